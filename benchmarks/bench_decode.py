@@ -0,0 +1,86 @@
+"""
+Benchmark the latency and quality of decoding large JPEG originals in full
+(``decode='quality'``) or at a reduced scale (``decode='fast'``).
+
+Quality is reported as the PSNR of the fast output against the full quality
+output, in dB: above 40 is generally indistinguishable.
+
+Usage::
+
+    $ PYTHONPATH=. python benchmarks/bench_decode.py [--megapixels 24]
+"""
+from __future__ import absolute_import, print_function, division
+
+import argparse
+import math
+import timeit
+
+from six import BytesIO
+from PIL import Image, ImageChops, ImageStat
+
+from pyramid_frontend.images.filters import ThumbFilter
+
+
+cases = [
+    ('200x200', dict(dimensions=(200, 200))),
+    ('200x200 crop', dict(dimensions=(200, 200), crop=True)),
+    ('300x300 pad', dict(dimensions=(300, 300), pad=True)),
+    ('1280w', dict(dimensions=(1280, None))),
+]
+
+
+def make_original(megapixels):
+    """
+    Return the data of a JPEG original with some detail in it.
+    """
+    h = int(math.sqrt(megapixels * 1e6 / 1.5))
+    w = int(h * 1.5)
+    fractal = Image.effect_mandelbrot((w, h), (-2.2, -1.2, 1.0, 1.2), 200)
+    gradient = Image.linear_gradient('L').resize((w, h))
+    radial = Image.radial_gradient('L').resize((w, h))
+    im = Image.merge('RGB', (fractal, gradient, radial))
+    # Some sensor-like noise.
+    im = ImageChops.add(im, Image.effect_noise((w, h), 6).convert('RGB'),
+                        1.0, -128)
+    buf = BytesIO()
+    im.save(buf, 'JPEG', quality=90)
+    return im.size, buf.getvalue()
+
+
+def psnr(a, b):
+    rms = ImageStat.Stat(ImageChops.difference(a, b)).rms
+    mse = sum(n ** 2 for n in rms) / len(rms)
+    if not mse:
+        return float('inf')
+    return 20 * math.log10(255 / math.sqrt(mse))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--megapixels', type=float, default=24)
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+
+    size, data = make_original(options.megapixels)
+    print('Original: %dx%d, %d bytes' % (size[0], size[1], len(data)))
+    print('%-14s %10s %10s %8s %10s' % ('case', 'quality', 'fast',
+                                        'speedup', 'PSNR'))
+    for label, kwargs in cases:
+        times = {}
+        outputs = {}
+        for decode in ('quality', 'fast'):
+            filter = ThumbFilter(decode=decode, **kwargs)
+
+            def run():
+                return filter(BytesIO(data))
+            outputs[decode] = run()
+            times[decode] = min(timeit.repeat(run, number=1,
+                                              repeat=options.repeat))
+        print('%-14s %8.1fms %8.1fms %7.1fx %8.1fdB' % (
+            label, times['quality'] * 1000, times['fast'] * 1000,
+            times['quality'] / times['fast'],
+            psnr(outputs['quality'], outputs['fast'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Benchmark the peak memory used to run filter chains on the sample images in
+``pyramid_frontend/tests/data``.
+
+Each chain is run on each sample in a fresh subprocess, and the growth of its
+peak RSS over that of a process which has only imported everything is
+reported, in MB. Samples may be enlarged with ``--scale``, since the samples
+themselves are small.
+
+To compare with another version, pass the path of its checkout with
+``--baseline``: each run is repeated with that first on the ``PYTHONPATH``.
+
+Usage::
+
+    $ PYTHONPATH=. python benchmarks/bench_memory.py [--scale 8] \\
+        [--baseline ../pyramid_frontend-1.0]
+"""
+from __future__ import absolute_import, print_function, division
+
+import argparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from PIL import Image
+
+
+samples_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'pyramid_frontend', 'tests', 'data')
+
+chains = [
+    ('jpg', dict(width=200, height=200, extension='jpg')),
+    ('jpg crop', dict(width=200, height=200, crop=True, extension='jpg')),
+    ('jpg pad', dict(width=300, height=300, pad=True, extension='jpg')),
+    ('png whitespace', dict(width=300, height=300, crop_whitespace=True)),
+    ('png nonwhite', dict(width=200, height=200, crop='nonwhite')),
+]
+
+
+def peak_rss():
+    """
+    Return the peak RSS of this process so far, in bytes.
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def worker(path, index):
+    """
+    Run one chain on the image at ``path``, and print the peak RSS before and
+    after.
+    """
+    from pyramid_frontend.images.chain import FilterChain
+    label, kwargs = chains[index]
+    chain = FilterChain('bench', **kwargs)
+    before = peak_rss()
+    with open(path, 'rb') as f:
+        try:
+            chain.run_chain(f, postprocess=False)
+        except TypeError:
+            # Versions before deferred optimization always postprocess, but
+            # that runs in external processes, so doesn't count here.
+            f.seek(0)
+            chain.run_chain(f)
+    print(before, peak_rss())
+
+
+def measure(path, index, pythonpath):
+    """
+    Return the growth in peak RSS, in MB, from running a chain on the image at
+    ``path``, or None if it fails (e.g. for want of ImageMagick).
+    """
+    env = dict(os.environ, PYTHONPATH=pythonpath)
+    with open(os.devnull, 'wb') as devnull:
+        try:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 '--worker', path, str(index)], env=env, stderr=devnull)
+        except subprocess.CalledProcessError:
+            return None
+    before, after = output.split()
+    return (int(after) - int(before)) / (1024 * 1024)
+
+
+def format_mb(mb):
+    if mb is None:
+        return '%10s' % 'failed'
+    return '%8.1fMB' % mb
+
+
+def samples(scale, dest_dir):
+    """
+    Yield the name and path of each sample image, enlarged by ``scale``.
+    """
+    for name in sorted(os.listdir(samples_dir)):
+        path = os.path.join(samples_dir, name)
+        try:
+            im = Image.open(path)
+        except IOError:
+            continue
+        if scale != 1:
+            format = im.format
+            im = im.resize((im.size[0] * scale, im.size[1] * scale),
+                           Image.BICUBIC)
+            path = os.path.join(dest_dir, name)
+            im.save(path, format)
+        yield name, path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--baseline')
+    parser.add_argument('--worker', nargs=2, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.worker:
+        path, index = options.worker
+        worker(path, int(index))
+        return
+
+    pythonpath = os.environ.get('PYTHONPATH', '.')
+    baseline = options.baseline
+    if baseline:
+        baseline = os.pathsep.join([os.path.abspath(baseline), pythonpath])
+        print('%-24s %-16s %10s %10s' % ('sample', 'chain', 'baseline',
+                                         'current'))
+    else:
+        print('%-24s %-16s %10s' % ('sample', 'chain', 'current'))
+
+    dest_dir = tempfile.mkdtemp()
+    try:
+        for name, path in samples(options.scale, dest_dir):
+            for index, (label, kwargs) in enumerate(chains):
+                current = format_mb(measure(path, index, pythonpath))
+                if baseline:
+                    print('%-24s %-16s %s %s' % (
+                        name, label,
+                        format_mb(measure(path, index, baseline)), current))
+                else:
+                    print('%-24s %-16s %s' % (name, label, current))
+    finally:
+        shutil.rmtree(dest_dir)
+
+
+if __name__ == '__main__':
+    main()
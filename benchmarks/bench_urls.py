@@ -0,0 +1,69 @@
+"""
+Benchmark the cost per URL of building image URLs for a gallery page.
+
+Usage::
+
+    $ PYTHONPATH=. python benchmarks/bench_urls.py [--count 200] [--repeat 20]
+"""
+from __future__ import absolute_import, print_function, division
+
+import argparse
+import hashlib
+import timeit
+
+from pyramid.scripting import prepare
+
+from pyramid_frontend.tests import utils
+
+
+def route_urls(request, names, original_ext, filter_key):
+    """
+    Build URLs the way ``image_url()`` used to: with a registry lookup, an
+    MD5 and a full route generation per URL.
+    """
+    chain, with_theme = request.registry.image_filter_registry[filter_key]
+    return [request.route_path(
+        'pyramid_frontend:images',
+        prefix=hashlib.md5(name.encode('utf-8')).hexdigest()[:4],
+        name=chain.basename(name, original_ext))
+        for name in names]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--count', type=int, default=200,
+                        help='Number of images on the page.')
+    parser.add_argument('--repeat', type=int, default=20)
+    options = parser.parse_args()
+
+    settings_variants = [
+        ('plain', {}),
+        ('signed', {'pyramid_frontend.image_signing_keys': 'secret'}),
+    ]
+    names = ['product-image-%06d' % ii for ii in range(options.count)]
+
+    for label, settings in settings_variants:
+        app = utils.make_app(settings)
+        env = prepare(registry=app.registry)
+        request = env['request']
+        try:
+            cases = [
+                ('route per URL', lambda: route_urls(request, names, 'jpg',
+                                                     'thumb')),
+                ('image_url', lambda: [request.image_url(name, 'jpg', 'thumb')
+                                       for name in names]),
+                ('image_urls', lambda: request.image_urls(names, 'jpg',
+                                                          'thumb')),
+            ]
+            for case, func in cases:
+                func()
+                best = min(timeit.repeat(func, number=1,
+                                         repeat=options.repeat))
+                print('%-8s %-14s %8.2f us/url' %
+                      (label, case, best / options.count * 1e6))
+        finally:
+            env['closer']()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,20 @@ from __future__ import absolute_import, print_function, division
 
 from webhelpers2.html.tags import HTML
 
-from .files import (prefix_for_name, get_url_prefix, original_path,
-                    save_image, save_to_error_dir, check, filter_sep)
-from .view import ImageView, MissingOriginal
+from .files import (get_url_prefix, original_path, save_image,
+                    save_to_error_dir, check, filter_sep)
+from .view import (ImageView, MissingOriginal, process_variants,
+                   negotiable_formats, find_image_filter, check_offload_mode)
+from .executor import executor_from_settings
+from .urls import get_url_builder, template_base
+from .metadata import image_dimensions
+from .shmcache import shared_cache_from_settings
+from .cache import missing_cache_from_settings
+from .eviction import sweeper_from_settings
+from .warmup import check_warmup
 from .chain import PassThroughFilterChain, FilterChain
 
-__all__ = ['FilterChain', 'MissingOriginal',
+__all__ = ['FilterChain', 'MissingOriginal', 'process_variants',
            'save_image', 'save_to_error_dir', 'check', 'filter_sep']
 
 
@@ -53,31 +61,43 @@ def image_url(request, name, original_ext, filter_key,
               qualified=False, _scheme=None, _host=None, _port=None):
     """
     Return the URL for an image as processed by a specified image filter chain.
+
+    If ``pyramid_frontend.image_versioned_urls`` is enabled, the URL includes
+    a version token which changes when the original image or the chain
+    changes, so that it can be cached indefinitely.
+
+    If ``pyramid_frontend.image_signing_keys`` is set, the URL is signed, and
+    the image view will only process images for signed URLs.
     """
-    filter_registry = request.registry.image_filter_registry
+    return image_urls(request, [name], original_ext, filter_key,
+                      qualified=qualified, _scheme=_scheme, _host=_host,
+                      _port=_port)[0]
 
+
+def image_urls(request, names, original_ext, filter_key,
+               qualified=False, _scheme=None, _host=None, _port=None):
+    """
+    Return a list of the URLs for several images with the same extension, as
+    processed by a specified image filter chain, as ``image_url()`` would.
+
+    Rather than generating each URL with the route, the route is used once
+    per request to generate the common part of image URLs, and the rest is
+    built by an ``ImageURLBuilder`` for the chain, so this is much faster
+    than generating URLs one at a time with Pyramid.
+    """
     # Check if there is a theme active. If so, check that the supplied
     # filter_key is ref'd within the theme: if not, fail with a descriptive
     # exception.
-    chain, with_theme_set = filter_registry[filter_key]
+    chain, with_theme_set = find_image_filter(request.registry, filter_key)
     if with_theme_set and getattr(request, 'theme', None):
         assert request.theme in with_theme_set, \
             ("current theme is %r, but this filter is only registered "
              "with %r" % (request.theme, with_theme_set))
 
-    prefix = prefix_for_name(name)
-    name = chain.basename(name, original_ext)
-    if qualified:
-        return request.route_url('pyramid_frontend:images',
-                                 prefix=prefix,
-                                 name=name,
-                                 _scheme=_scheme or request.scheme,
-                                 _host=_host or request.host,
-                                 _port=_port or request.server_port)
-    else:
-        return request.route_path('pyramid_frontend:images',
-                                  prefix=prefix,
-                                  name=name)
+    builder = get_url_builder(request.registry, filter_key)
+    base = template_base(request, qualified=qualified, _scheme=_scheme,
+                         _host=_host, _port=_port)
+    return [builder.url(base, name, original_ext) for name in names]
 
 
 def image_tag(request, name, original_ext, filter_key,
@@ -85,16 +105,41 @@ def image_tag(request, name, original_ext, filter_key,
     """
     Return the HTML tag for an image as processed by a specified image filter
     chain.
+
+    If the chain has a width or density ladder, a ``srcset`` attribute lists
+    the URL for each rung, so that the browser can pick the best one. With a
+    width ladder, ``sizes`` defaults to the chain's width.
+
+    If ``pyramid_frontend.image_metadata_index`` is set and the original is
+    indexed, ``width`` and ``height`` default to the actual dimensions of the
+    processed image, computed without opening it. Otherwise they default to
+    the chain's.
     """
-    filter_registry = request.registry.image_filter_registry
-    chain, with_theme = filter_registry[filter_key]
+    chain, with_theme = find_image_filter(request.registry, filter_key)
 
-    kwargs.setdefault('width', chain.width)
-    kwargs.setdefault('height', chain.height)
+    size = image_dimensions(request.registry.settings, name, original_ext,
+                            chain)
+    if size:
+        kwargs.setdefault('width', size[0])
+        kwargs.setdefault('height', size[1])
+    else:
+        kwargs.setdefault('width', chain.width)
+        kwargs.setdefault('height', chain.height)
 
     url = request.image_url(name, original_ext, filter_key,
                             qualified=qualified, _scheme=_scheme, _host=_host)
 
+    rungs = chain.rungs()
+    if rungs and 'srcset' not in kwargs:
+        kwargs['srcset'] = ', '.join(
+            '%s %s' % (request.image_url(name, original_ext, suffix,
+                                         qualified=qualified,
+                                         _scheme=_scheme, _host=_host),
+                       descriptor)
+            for descriptor, suffix in rungs)
+        if chain.widths and chain.width:
+            kwargs.setdefault('sizes', '%dpx' % chain.width)
+
     return HTML.img(src=url, **kwargs)
 
 
@@ -111,10 +156,26 @@ def includeme(config):
     config.add_image_filter(PassThroughFilterChain())
 
     config.add_request_method(image_url, 'image_url')
+    config.add_request_method(image_urls, 'image_urls')
     config.add_request_method(image_tag, 'image_tag')
     config.add_request_method(image_original_path, 'image_original_path')
 
+    check_offload_mode(config.registry.settings)
+    # Once the themes have been registered.
+    config.action(None, check_warmup, args=(config.registry,), order=1)
+
     url_prefix = get_url_prefix(config.registry.settings)
     config.add_route('pyramid_frontend:images',
                      '%s/{prefix}/{name:.+\.\w+}' % url_prefix)
     config.add_view(ImageView, route_name='pyramid_frontend:images')
+
+    config.registry.image_executor = \
+        executor_from_settings(config.registry.settings)
+    config.registry.image_cache = \
+        shared_cache_from_settings(config.registry.settings)
+    config.registry.image_missing_cache = \
+        missing_cache_from_settings(config.registry.settings)
+    config.registry.image_sweeper = sweeper_from_settings(config.registry)
+    config.registry.image_negotiate_formats = \
+        negotiable_formats(config.registry.settings)
+    config.registry.image_url_builders = {}
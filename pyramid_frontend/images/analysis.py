@@ -0,0 +1,221 @@
+"""
+Faster image analysis used to decide how to crop images, vectorized with NumPy
+where it's installed, and otherwise doing less work than the straightforward
+implementations.
+
+Each function gives the same results as its counterpart in
+``pyramid_frontend.images.utils``, which is used instead where NumPy doesn't
+help. The ``proxy_*`` functions instead make an approximate decision about a
+large image by analyzing a reduced copy of it.
+"""
+from __future__ import absolute_import, print_function, division
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import utils
+
+
+# Modes for which bounding boxes are computed with a lookup table.
+# Image.getbbox() only considers the alpha band of images which have one.
+bbox_modes = frozenset(['L', 'P', 'RGB', 'CMYK'])
+
+
+def is_white_background(im, tolerance=180):
+    """
+    Check if this image is against a white background: that is, if every border
+    pixel is white.
+
+    Only the border is converted to RGB, rather than the whole image.
+    """
+    w, h = im.size
+    strips = [(0, 0, w, 1), (0, h - 1, w, h), (0, 0, 1, h), (w - 1, 0, w, h)]
+    for box in strips:
+        strip = im.crop(box).convert('RGB')
+        if numpy is None:
+            if not utils.is_white_background(strip, tolerance=tolerance):
+                return False
+        else:
+            a = numpy.asarray(strip).reshape(-1, 3)
+            # The manhattan distance of each pixel from white.
+            distance = 765 - a.sum(axis=1, dtype=numpy.int32)
+            if (distance > tolerance).any():
+                return False
+    return True
+
+
+def bounding_box(im, tolerance=0):
+    """
+    Return the bounding box of the parts of an image which differ from the
+    color of its top left pixel by more than ``tolerance`` in any band, or
+    None if none do.
+
+    Rather than comparing the image with a background image, a lookup table
+    maps each band straight to whether it differs.
+    """
+    if im.mode not in bbox_modes:
+        return utils.bounding_box(im, tolerance=tolerance)
+    background = im.getpixel((0, 0))
+    if not isinstance(background, tuple):
+        background = (background,)
+    table = []
+    for value in background:
+        table.extend(255 if abs(n - value) > tolerance else 0
+                     for n in range(256))
+    return im.point(table).getbbox()
+
+
+def histogram_entropy(hist):
+    """
+    Return the entropy of an image with the histogram ``hist``.
+    """
+    if numpy is None:
+        return utils.histogram_entropy(hist)
+    hist = numpy.asarray(hist, dtype=numpy.float64)
+    p = hist[hist != 0] / hist.sum()
+    return -float((p * numpy.log2(p)).sum())
+
+
+def less_entropy(a, b):
+    """
+    Return True if the image with histogram ``a`` has less entropy than the
+    one with histogram ``b``.
+    """
+    entropy_a = histogram_entropy(a)
+    entropy_b = histogram_entropy(b)
+    if abs(entropy_a - entropy_b) < 1e-9:
+        # Too close to call with a different rounding error from
+        # utils.image_entropy(), so make the same call it would.
+        return utils.histogram_entropy(a) < utils.histogram_entropy(b)
+    return entropy_a < entropy_b
+
+
+def entropy_window_width(im, desired_w):
+    """
+    Return the ``(left, right)`` offsets of the columns which
+    ``crop_entropy_width()`` would keep.
+    """
+    w, h = im.size
+    left, right = 0, w
+    while right - left > desired_w:
+        width = right - left
+        slice_width = min(width - desired_w, int(math.floor(width * 0.1)))
+        left_slice = im.crop((left, 0, left + slice_width, h))
+        right_slice = im.crop((right - slice_width, 0, right, h))
+        if less_entropy(left_slice.histogram(), right_slice.histogram()):
+            left += slice_width
+        else:
+            right -= slice_width
+    return left, right
+
+
+def entropy_window_height(im, desired_h):
+    """
+    Return the ``(top, bottom)`` offsets of the rows which
+    ``crop_entropy_height()`` would keep.
+    """
+    w, h = im.size
+    top, bottom = 0, h
+    while bottom - top > desired_h:
+        height = bottom - top
+        slice_height = min(height - desired_h, int(math.floor(height * 0.1)))
+        top_slice = im.crop((0, top, w, top + slice_height))
+        bottom_slice = im.crop((0, bottom - slice_height, w, bottom))
+        if less_entropy(bottom_slice.histogram(), top_slice.histogram()):
+            bottom -= slice_height
+        else:
+            top += slice_height
+    return top, bottom
+
+
+def crop_entropy_width(im, desired_w):
+    """
+    Like ``utils.crop_entropy_width()``, but only the slices are cropped from
+    the image while deciding where to crop it, and then it's cropped once.
+    """
+    w, h = im.size
+    left, right = entropy_window_width(im, desired_w)
+    if (left, right) == (0, w):
+        return im
+    return im.crop((left, 0, right, h))
+
+
+def crop_entropy_height(im, desired_h):
+    """
+    Like ``utils.crop_entropy_height()``, cropping the image once.
+    """
+    w, h = im.size
+    top, bottom = entropy_window_height(im, desired_h)
+    if (top, bottom) == (0, h):
+        return im
+    return im.crop((0, top, w, bottom))
+
+
+def crop_entropy(im, dimensions):
+    """
+    Scale and crop the image to the desired aspect ratio, like
+    ``utils.crop_entropy()``.
+    """
+    return utils.crop_entropy(im, dimensions,
+                              crop_width=crop_entropy_width,
+                              crop_height=crop_entropy_height)
+
+
+def proxy_entropy_box(proxy, size, dimensions):
+    """
+    Return the box, in an image of ``size``, which an entropy crop to the
+    aspect ratio of ``dimensions`` should keep, deciding where to crop with
+    ``proxy``, a reduced copy of the image.
+
+    The box may have fractional coordinates, and is meant to be passed to
+    ``Image.resize()``, so that the image is cropped and resized at once.
+    """
+    w, h = size
+    proxy_w, proxy_h = proxy.size
+    desired_w, desired_h = dimensions
+    input_ar = w / h
+    desired_ar = desired_w / desired_h
+
+    if input_ar > desired_ar:
+        crop_w = h * desired_ar
+        scale = w / proxy_w
+        left, right = entropy_window_width(
+            proxy, max(1, int(round(crop_w / scale))))
+        left = min(left * scale, w - crop_w)
+        return (left, 0, left + crop_w, h)
+    elif input_ar < desired_ar:
+        crop_h = w / desired_ar
+        scale = h / proxy_h
+        top, bottom = entropy_window_height(
+            proxy, max(1, int(round(crop_h / scale))))
+        top = min(top * scale, h - crop_h)
+        return (0, top, w, top + crop_h)
+    else:
+        return (0, 0, w, h)
+
+
+def proxy_bounding_box(proxy, size, tolerance=0):
+    """
+    Return the bounding box, in an image of ``size``, of what
+    ``bounding_box()`` finds in ``proxy``, a reduced copy of the image, or
+    None if it finds nothing.
+
+    The box is widened by a pixel of the proxy on each side, since the edges
+    of what's in the image are blurred when it's reduced.
+    """
+    box = bounding_box(proxy, tolerance=tolerance)
+    if box is None:
+        return None
+    w, h = size
+    proxy_w, proxy_h = proxy.size
+    scale_x = w / proxy_w
+    scale_y = h / proxy_h
+    x0, y0, x1, y1 = box
+    return (max(0, int(math.floor((x0 - 1) * scale_x))),
+            max(0, int(math.floor((y0 - 1) * scale_y))),
+            min(w, int(math.ceil((x1 + 1) * scale_x))),
+            min(h, int(math.ceil((y1 + 1) * scale_y))))
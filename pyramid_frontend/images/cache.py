@@ -0,0 +1,118 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import time
+import threading
+
+from collections import OrderedDict
+
+from .files import prefix_for_name
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping which holds at most ``maxsize`` items, discarding
+    the least recently used items first.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+
+class MissingCache(object):
+    """
+    Remembers original images which were found to be missing, for ``ttl``
+    seconds, so that repeated requests for them (e.g. from crawlers following
+    stale links) can be rejected without touching the filesystem.
+
+    By default, entries are held in a bounded in-process LRU, and an entry is
+    only invalidated early in the process which saves the original. If
+    ``shared_dir`` is given, entries are instead kept as marker files in that
+    directory, so they are shared by (and invalidated for) every process which
+    uses it, at the cost of a ``stat()`` per check.
+    """
+
+    def __init__(self, ttl, maxsize=10000, shared_dir=None):
+        self.ttl = ttl
+        self.shared_dir = shared_dir
+        self._expires = LRUCache(maxsize)
+
+    def _marker_path(self, name, original_ext):
+        return os.path.join(self.shared_dir, prefix_for_name(name),
+                            '%s.%s' % (name, original_ext))
+
+    def is_missing(self, name, original_ext):
+        now = time.time()
+        if self.shared_dir:
+            try:
+                mtime = os.stat(self._marker_path(name, original_ext)).st_mtime
+            except OSError:
+                return False
+            return mtime + self.ttl > now
+        expires = self._expires.get((name, original_ext))
+        return bool(expires and expires > now)
+
+    def add(self, name, original_ext):
+        if self.shared_dir:
+            path = self._marker_path(name, original_ext)
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+            # The marker's modification time records when it was added.
+            open(path, 'w').close()
+        else:
+            self._expires.set((name, original_ext), time.time() + self.ttl)
+
+    def discard(self, name, original_ext):
+        if self.shared_dir:
+            try:
+                os.unlink(self._marker_path(name, original_ext))
+            except OSError:
+                pass
+        else:
+            self._expires.pop((name, original_ext))
+
+
+def missing_cache_from_settings(settings):
+    """
+    Return a ``MissingCache`` configured by
+    ``pyramid_frontend.missing_image_ttl`` and friends, or None if missing
+    originals should not be cached, which is the default.
+    """
+    ttl = int(settings.get('pyramid_frontend.missing_image_ttl') or 0)
+    if not ttl:
+        return None
+    maxsize = int(settings.get('pyramid_frontend.missing_image_cache_size') or
+                  10000)
+    shared_dir = settings.get('pyramid_frontend.missing_image_cache_dir')
+    return MissingCache(ttl, maxsize=maxsize, shared_dir=shared_dir)
@@ -1,17 +1,20 @@
 from __future__ import absolute_import, print_function, division
 
+import re
 import os
-import stat
-
-from shutil import copyfileobj
+import copy
+import hashlib
 
 from .files import filter_sep
+from .storage import atomic_write
 from .filters import (PNGSaver, PNGProcessor, JPGSaver, JPGProcessor,
-                      ThumbFilter)
+                      WebPSaver, AVIFSaver, ThumbFilter, VignetteFilter)
 
 savers = {
     'png': PNGSaver,
     'jpg': JPGSaver,
+    'webp': WebPSaver,
+    'avif': AVIFSaver,
 }
 
 
@@ -21,22 +24,111 @@ postprocessors = {
 }
 
 
+optimized_marker_suffix = '.optimized'
+
+# Saver settings which apply to every format, and so are also used for the
+# formats a chain's images are converted to by content negotiation.
+shared_saver_kwargs = ('sharpness',)
+
+# Built-in filters which may be passed a decoded PIL image instead of image
+# data. Subclasses aren't included, since they may expect image data.
+image_filter_classes = (ThumbFilter, VignetteFilter, PNGSaver, JPGSaver,
+                        WebPSaver, AVIFSaver)
+
+# The suffix of a chain derived from another chain by a width or density
+# ladder, e.g. 'thumb-w640' or 'thumb-2x'.
+derived_suffix_re = re.compile(r'^(.+)-(w\d{1,5}|\d{1,2}(?:\.\d{1,2})?x)$')
+
+
+def split_derived_suffix(suffix):
+    """
+    Split the suffix of a derived chain into the suffix of the chain it's
+    derived from and the rung of its ladder, like ``('thumb', 'w640')``, or
+    return None if it isn't one.
+    """
+    match = derived_suffix_re.match(suffix or '')
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+def find_chain(chains, suffix):
+    """
+    Return the chain for ``suffix`` in ``chains``, a dict of chains by suffix,
+    including chains derived from them by their ladders. Raises KeyError if
+    there isn't one.
+    """
+    chain = chains.get(suffix)
+    if chain is None:
+        split = split_derived_suffix(suffix)
+        if split is not None and split[0] in chains:
+            chain = chains[split[0]].derived(split[1])
+        if chain is None:
+            raise KeyError(suffix)
+    return chain
+
+
+def trailing_deferrable(filters):
+    """
+    Split a list of filters into the leading filters which must be run inline,
+    and the trailing lossless optimization filters which may be deferred.
+    """
+    split = len(filters)
+    while split and filters[split - 1].deferrable:
+        split -= 1
+    return filters[:split], filters[split:]
+
+
 class FilterChain(object):
     """
     A chain of image filters (a.k.a. "pipeline") used to process images for a
     particular display context.
+
+    Chains may declare a ladder of ``widths`` or pixel ``densities``, for
+    responsive images. Each rung is served by a chain which is derived from
+    this one on demand, with a suffix like ``thumb-w640`` or ``thumb-2x``.
+
+    With ``decode='fast'``, large JPEG originals are decoded at a reduced
+    scale before resizing, trading a little quality for speed and memory.
+    With ``proxy_size``, where to crop large originals is decided on a copy
+    reduced to about that size, to within ``proxy_tolerance`` output pixels.
     """
+    # Whether the chain can be run on an already-decoded PIL image, rather
+    # than the raw original image data. Only chains made entirely of built-in
+    # image filters can.
+    accepts_image = False
+
     def __init__(self, suffix, filters=(), extension='png',
                  width=None, height=None, no_thumb=False,
                  pad=False, crop=False, crop_whitespace=False,
-                 background='white', enlarge=False,
-                 **saver_kwargs):
+                 background='white', enlarge=False, fingerprinted=False,
+                 widths=None, densities=None, decode='quality',
+                 proxy_size=None, proxy_tolerance=1.0, **saver_kwargs):
 
         self.suffix = suffix
         self.filters = list(filters)
+        self.accepts_image = all(type(filter) in image_filter_classes
+                                 for filter in self.filters)
         self.width = width
         self.height = height
         self.extension = extension
+        self.fingerprinted = fingerprinted
+        self.widths = sorted(widths) if widths else None
+        self.densities = sorted(densities) if densities else None
+
+        # Used to build derived chains.
+        self._kwargs = dict(saver_kwargs,
+                            filters=filters, extension=extension,
+                            no_thumb=no_thumb, pad=pad, crop=crop,
+                            crop_whitespace=crop_whitespace,
+                            background=background, enlarge=enlarge,
+                            fingerprinted=fingerprinted, decode=decode,
+                            proxy_size=proxy_size,
+                            proxy_tolerance=proxy_tolerance)
+        self._derived = {}
+
+        assert not (widths and not width), \
+            "a width ladder requires a width"
 
         assert filter_sep not in suffix, \
             "filter suffix cannot contain %r" % filter_sep
@@ -47,46 +139,210 @@ class FilterChain(object):
             self.filters.append(ThumbFilter(
                 (width, height),
                 pad=pad, crop=crop, crop_whitespace=crop_whitespace,
-                background=background, enlarge=enlarge))
+                background=background, enlarge=enlarge, decode=decode,
+                proxy_size=proxy_size, proxy_tolerance=proxy_tolerance))
 
         saver_class = savers[self.extension]
         self.filters.append(saver_class(**saver_kwargs))
 
-        self.filters.append(postprocessors[self.extension]())
+        if self.extension in postprocessors:
+            self.filters.append(postprocessors[self.extension]())
+
+        self.fingerprint = self.compute_fingerprint()
+        self._alternates = {}
 
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.suffix)
 
+    def compute_fingerprint(self):
+        """
+        Return a short hash of this chain's output format and the parameters
+        of all its filters.
+        """
+        data = '%s:%s' % (self.extension,
+                          ','.join(filter.fingerprint_data()
+                                   for filter in self.filters))
+        return hashlib.md5(data.encode('utf-8')).hexdigest()[:8]
+
+    @property
+    def versioned_suffix(self):
+        """
+        The suffix used in processed image filenames. If the chain is
+        ``fingerprinted``, this includes the fingerprint, so that changing the
+        chain's configuration results in new filenames (and URLs), and
+        previously processed images are no longer used.
+        """
+        if self.fingerprinted:
+            return '%s.%s' % (self.suffix, self.fingerprint)
+        return self.suffix
+
+    def output_size(self, size):
+        """
+        Return the ``(width, height)`` of the images this chain produces from
+        an original image of ``size``, or None if that can't be known without
+        processing the image.
+        """
+        for filter in self.filters:
+            size = filter.output_size(size)
+            if size is None:
+                return None
+        return tuple(size)
+
+    def scaled_size(self, width):
+        """
+        Return the dimensions of this chain's output, scaled to ``width``.
+        """
+        height = self.height
+        if height:
+            height = int(round(height * width / self.width))
+        return width, height
+
+    def bucket_width(self, width):
+        """
+        Return the width on this chain's width ladder which should be used for
+        an image requested at ``width``: the next one up, or the largest.
+        """
+        for bucket in self.widths:
+            if bucket >= width:
+                return bucket
+        return self.widths[-1]
+
+    def derived(self, rung):
+        """
+        Return the chain for a rung of this chain's width ladder, like
+        ``'w640'``, or its density ladder, like ``'2x'``, or None if it
+        doesn't have that rung.
+        """
+        chain = self._derived.get(rung)
+        if chain is not None:
+            return chain
+        # Only the canonical spelling of each rung is accepted, so that each
+        # is only processed and stored once.
+        if rung.startswith('w'):
+            width = int(rung[1:])
+            if not (self.widths and width in self.widths and
+                    rung == 'w%d' % width):
+                return None
+            width, height = self.scaled_size(width)
+        else:
+            density = float(rung[:-1])
+            if not (self.densities and density in self.densities and
+                    density != 1 and rung == '%gx' % density):
+                return None
+            width = self.width and int(round(self.width * density))
+            height = self.height and int(round(self.height * density))
+        chain = self.__class__('%s-%s' % (self.suffix, rung),
+                               width=width, height=height, **self._kwargs)
+        self._derived[rung] = chain
+        return chain
+
+    def rungs(self):
+        """
+        Return a list of ``(descriptor, suffix)`` pairs for this chain's
+        ladder, where the descriptor is as used in a ``srcset`` attribute,
+        like ``640w`` or ``2x``. A width ladder takes precedence over a
+        density ladder.
+        """
+        if self.widths:
+            return [('%dw' % width, '%s-w%d' % (self.suffix, width))
+                    for width in self.widths]
+        if self.densities:
+            return [('%gx' % density,
+                     self.suffix if density == 1 else
+                     '%s-%gx' % (self.suffix, density))
+                    for density in self.densities]
+        return []
+
+    def with_extension(self, extension):
+        """
+        Return a copy of this chain which saves images in the format for
+        ``extension`` instead, using that format's default saver settings,
+        apart from ``sharpness``.
+        Processed images from the copy are stored separately, since their
+        basenames have a different extension.
+        """
+        if extension == self.extension:
+            return self
+        alternate = self._alternates.get(extension)
+        if alternate is None:
+            alternate = copy.copy(self)
+            alternate.extension = extension
+            alternate.filters = trailing_deferrable(self.filters)[0][:-1]
+            saver_kwargs = dict((key, self._kwargs[key])
+                                for key in shared_saver_kwargs
+                                if key in self._kwargs)
+            alternate.filters.append(savers[extension](**saver_kwargs))
+            if extension in postprocessors:
+                alternate.filters.append(postprocessors[extension]())
+            alternate.fingerprint = alternate.compute_fingerprint()
+            alternate._alternates = {}
+            alternate._derived = {}
+            alternate.widths = alternate.densities = None
+            self._alternates[extension] = alternate
+        return alternate
+
     def basename(self, name, original_ext):
         return ''.join([name,
                         filter_sep,
                         original_ext,
                         filter_sep,
-                        self.suffix,
+                        self.versioned_suffix,
                         '.',
                         self.extension])
 
-    def run_chain(self, image_data):
-        for filter in self.filters:
+    def deferrable_filters(self, dest_path):
+        """
+        Return the trailing lossless optimization filters which may be run
+        later on the file written to ``dest_path``, via ``optimize()``.
+        """
+        return trailing_deferrable(self.filters)[1]
+
+    def run_chain(self, image_data, postprocess=True):
+        filters = self.filters
+        if not postprocess:
+            filters = trailing_deferrable(filters)[0]
+        for filter in filters:
             image_data = filter(image_data)
         return image_data
 
-    def write(self, dest_path, filtered):
-        # We have the final image data, now save it.
+    def write(self, dest_path, filtered, fsync=False):
+        # We have the final image data, now save it. It's written to a
+        # temporary file and renamed into place, so that the file at
+        # dest_path is always complete.
         dest_dir = os.path.dirname(dest_path)
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
-        copyfileobj(filtered, open(dest_path, 'wb'))
+        atomic_write(dest_path, filtered, fsync=fsync)
+        return True
 
-        # Make this writable by everyone.
-        bits = os.stat(dest_path).st_mode
-        os.chmod(dest_path, bits | stat.S_IWGRP | stat.S_IWOTH)
+    def process(self, dest_path, image_data, postprocess=True):
+        """
+        Run the chain and return a file-like object with the contents which
+        should be stored at ``dest_path``.
+        """
+        return self.run_chain(image_data, postprocess=postprocess)
 
-        return True
+    def run(self, dest_path, image_data, postprocess=True, fsync=False):
+        filtered = self.process(dest_path, image_data,
+                                postprocess=postprocess)
+        return self.write(dest_path, filtered, fsync=fsync)
 
-    def run(self, dest_path, image_data):
-        filtered = self.run_chain(image_data)
-        return self.write(dest_path, filtered)
+    def optimize(self, dest_path, fsync=False):
+        """
+        Apply lossless optimization which was skipped by calling ``run()``
+        with ``postprocess=False``, replacing the file at ``dest_path``. A
+        marker file is left alongside, so that this only happens once.
+        Returns True if the file was optimized.
+        """
+        marker_path = dest_path + optimized_marker_suffix
+        if os.path.exists(marker_path):
+            return False
+        filtered = open(dest_path, 'rb')
+        for filter in self.deferrable_filters(dest_path):
+            filtered = filter(filtered)
+        atomic_write(dest_path, filtered, fsync=fsync)
+        open(marker_path, 'w').close()
+        return True
 
 
 class PassThroughFilterChain(FilterChain):
@@ -94,19 +350,34 @@ class PassThroughFilterChain(FilterChain):
     A filter chain which does not do any manipulation, only applies lossless
     optimization tools.
     """
+    accepts_image = False
+
     def __init__(self, suffix=None, filters=()):
         self.suffix = suffix
         self.extension = None
         self.filters = filters
         self.width = None
         self.height = None
+        self.fingerprinted = False
+        self.fingerprint = None
+        self.widths = None
+        self.densities = None
+
+    def derived(self, rung):
+        return None
 
     def basename(self, name, original_ext):
         return '%s.%s' % (name, original_ext)
 
-    def run(self, dest_path, image_data):
-        filtered = self.run_chain(image_data)
+    def deferrable_filters(self, dest_path):
         ext = dest_path.rsplit('.', 1)[-1]
         if ext in postprocessors:
-            filtered = postprocessors[ext]()(filtered)
-        return self.write(dest_path, filtered)
+            return [postprocessors[ext]()]
+        return []
+
+    def process(self, dest_path, image_data, postprocess=True):
+        filtered = self.run_chain(image_data)
+        if postprocess:
+            for filter in self.deferrable_filters(dest_path):
+                filtered = filter(filtered)
+        return filtered
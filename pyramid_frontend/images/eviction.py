@@ -0,0 +1,290 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import re
+import time
+import logging
+import threading
+
+from .files import filter_sep
+from .chain import optimized_marker_suffix, find_chain
+from .locking import PathLock, lock_suffix
+from .storage import get_storage
+
+log = logging.getLogger(__name__)
+
+
+temp_suffix = '.tmp'
+
+# Processed images are sharded into directories named by prefix_for_name().
+shard_re = re.compile(r'^[0-9a-f]{4}$')
+
+size_units = {
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4,
+}
+
+
+def parse_size(value):
+    """
+    Parse a size in bytes, optionally with a ``K``, ``M``, ``G`` or ``T``
+    suffix, e.g. ``500M``.
+    """
+    if value in (None, ''):
+        return None
+    value = str(value).strip().lower().rstrip('b')
+    multiplier = size_units.get(value[-1:])
+    if multiplier:
+        value = value[:-1]
+    return int(float(value) * (multiplier or 1))
+
+
+def registered_chains(registry):
+    """
+    Return a dict of the filter chains registered in ``registry``, by suffix.
+    """
+    return dict((suffix, chain) for suffix, (chain, with_theme)
+                in getattr(registry, 'image_filter_registry', {}).items())
+
+
+def variant_chain(chains, filename, formats=()):
+    """
+    Return the chain in ``chains`` (a dict by suffix) which produces the
+    processed image ``filename``, or None if no chain would produce it, e.g.
+    because its chain is no longer registered, or was fingerprinted and has
+    since changed. Images in any of ``formats`` (extensions) are expected to
+    have been produced for content negotiation.
+    """
+    if '.' not in filename:
+        return None
+    base, ext = filename.rsplit('.', 1)
+    if filter_sep in base:
+        parts = base.split(filter_sep, 2)
+        if len(parts) != 3:
+            return None
+        name, original_ext, versioned_suffix = parts
+    else:
+        name, original_ext, versioned_suffix = base, ext, None
+    try:
+        chain = find_chain(chains, versioned_suffix)
+    except KeyError:
+        if not (versioned_suffix and '.' in versioned_suffix):
+            return None
+        try:
+            chain = find_chain(chains, versioned_suffix.rsplit('.', 1)[0])
+        except KeyError:
+            return None
+    if chain.extension and ext != chain.extension and ext in formats:
+        # Served instead of the chain's own format by content negotiation.
+        chain = chain.with_extension(ext)
+    # The fingerprint and extension need to match what the chain would
+    # produce now, too.
+    if chain.basename(name, original_ext) != filename:
+        return None
+    return chain
+
+
+def remove_variant(path, dry_run=False):
+    """
+    Remove a processed image and its optimization marker, unless it's
+    currently being written. Returns True if it was removed.
+    """
+    lock = PathLock(path)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        if not dry_run:
+            for remove_path in (path, path + optimized_marker_suffix):
+                try:
+                    os.unlink(remove_path)
+                except OSError:
+                    pass
+    finally:
+        lock.release()
+    return True
+
+
+def sweep(settings, chains, formats=(), max_size=None, max_files=None,
+          temp_age=3600, min_age=0, dry_run=False):
+    """
+    Garbage collect the processed image directory.
+
+    Processed images which aren't produced by any of ``chains`` (a dict by
+    suffix) any more, in their own format or one of the negotiated
+    ``formats``, are removed, along with orphaned lock files, optimization
+    markers, and temporary files older than ``temp_age`` seconds. Then, if the
+    remaining images take up more than ``max_size`` bytes or ``max_files``
+    files, the least recently used images are removed until they don't,
+    except for those used within the last ``min_age`` seconds, which may be
+    being served.
+
+    Recent use is judged by the later of each file's access and modification
+    times, so it's only as accurate as the filesystem's ``atime`` updates.
+
+    Images are only removed while holding their ``PathLock``, without waiting
+    for it, so that this never interferes with an image being processed. If
+    ``dry_run`` is set, nothing is removed, and the counts are of what would
+    have been.
+
+    Returns a dict of counts.
+    """
+    if not get_storage(settings, 'processed').local:
+        raise ValueError('Garbage collection is only supported for local '
+                         'processed image storage')
+    root = settings['pyramid_frontend.processed_image_dir']
+    stats = dict(unregistered=0, evicted=0, locks=0, markers=0, temp=0,
+                 freed=0, files=0, size=0)
+    now = time.time()
+    variants = []
+
+    for shard in sorted(os.listdir(root)):
+        dirpath = os.path.join(root, shard)
+        if not (shard_re.match(shard) and os.path.isdir(dirpath)):
+            continue
+        filenames = set(os.listdir(dirpath))
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Removed since we listed the directory.
+                continue
+
+            if filename.endswith(lock_suffix):
+                # Taking the lock succeeds only if nobody holds it, and
+                # releasing it removes the lock file.
+                lock = PathLock(path[:-len(lock_suffix)])
+                if dry_run or lock.acquire(blocking=False):
+                    if not dry_run:
+                        lock.release()
+                    stats['locks'] += 1
+
+            elif filename.startswith('.'):
+                if (filename.endswith(temp_suffix) and
+                        st.st_mtime < now - temp_age):
+                    if not dry_run:
+                        os.unlink(path)
+                    stats['temp'] += 1
+                    stats['freed'] += st.st_size
+
+            elif filename.endswith(optimized_marker_suffix):
+                if filename[:-len(optimized_marker_suffix)] not in filenames:
+                    if not dry_run:
+                        os.unlink(path)
+                    stats['markers'] += 1
+
+            elif variant_chain(chains, filename, formats) is None:
+                if remove_variant(path, dry_run=dry_run):
+                    stats['unregistered'] += 1
+                    stats['freed'] += st.st_size
+
+            else:
+                variants.append((max(st.st_atime, st.st_mtime), st.st_size,
+                                 path))
+
+    size = sum(variant[1] for variant in variants)
+    count = len(variants)
+    variants.sort()
+    for last_used, file_size, path in variants:
+        if not ((max_size is not None and size > max_size) or
+                (max_files is not None and count > max_files)):
+            break
+        if last_used > now - min_age:
+            # Everything from here on was used too recently.
+            break
+        if remove_variant(path, dry_run=dry_run):
+            size -= file_size
+            count -= 1
+            stats['evicted'] += 1
+            stats['freed'] += file_size
+
+    stats['files'] = count
+    stats['size'] = size
+    return stats
+
+
+def sweep_options(settings):
+    """
+    Return the keyword arguments for ``sweep()`` configured by
+    ``pyramid_frontend.image_gc_max_size`` and friends.
+    """
+    max_size = settings.get('pyramid_frontend.image_gc_max_size')
+    max_files = settings.get('pyramid_frontend.image_gc_max_files')
+    return dict(
+        max_size=parse_size(max_size),
+        max_files=int(max_files) if max_files not in (None, '') else None,
+        temp_age=int(settings.get('pyramid_frontend.image_gc_temp_age') or
+                     3600),
+        min_age=int(settings.get('pyramid_frontend.image_gc_min_age') or 60))
+
+
+class Sweeper(object):
+    """
+    A daemon thread which garbage collects the processed image directory
+    every ``interval`` seconds, using the filter chains registered in
+    ``registry`` and the limits configured in its settings.
+
+    When several processes run a sweeper, only one at a time does any work.
+    """
+
+    def __init__(self, registry, interval):
+        self.registry = registry
+        self.interval = interval
+        self.pid = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """
+        Start the thread if it isn't running in this process yet.
+        """
+        with self._lock:
+            # Threads don't survive a fork, so start a new one in a child.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._work)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _work(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep_once()
+            except Exception:
+                log.exception('Processed image garbage collection failed')
+
+    def sweep_once(self):
+        """
+        Run one sweep, unless another process is already sweeping. Returns
+        the counts from ``sweep()``, or None.
+        """
+        settings = self.registry.settings
+        lock = PathLock(os.path.join(
+            settings['pyramid_frontend.processed_image_dir'], '.gc'))
+        if not lock.acquire(blocking=False):
+            return None
+        try:
+            stats = sweep(settings, registered_chains(self.registry),
+                          formats=self.registry.image_negotiate_formats,
+                          **sweep_options(settings))
+        finally:
+            lock.release()
+        log.info('Processed image garbage collection: %r', stats)
+        return stats
+
+
+def sweeper_from_settings(registry):
+    """
+    Build a ``Sweeper`` as configured by
+    ``pyramid_frontend.image_gc_interval``, or return None if it's not set,
+    which is the default.
+    """
+    interval = int(registry.settings.get('pyramid_frontend.image_gc_interval')
+                   or 0)
+    if not interval:
+        return None
+    return Sweeper(registry, interval)
@@ -0,0 +1,198 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import logging
+import threading
+
+from multiprocessing import Pool
+
+from six import string_types, integer_types
+from six.moves import queue
+
+log = logging.getLogger(__name__)
+
+
+class Saturated(Exception):
+    """
+    Raised when an executor already has as many jobs outstanding as its queue
+    depth allows.
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        Exception.__init__(self, 'Image executor saturated')
+
+
+def picklable_settings(settings):
+    """
+    Return a copy of ``settings`` with only the plain values, suitable for
+    sending to another process. Things like the theme registry are dropped.
+    """
+    plain_types = string_types + integer_types + (bool, float, type(None))
+    return dict((key, value) for key, value in settings.items()
+                if isinstance(value, plain_types))
+
+
+# Set in each worker process by _init_worker().
+_worker_settings = None
+
+
+def _init_worker(settings):
+    # Imported here because the storage module is only needed in workers.
+    from .storage import get_storage
+
+    global _worker_settings
+    _worker_settings = settings
+    # Storage backends which are expensive to set up (e.g. S3 clients) are
+    # cached in the settings, so this keeps them for every job.
+    for kind in ('original', 'processed'):
+        get_storage(settings, kind)
+
+
+def _call_with_settings(func, args, kwargs):
+    return func(_worker_settings, *args, **kwargs)
+
+
+class ImageExecutor(object):
+    """
+    Runs functions (usually ``process_image``) in a bounded pool of worker
+    processes, so that CPU-heavy image processing doesn't tie up the web
+    worker threads.
+
+    At most ``queue_depth`` jobs may be outstanding (running or waiting for a
+    worker) at a time: past that, ``run()`` raises ``Saturated`` instead of
+    queueing more work.
+
+    If ``settings`` are given, each worker process keeps a copy of them, for
+    jobs started with ``run_with_settings()``.
+    """
+
+    def __init__(self, workers, queue_depth=None, retry_after=5,
+                 settings=None):
+        self.workers = workers
+        self.queue_depth = queue_depth or (workers * 4)
+        self.retry_after = retry_after
+        self.settings = None
+        if settings is not None:
+            self.settings = picklable_settings(settings)
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def __repr__(self):
+        return '<%s: %d workers, %d / %d pending>' % (
+            self.__class__.__name__, self.workers, self.pending,
+            self.queue_depth)
+
+    def _get_pool(self):
+        # The pool is created lazily, and re-created if we find ourselves in
+        # a forked child (e.g. a preloading app server), because the worker
+        # processes belong to the parent.
+        if self._pool is None or self._pid != os.getpid():
+            if self.settings is not None:
+                self._pool = Pool(self.workers, initializer=_init_worker,
+                                  initargs=(self.settings,))
+            else:
+                self._pool = Pool(self.workers)
+            self._pid = os.getpid()
+        return self._pool
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call ``func`` with the supplied arguments in a worker process, block
+        until it has finished, and return the result. Exceptions raised by
+        ``func`` are re-raised here.
+        """
+        with self._lock:
+            if self.pending >= self.queue_depth:
+                raise Saturated(self.retry_after)
+            self.pending += 1
+            pool = self._get_pool()
+        try:
+            return pool.apply_async(func, args, kwargs).get()
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def run_with_settings(self, func, *args, **kwargs):
+        """
+        Like ``run()``, but ``func`` is called with the worker process's copy
+        of the executor's settings as its first argument, so that whatever is
+        cached in them (like storage backends) is reused from job to job.
+        """
+        return self.run(_call_with_settings, func, args, kwargs)
+
+    def close(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
+
+
+class BackgroundWorker(object):
+    """
+    A daemon thread which runs fire-and-forget jobs, like lossless
+    optimization of images which have already been served, in the order they
+    were submitted.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                log.exception('Background job %r failed', func)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        self.queue.put((func, args, kwargs))
+
+    def wait(self):
+        """
+        Block until all submitted jobs have finished.
+        """
+        self.queue.join()
+
+
+_background_worker = None
+_background_lock = threading.Lock()
+
+
+def background_worker():
+    """
+    Return the background worker for this process, starting it if necessary.
+    """
+    global _background_worker
+    with _background_lock:
+        # Threads don't survive a fork, so start a new one in a child.
+        if (_background_worker is None or
+                _background_worker.pid != os.getpid()):
+            _background_worker = BackgroundWorker()
+        return _background_worker
+
+
+def executor_from_settings(settings):
+    """
+    Build an ``ImageExecutor`` as configured by
+    ``pyramid_frontend.image_workers`` and friends. Returns None if image
+    processing should happen inline, which is the default.
+    """
+    workers = int(settings.get('pyramid_frontend.image_workers') or 0)
+    if not workers:
+        return None
+    queue_depth = int(settings.get('pyramid_frontend.image_queue_depth') or 0)
+    retry_after = int(settings.get('pyramid_frontend.image_retry_after') or 5)
+    return ImageExecutor(workers,
+                         queue_depth=queue_depth,
+                         retry_after=retry_after,
+                         settings=settings)
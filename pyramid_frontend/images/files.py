@@ -3,15 +3,53 @@ from __future__ import absolute_import, print_function, division
 import os
 import shutil
 import hashlib
+import logging
 
 from datetime import datetime
 
 from PIL import Image
 
+from .storage import get_storage
+
+
+try:
+    from functools import lru_cache
+except ImportError:  # Python 2
+    lru_cache = None
+
+
+log = logging.getLogger(__name__)
+
 
 filter_sep = '_'
 
 
+def memoize(maxsize):
+    """
+    Decorator to cache the results of a function of hashable arguments,
+    holding at most ``maxsize`` of them.
+    """
+    if lru_cache:
+        return lru_cache(maxsize=maxsize)
+
+    def decorator(func):
+        cache = {}
+
+        def wrapper(*args):
+            try:
+                return cache[args]
+            except KeyError:
+                if len(cache) >= maxsize:
+                    cache.clear()
+                value = cache[args] = func(*args)
+                return value
+        wrapper.__doc__ = func.__doc__
+        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorator
+
+
+@memoize(maxsize=10000)
 def prefix_for_name(name):
     """
     Return the 4-char hash prefix to use for this image name (prevents having
@@ -25,10 +63,29 @@ def get_url_prefix(settings):
         rstrip('/')
 
 
-def save_image(settings, name, original_ext, f):
-    prefix = prefix_for_name(name)
-    ensure_dirs(settings, prefix)
-    save_locally(original_path(settings, name, original_ext), f)
+def save_image(settings, name, original_ext, f, registry=None):
+    """
+    Save an original image from the file-like object ``f``. Pass the
+    application's ``registry`` to forget that the image was missing;
+    without it, only entries shared through
+    ``pyramid_frontend.missing_image_cache_dir`` can be cleared.
+    """
+    # Imported here because the cache module depends on this one.
+    from .cache import missing_cache_from_settings
+    from .metadata import get_metadata_index
+
+    get_storage(settings, 'original').save(original_key(name, original_ext), f)
+
+    if registry is not None:
+        missing_cache = getattr(registry, 'image_missing_cache', None)
+    else:
+        missing_cache = missing_cache_from_settings(settings)
+    if missing_cache:
+        missing_cache.discard(name, original_ext)
+    # Whatever was indexed described the image this one replaced.
+    metadata_index = get_metadata_index(settings)
+    if metadata_index:
+        metadata_index.discard(name, original_ext)
 
 
 def save_locally(path, f):
@@ -63,13 +120,6 @@ def save_to_error_dir(settings, name, f):
     save_locally(filepath, f)
 
 
-def ensure_dirs(settings, prefix):
-    dirpath = os.path.join(settings['pyramid_frontend.original_image_dir'],
-                           prefix)
-    if not os.path.exists(dirpath):
-        os.makedirs(dirpath)
-
-
 def original_path(settings, name, original_ext):
     dir = settings['pyramid_frontend.original_image_dir']
     return os.path.join(dir,
@@ -77,6 +127,21 @@ def original_path(settings, name, original_ext):
                         '%s.%s' % (name, original_ext))
 
 
+def original_key(name, original_ext):
+    """
+    Return the storage key of an original image.
+    """
+    return '%s/%s.%s' % (prefix_for_name(name), name, original_ext)
+
+
+def processed_key(name, original_ext, chain):
+    """
+    Return the storage key of the variant of an image produced by ``chain``.
+    """
+    return '%s/%s' % (prefix_for_name(name),
+                      chain.basename(name, original_ext))
+
+
 def processed_path(settings, name, original_ext, chain):
     dir = settings['pyramid_frontend.processed_image_dir']
     return os.path.join(
@@ -85,20 +150,59 @@ def processed_path(settings, name, original_ext, chain):
         chain.basename(name, original_ext))
 
 
-def check_and_save_image(settings, name, f):
+def version_token(settings, name, original_ext, chain):
+    """
+    Return a short token which changes whenever the original image (as
+    detected by its modification time and size) or the configuration of
+    ``chain`` changes, or None if the original doesn't exist.
+    """
+    originals = get_storage(settings, 'original')
+    return stat_version_token(originals.stat(original_key(name, original_ext)),
+                              chain)
+
+
+def stat_version_token(st, chain):
     """
-    Save an image to the local ``pyramid_frontend`` image originals directory,
-    using the supplied base name and file-like object.
+    Return the version token for ``chain`` of an original image with the
+    modification time and size ``st``, or None if ``st`` is None.
+    """
+    if st is None:
+        return None
+    mtime, size = st
+    data = '%d:%d:%s:%s' % (int(mtime * 1000), size,
+                            chain.suffix, chain.fingerprint)
+    return hashlib.md5(data.encode('utf-8')).hexdigest()[:12]
+
+
+def check_and_save_image(settings, name, f, registry=None):
+    """
+    Save an image to the ``pyramid_frontend`` image originals storage, using
+    the supplied base name and file-like object.
 
     The extension is chosen and normalized based on file format, and returned.
     It will always be three characters.
 
     If the image is not valid (cannot be loaded as a PIL image), it is saved to
     the error directory, and the exception raised by PIL is re-raised.
+
+    The application's ``registry`` should be passed if it is available, as for
+    ``save_image()``, and to warm up ``all`` chains.
+
+    If ``pyramid_frontend.image_metadata_index`` is set, the format, mode,
+    dimensions and size in bytes of the image are indexed.
+
+    If ``pyramid_frontend.image_warmup`` is set, processing of variants of the
+    new image is queued in the background once it has been saved. Failing to
+    queue them is logged, but doesn't fail the upload.
     """
+    # Imported here because these modules depend on this one.
+    from .metadata import ImageInfo, get_metadata_index
+    from .warmup import warmup_image
+
     try:
         im = Image.open(f)
         format = im.format
+        mode = im.mode
         size = im.size
     except IOError:
         save_to_error_dir(settings, name, f)
@@ -111,6 +215,16 @@ def check_and_save_image(settings, name, f):
         'GIF': 'gif',
     }
     original_ext = possible_extensions[format]
-    save_image(settings, name, original_ext, f)
+    save_image(settings, name, original_ext, f, registry=registry)
+    metadata_index = get_metadata_index(settings)
+    if metadata_index:
+        f.seek(0, os.SEEK_END)
+        metadata_index.record(name, original_ext,
+                              ImageInfo(format, mode, size[0], size[1],
+                                        f.tell()))
     f.close()
+    try:
+        warmup_image(settings, name, original_ext, registry=registry)
+    except Exception:
+        log.exception('Failed to queue warmup of %s.%s', name, original_ext)
     return dict(ext=original_ext, size=size)
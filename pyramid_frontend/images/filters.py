@@ -3,14 +3,71 @@ from __future__ import absolute_import, print_function, division
 import shutil
 import tempfile
 import math
-from six import BytesIO
+from six import BytesIO, integer_types, string_types
 from six.moves import xrange
 
 from PIL import Image
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from .. import cmd
-from .utils import (pad_image, flatten_alpha, crop_entropy,
-                    is_white_background, is_larger, bounding_box, sharpen)
+from .cache import LRUCache
+from .utils import (pad_image, flatten_alpha, corner_color, crop_entropy_size,
+                    is_larger, is_larger_size, sharpen, thumbnail_size,
+                    resize)
+from .analysis import (crop_entropy, is_white_background, bounding_box,
+                       proxy_entropy_box, proxy_bounding_box)
+
+
+# Vignette masks by size and parameters, shared by every VignetteFilter.
+vignette_masks = LRUCache(16)
+
+
+def format_supported(format):
+    """
+    Return True if PIL can save images in ``format``, like ``'WEBP'``.
+    """
+    if format == 'AVIF':
+        try:
+            # Adds AVIF support to versions of Pillow which lack it.
+            import pillow_avif  # noqa
+        except ImportError:
+            pass
+    Image.init()
+    return format in Image.SAVE
+
+
+# Values whose repr() is the same in every process.
+stable_repr_types = (bool, float, bytes) + integer_types + string_types
+
+
+def stable_repr(value):
+    """
+    Like ``repr()``, but the same from run to run regardless of the ordering
+    of dicts and sets. Raises TypeError for values whose ``repr()`` may not be
+    (e.g. because it includes a memory address): filters with parameters like
+    that must override ``fingerprint_data()``.
+    """
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted('%s: %s' % (stable_repr(k),
+                                                     stable_repr(v))
+                                         for k, v in value.items()))
+    elif isinstance(value, (set, frozenset)):
+        return '{%s}' % ', '.join(sorted(stable_repr(v) for v in value))
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(stable_repr(v) for v in value)
+    elif isinstance(value, Filter):
+        return value.fingerprint_data()
+    elif hasattr(value, '__name__'):
+        # Functions and classes: the default repr includes the address.
+        return '%s.%s' % (getattr(value, '__module__', ''), value.__name__)
+    elif value is None or isinstance(value, stable_repr_types):
+        return repr(value)
+    raise TypeError('no stable repr for %r: override fingerprint_data()' %
+                    value)
 
 
 class Filter(object):
@@ -21,7 +78,35 @@ class Filter(object):
     Filter instances are called on input data and return output data. Filters
     can take an arbitrary input and output, but by convention will tend to pass
     either PIL images or file-like objects.
+
+    Filters with ``deferrable`` set only perform lossless optimization, and
+    can be run after the chain's output has already been saved and served.
+
+    Filters with ``preserves_size`` set output images (or image data) of the
+    same size as their input, so that the size of a chain's output can be
+    known without running it.
     """
+    deferrable = False
+    preserves_size = False
+
+    def fingerprint_data(self):
+        """
+        Return a string which describes this filter's class and parameters, so
+        that any change in configuration changes the fingerprint of chains
+        which use it.
+        """
+        return '%s(%s)' % (self.__class__.__name__, stable_repr(vars(self)))
+
+    def output_size(self, size):
+        """
+        Return the ``(width, height)`` of this filter's output for an input
+        image of ``size``, or None if that isn't known, as for filters which
+        don't set ``preserves_size``. Filters which change the size of images
+        in a predictable way should override this.
+        """
+        if self.preserves_size:
+            return size
+        return None
 
     def adapt_input(self, input):
         """
@@ -77,10 +162,28 @@ class ThumbFilter(Filter):
     """
     A filter that resizes to a given size, using various mechanisms for
     changing size.
+
+    With ``decode='fast'``, JPEG originals are decoded at a reduced scale (the
+    smallest which is at least ``reducing_gap`` times the output size), and
+    then resized in two steps, which is much faster and uses much less memory
+    for large originals, at a slight cost in quality. The default,
+    ``'quality'``, decodes originals in full.
+
+    With ``proxy_size`` set, where to crop large images is decided by
+    analyzing a copy reduced to about ``proxy_size`` pixels on its long edge,
+    so that the image itself is only cropped and resized once. The copy is
+    kept large enough that the crop is within about ``proxy_tolerance``
+    pixels of the output of where it would otherwise be.
     """
+    decode = 'quality'
+    reducing_gap = 2.0
+    proxy_size = None
+    proxy_tolerance = 1.0
+
     def __init__(self, dimensions, pad=False, crop=False,
                  crop_whitespace=False, crop_whitespace_pad=0,
-                 background='white', enlarge=False):
+                 background='white', enlarge=False, decode='quality',
+                 proxy_size=None, proxy_tolerance=1.0):
 
         self.dimensions = dimensions
         self.pad = pad
@@ -89,12 +192,120 @@ class ThumbFilter(Filter):
         self.crop_whitespace_pad = crop_whitespace_pad
         self.background = background
         self.enlarge = enlarge
+        assert decode in ('quality', 'fast'), \
+            "decode must be 'quality' or 'fast'"
+        # Only set when it isn't the default, so that the fingerprints of
+        # existing chains don't change.
+        if decode != 'quality':
+            self.decode = decode
+        if proxy_size:
+            assert proxy_tolerance > 0, "proxy_tolerance must be positive"
+            self.proxy_size = proxy_size
+            if proxy_tolerance != 1.0:
+                self.proxy_tolerance = proxy_tolerance
+
+    def proxy_factor(self, size, cover):
+        """
+        Return the factor by which an image of ``size`` may be reduced to
+        decide where to crop it, or None if it should be analyzed in full.
+        ``cover`` is True if the image will be scaled to cover the dimensions
+        rather than fit within them.
+        """
+        if not self.proxy_size:
+            return None
+        # How many pixels of the image make up each pixel of the output.
+        scales = [n / d for n, d in zip(size, self.dimensions) if d]
+        if not scales:
+            return None
+        scale = min(scales) if cover else max(scales)
+        factor = int(min(max(size) / self.proxy_size,
+                         scale * self.proxy_tolerance))
+        if factor < 2:
+            return None
+        return factor
+
+    def proxy(self, im, cover):
+        """
+        Return a reduced copy of ``im`` to decide where to crop it with, or
+        None if it should be analyzed in full. Palette and bilevel images
+        can't be reduced, so they're always analyzed in full.
+        """
+        if im.mode in ('1', 'P'):
+            return None
+        factor = self.proxy_factor(im.size, cover)
+        if factor is None:
+            return None
+        if hasattr(im, 'reduce'):
+            return im.reduce(factor)
+        w, h = im.size
+        return im.resize((max(1, w // factor), max(1, h // factor)),
+                         Image.BOX)
+
+    def draft_size(self, size):
+        """
+        Return the smallest size at which an original image of ``size`` may
+        be decoded, or None if it must be decoded in full.
+        """
+        if self.decode != 'fast' or self.enlarge:
+            return None
+        output_size = self.output_size(size)
+        if output_size is None:
+            return None
+        return tuple(int(math.ceil(n * self.reducing_gap))
+                     for n in output_size)
+
+    def draft(self, im):
+        """
+        Configure a JPEG image which hasn't been loaded yet to be decoded at
+        the reduced scale given by ``draft_size()``. Returns the reduced size,
+        or None if it won't be reduced.
+        """
+        size = im.size
+        draft_size = self.draft_size(size)
+        if draft_size is None or im.format != 'JPEG':
+            return None
+        if im.draft(im.mode, draft_size) is None or im.size == size:
+            return None
+        return im.size
+
+    def output_size(self, size):
+        # This follows the same steps as filter(), below.
+        dimensions = self.dimensions
+        desired_w, desired_h = dimensions
+        if ((self.crop == 'nonwhite' or self.crop_whitespace) and
+                is_larger_size(size, dimensions)):
+            return None
+
+        if self.crop is True and is_larger_size(size, dimensions):
+            size = crop_entropy_size(size, dimensions)
+
+        w, h = size
+        if self.enlarge:
+            factor = max(float(desired_w) / w, float(desired_h) / h)
+            w, h = (int(math.ceil(w * factor)), int(math.ceil(h * factor)))
+
+        aspect = float(w) / float(h)
+        if (not desired_w) and (not desired_h):
+            desired_w, desired_h = w, h
+        elif not desired_w:
+            desired_w = aspect * desired_h
+        elif not desired_h:
+            desired_h = desired_w / aspect
+
+        w, h = thumbnail_size((w, h), (desired_w, desired_h))
+        if self.pad:
+            w = max(w, dimensions[0])
+            h = max(h, dimensions[1])
+        return w, h
 
     def filter(self, im):
         def _pad_dim(src, dst, flag):
             assert isinstance(flag, bool)
             return (dst if flag else src)
 
+        size = im.size
+        drafted_size = self.draft(im)
+
         im = flatten_alpha(im, self.background)
 
         if self.crop is True:
@@ -104,22 +315,34 @@ class ThumbFilter(Filter):
         else:
             should_entropy_crop = False
 
-        bgcolor = im.convert('RGBA').getpixel((0, 0))
+        bgcolor = corner_color(im)
 
         # FIXME The cropping behavior is not really correct here for dimensions
         # that are partially unspecified.
         if should_entropy_crop and is_larger(im, self.dimensions):
-            im = crop_entropy(im, self.dimensions)
+            proxy = self.proxy(im, cover=True)
+            if proxy is None:
+                im = crop_entropy(im, self.dimensions)
+            else:
+                box = proxy_entropy_box(proxy, im.size, self.dimensions)
+                im = resize(im, self.dimensions, self.reducing_gap, box=box)
 
         if self.crop_whitespace and is_larger(im, self.dimensions):
             has_white_background = is_white_background(im, tolerance=0)
-            im = im.crop(bounding_box(im))
+            proxy = self.proxy(im, cover=False)
+            if proxy is None:
+                im = im.crop(bounding_box(im))
+            else:
+                im = im.crop(proxy_bounding_box(proxy, im.size))
             if has_white_background:
                 xpad = int(self.crop_whitespace_pad * im.size[0])
                 ypad = int(self.crop_whitespace_pad * im.size[1])
                 pad_dims = (im.size[0] + (2 * xpad),
                             im.size[1] + (2 * ypad))
-                im = pad_image(im, pad_dims)
+                # Padding also converts to RGB, so it's only a no-op copy
+                # for RGB images.
+                if pad_dims != im.size or im.mode != 'RGB':
+                    im = pad_image(im, pad_dims)
 
         # FIXME The enlarge flag should only have any effect if the image
         # actually needs to be enlarged.
@@ -131,6 +354,11 @@ class ThumbFilter(Filter):
                            Image.BICUBIC)
 
         w, h = im.size
+        if drafted_size and im.size == drafted_size:
+            # Nothing has been cropped since the original was decoded at a
+            # reduced scale, so size the output as if it had been decoded in
+            # full.
+            w, h = size
         aspect = float(w) / float(h)
         desired_w, desired_h = self.dimensions
         if (not desired_w) and (not desired_h):
@@ -140,7 +368,12 @@ class ThumbFilter(Filter):
         elif not desired_h:
             desired_h = desired_w / aspect
 
-        im.thumbnail((desired_w, desired_h), Image.ANTIALIAS)
+        if self.decode == 'fast':
+            target = thumbnail_size((w, h), (desired_w, desired_h))
+            if im.size != target:
+                im = resize(im, target, self.reducing_gap)
+        else:
+            im.thumbnail((desired_w, desired_h), Image.ANTIALIAS)
         if self.pad:
             w = _pad_dim(im.size[0], self.dimensions[0], self.pad)
             h = _pad_dim(im.size[1], self.dimensions[1], self.pad)
@@ -152,12 +385,31 @@ class VignetteFilter(Filter):
     """
     A filter which vignettes corners a bit, to make a white background image
     stand out a bit against a white page background.
+
+    The mask for each output size is cached, and computed with NumPy if it's
+    installed.
     """
+    preserves_size = True
+
     def __init__(self, falloff=4, extent=40):
         self.falloff = falloff
         self.extent = extent
 
-    def filter(self, im):
+    def mask(self, size):
+        """
+        Return the alpha mask used to darken an image of ``size``.
+        """
+        key = (size, self.falloff, self.extent)
+        mask = vignette_masks.get(key)
+        if mask is None:
+            if numpy is not None:
+                mask = self.compute_mask_numpy(size)
+            else:
+                mask = self.compute_mask(size)
+            vignette_masks.set(key, mask)
+        return mask
+
+    def compute_mask(self, size):
         falloff = self.falloff
         extent = self.extent
 
@@ -171,9 +423,7 @@ class VignetteFilter(Filter):
         def light_falloff(radius, outside):
             return ((radius / outside) ** falloff) * extent
 
-        im = im.convert('RGBA')
-
-        w, h = im.size
+        w, h = size
         center = w / 2, h / 2
         outside = length(center, (0, 0))
 
@@ -184,10 +434,27 @@ class VignetteFilter(Filter):
                 factor = light_falloff(radius, outside)
                 data.append(factor)
 
-        alpha_im = Image.new('L', im.size)
+        alpha_im = Image.new('L', size)
         alpha_im.putdata(data)
+        return alpha_im
+
+    def compute_mask_numpy(self, size):
+        # The same arithmetic as compute_mask(), a row and column at a time.
+        w, h = size
+        center_x, center_y = w / 2, h / 2
+        outside = math.sqrt((center_x ** 2) + (center_y ** 2))
+        dist_x = (numpy.arange(w, dtype=numpy.float64) - center_x) ** 2
+        dist_y = (numpy.arange(h, dtype=numpy.float64) - center_y) ** 2
+        radius = numpy.sqrt(dist_y[:, numpy.newaxis] + dist_x)
+        factor = ((radius / outside) ** self.falloff) * self.extent
+        # Truncated and clipped like Image.putdata().
+        data = numpy.clip(factor, 0, 255).astype(numpy.uint8)
+        return Image.frombytes('L', size, data.tobytes())
+
+    def filter(self, im):
+        im = im.convert('RGBA')
         overlay_im = Image.new('L', im.size, 'black')
-        return Image.composite(overlay_im, im, alpha_im)
+        return Image.composite(overlay_im, im, self.mask(im.size))
 
 
 class CMYKFilter(Filter):
@@ -195,6 +462,7 @@ class CMYKFilter(Filter):
     Convert a file-like object to RGB colorspace using ImageMagick. This should
     be quite robust to weird things like CMYK TIFFs.
     """
+    preserves_size = True
 
     def __call__(self, input):
         return self.shell_process(input, ['convert', 'IN',
@@ -207,6 +475,8 @@ class JPGSaver(Filter):
     A JPG saver. Accepts keyword arguments, which will be passed to PIL's
     ``save()`` method. Calls jpegoptim on output.
     """
+    preserves_size = True
+
     def __init__(self, sharpness=None, **kwargs):
         self.sharpness = sharpness
         self.kwargs = kwargs
@@ -214,7 +484,9 @@ class JPGSaver(Filter):
     def filter(self, im):
         if self.sharpness:
             im = sharpen(im, self.sharpness)
-        if im.mode.endswith("A"):
+        if im.mode == "RGBA":
+            im = flatten_alpha(im)
+        elif im.mode.endswith("A"):
             ni = Image.new("RGB", im.size, 'white')
             ni.paste(im, im)
             im = ni
@@ -231,6 +503,9 @@ class JPGProcessor(Filter):
     Postprocess a JPEG. For now, just uses jpegoptim to do some additional
     lossless slimming.
     """
+    deferrable = True
+    preserves_size = True
+
     def __call__(self, input):
         return self.shell_process(input,
                                   ['jpegoptim', '--strip-all', 'IN'],
@@ -242,6 +517,8 @@ class PNGSaver(Filter):
     Save a file as a 24-bit PNG and return the file-like object
     with PNG data.
     """
+    preserves_size = True
+
     def __init__(self, palette=False, colors=256, sharpness=None,
                  background='white'):
         self.palette = palette
@@ -279,11 +556,72 @@ class PNGSaver(Filter):
         return buf
 
 
+class WebPSaver(Filter):
+    """
+    A WebP saver. ``quality`` ranges from 0 to 100, and ``method`` from 0
+    (fastest) to 6 (smallest). Other keyword arguments are passed to PIL's
+    ``save()`` method. Transparency is preserved.
+    """
+    format = 'WEBP'
+    preserves_size = True
+
+    def __init__(self, quality=80, method=4, lossless=False, sharpness=None,
+                 **kwargs):
+        self.quality = quality
+        self.method = method
+        self.lossless = lossless
+        self.sharpness = sharpness
+        self.kwargs = kwargs
+
+    def convert(self, im):
+        if self.sharpness:
+            im = sharpen(im, self.sharpness)
+        if im.mode in ('RGB', 'RGBA'):
+            return im
+        if (im.mode in ('LA', 'PA') or
+                (im.mode == 'P' and 'transparency' in im.info)):
+            return im.convert('RGBA')
+        return im.convert('RGB')
+
+    def filter(self, im):
+        im = self.convert(im)
+        buf = BytesIO()
+        im.save(buf, self.format, quality=self.quality, method=self.method,
+                lossless=self.lossless, **self.kwargs)
+        buf.seek(0)
+        return buf
+
+
+class AVIFSaver(WebPSaver):
+    """
+    An AVIF saver, for versions of Pillow which support AVIF (natively, or
+    with the ``pillow-avif-plugin`` package). ``quality`` ranges from 0 to
+    100, and ``speed`` from 0 (smallest) to 10 (fastest). Other keyword
+    arguments are passed to PIL's ``save()`` method.
+    """
+    format = 'AVIF'
+
+    def __init__(self, quality=60, speed=6, sharpness=None, **kwargs):
+        super(AVIFSaver, self).__init__(quality=quality, sharpness=sharpness,
+                                        **kwargs)
+        self.speed = speed
+
+    def filter(self, im):
+        im = self.convert(im)
+        buf = BytesIO()
+        im.save(buf, self.format, quality=self.quality, speed=self.speed,
+                **self.kwargs)
+        buf.seek(0)
+        return buf
+
+
 class PNGProcessor(Filter):
     """
     Postprocess a PNG. For now, just uses pngcrush and optipng to do some
     additional lossless slimming.
     """
+    deferrable = True
+    preserves_size = True
 
     def __call__(self, input):
         input = self.shell_process(input, ['pngcrush', 'IN', 'OUT'])
@@ -0,0 +1,121 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import errno
+import fcntl
+import threading
+
+
+lock_suffix = '.lock'
+
+
+# Maps a locked path to a [lock, refcount] pair, shared by all of the threads
+# in this process which are holding or waiting for that path.
+_thread_locks = {}
+_thread_locks_mutex = threading.Lock()
+
+
+class PathLock(object):
+    """
+    An exclusive lock on a path, used to ensure that a processed image is only
+    generated once even when many threads and processes want it at the same
+    time.
+
+    Threads in the same process wait on an in-process lock for the path, so
+    only one of them at a time touches the filesystem. Between processes,
+    ``flock()`` is used on a lock file alongside the path: the kernel wakes
+    waiters as soon as the lock is released, and releases it automatically if
+    the holder dies, so a crashed worker can't leave a stale lock behind. The
+    lock file is removed on release.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + lock_suffix
+        self._entry = None
+        self._fd = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.path)
+
+    def _acquire_thread_lock(self, blocking):
+        with _thread_locks_mutex:
+            entry = _thread_locks.get(self.path)
+            if entry is None:
+                entry = _thread_locks[self.path] = [threading.Lock(), 0]
+            entry[1] += 1
+        if entry[0].acquire(blocking):
+            self._entry = entry
+            return True
+        self._release_thread_lock(entry, locked=False)
+        return False
+
+    def _release_thread_lock(self, entry, locked=True):
+        if locked:
+            entry[0].release()
+        with _thread_locks_mutex:
+            entry[1] -= 1
+            if not entry[1]:
+                del _thread_locks[self.path]
+
+    def _acquire_flock(self, blocking):
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, flags)
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            # The previous holder removes the lock file when releasing it. If
+            # that happened after we opened it, we've locked an orphaned file
+            # and need to try again.
+            try:
+                current = os.stat(self.lock_path)
+            except OSError:
+                current = None
+            if current and os.path.samestat(current, os.fstat(fd)):
+                self._fd = fd
+                return True
+            os.close(fd)
+
+    def acquire(self, blocking=True):
+        """
+        Acquire the lock, waiting for it if ``blocking`` is set. Returns True
+        if the lock was acquired.
+        """
+        if not self._acquire_thread_lock(blocking):
+            return False
+        try:
+            if self._acquire_flock(blocking):
+                return True
+        except BaseException:
+            self._release_thread_lock(self._entry)
+            self._entry = None
+            raise
+        self._release_thread_lock(self._entry)
+        self._entry = None
+        return False
+
+    def release(self):
+        # Remove the lock file while we still hold the lock, so anyone who
+        # opened it in the meantime knows to start over.
+        try:
+            os.unlink(self.lock_path)
+        except OSError:
+            pass
+        os.close(self._fd)
+        self._fd = None
+        self._release_thread_lock(self._entry)
+        self._entry = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
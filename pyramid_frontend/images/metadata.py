@@ -0,0 +1,134 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import sqlite3
+import threading
+
+from collections import namedtuple
+
+
+ImageInfo = namedtuple('ImageInfo', 'format mode width height size')
+
+
+class MetadataIndex(object):
+    """
+    An index of the format, mode, dimensions and size in bytes of original
+    images, kept in a SQLite database at ``path`` so that it's shared by every
+    process which uses it.
+
+    Each thread (and process) gets its own connection.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._create_lock = threading.Lock()
+        self._created = False
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        dirpath = os.path.dirname(self.path)
+        if dirpath and not os.path.exists(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                pass
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None)
+        with self._create_lock:
+            if not self._created:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS originals ('
+                             'name TEXT NOT NULL, '
+                             'ext TEXT NOT NULL, '
+                             'format TEXT, '
+                             'mode TEXT, '
+                             'width INTEGER, '
+                             'height INTEGER, '
+                             'size INTEGER, '
+                             'PRIMARY KEY (name, ext))')
+                self._created = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def record(self, name, original_ext, info):
+        """
+        Store the ``ImageInfo`` of an original image.
+        """
+        self._connection().execute(
+            'INSERT OR REPLACE INTO originals '
+            '(name, ext, format, mode, width, height, size) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (name, original_ext) + tuple(info))
+
+    def get(self, name, original_ext):
+        """
+        Return the ``ImageInfo`` of an original image, or None if it isn't
+        indexed.
+        """
+        row = self._connection().execute(
+            'SELECT format, mode, width, height, size FROM originals '
+            'WHERE name = ? AND ext = ?', (name, original_ext)).fetchone()
+        return ImageInfo(*row) if row else None
+
+    def get_many(self, keys):
+        """
+        Return a dict of the ``ImageInfo`` of each ``(name, original_ext)``
+        in ``keys`` which is indexed, in as few queries as possible.
+        """
+        keys = list(keys)
+        found = {}
+        conn = self._connection()
+        # Stay well under SQLite's limit on the number of query parameters.
+        for start in range(0, len(keys), 400):
+            batch = keys[start:start + 400]
+            clause = ' OR '.join(['(name = ? AND ext = ?)'] * len(batch))
+            params = [value for key in batch for value in key]
+            for row in conn.execute(
+                    'SELECT name, ext, format, mode, width, height, size '
+                    'FROM originals WHERE ' + clause, params):
+                found[tuple(row[:2])] = ImageInfo(*row[2:])
+        return found
+
+    def discard(self, name, original_ext):
+        self._connection().execute(
+            'DELETE FROM originals WHERE name = ? AND ext = ?',
+            (name, original_ext))
+
+
+def get_metadata_index(settings):
+    """
+    Return the ``MetadataIndex`` configured by
+    ``pyramid_frontend.image_metadata_index``, or None if original image
+    metadata should not be indexed, which is the default.
+    """
+    path = settings.get('pyramid_frontend.image_metadata_index')
+    if not path:
+        return None
+    index = settings.get('pyramid_frontend.image_metadata_index_instance')
+    if index is None:
+        index = \
+            settings['pyramid_frontend.image_metadata_index_instance'] = \
+            MetadataIndex(path)
+    return index
+
+
+def image_dimensions(settings, name, original_ext, chain):
+    """
+    Return the ``(width, height)`` of the variant of an original image
+    produced by ``chain``, computed from the indexed metadata without opening
+    any image, or None if the original isn't indexed or the chain's output
+    size depends on the image contents.
+    """
+    index = get_metadata_index(settings)
+    if index is None:
+        return None
+    info = index.get(name, original_ext)
+    if info is None:
+        return None
+    return chain.output_size((info.width, info.height))
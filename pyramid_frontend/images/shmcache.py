@@ -0,0 +1,242 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import time
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+
+from contextlib import contextmanager
+
+
+# Header: magic, number of sets, ways per set, slot size, then the hits,
+# misses, evictions and access clock counters.
+header_struct = struct.Struct('<4sIII4Q')
+header_size = 64
+magic = b'PFE1'
+
+# Entry: key digest, mtime of the file, length of the data, last access clock
+# value, and the time the mtime was last checked against the file.
+entry_struct = struct.Struct('<16sdQQd')
+checked_struct = struct.Struct('<d')
+checked_offset = entry_struct.size - checked_struct.size
+
+empty_key = b'\0' * 16
+
+HITS, MISSES, EVICTIONS, CLOCK = range(4)
+
+
+class SharedImageCache(object):
+    """
+    A size-bounded LRU cache of processed image data, kept in a memory-mapped
+    file so that it's shared by every process on the machine which opens the
+    same path (for example, all of the workers of an app server).
+
+    The cache is divided into fixed-size slots, so images larger than
+    ``max_item`` bytes are never cached. Slots are grouped into sets of
+    ``ways`` slots, and an image can only be stored in one set (chosen by a
+    hash of its path), where it replaces the least recently used image.
+
+    Each entry records the modification time of the file it was read from,
+    which is checked against the file at most once every ``revalidate``
+    seconds, so that most hits don't touch the filesystem.
+    """
+    ways = 8
+
+    def __init__(self, path, size=64 * 1024 * 1024, max_item=256 * 1024,
+                 revalidate=5):
+        self.path = path
+        self.slot_size = max_item
+        self.revalidate = revalidate
+        self.num_sets = max(1, size // (max_item * self.ways))
+        self.num_slots = self.num_sets * self.ways
+        self.entries_offset = header_size
+        self.data_offset = self.entries_offset + (self.num_slots *
+                                                  entry_struct.size)
+        self.total_size = self.data_offset + (self.num_slots * self.slot_size)
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._mm = None
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.path)
+
+    def _open(self):
+        # flock() doesn't exclude processes which share an open file
+        # description, so every process (e.g. after a fork) needs to open the
+        # file itself.
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            expected = header_struct.pack(magic, self.num_sets, self.ways,
+                                          self.slot_size, 0, 0, 0, 0)[:16]
+            current = os.read(fd, 16)
+            if (current != expected or
+                    os.fstat(fd).st_size != self.total_size):
+                # New file, or created with a different configuration.
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.total_size)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, expected)
+            self._mm = mmap.mmap(fd, self.total_size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._pid = os.getpid()
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _counter(self, index):
+        offset = 16 + (index * 8)
+        return struct.unpack_from('<Q', self._mm, offset)[0]
+
+    def _incr(self, index):
+        value = self._counter(index) + 1
+        struct.pack_into('<Q', self._mm, 16 + (index * 8), value)
+        return value
+
+    def _entry_offset(self, slot):
+        return self.entries_offset + (slot * entry_struct.size)
+
+    def _read_entry(self, slot):
+        return entry_struct.unpack_from(self._mm, self._entry_offset(slot))
+
+    def _write_entry(self, slot, *values):
+        entry_struct.pack_into(self._mm, self._entry_offset(slot), *values)
+
+    def _write_checked(self, slot, checked):
+        checked_struct.pack_into(self._mm,
+                                 self._entry_offset(slot) + checked_offset,
+                                 checked)
+
+    def _set_slots(self, digest):
+        first = (struct.unpack('<Q', digest[:8])[0] % self.num_sets) * \
+            self.ways
+        return range(first, first + self.ways)
+
+    def _find(self, digest):
+        for slot in self._set_slots(digest):
+            if self._read_entry(slot)[0] == digest:
+                return slot
+        return None
+
+    def _data(self, slot, length):
+        offset = self.data_offset + (slot * self.slot_size)
+        return self._mm[offset:offset + length]
+
+    def get(self, path, min_mtime=None):
+        """
+        Return the cached contents of the file at ``path``, or None. If
+        ``min_mtime`` is given, contents cached from a file modified before
+        then are ignored.
+        """
+        digest = hashlib.md5(path.encode('utf-8')).digest()
+        now = time.time()
+        with self._locked():
+            slot = self._find(digest)
+            if slot is None:
+                self._incr(MISSES)
+                return None
+            key, mtime, length, used, checked = self._read_entry(slot)
+            if min_mtime is not None and mtime < min_mtime:
+                self._incr(MISSES)
+                return None
+            data = self._data(slot, length)
+            self._write_entry(slot, key, mtime, length, self._incr(CLOCK),
+                              checked)
+            if now - checked < self.revalidate:
+                self._incr(HITS)
+                return data
+
+        try:
+            current_mtime = os.stat(path).st_mtime
+        except OSError:
+            current_mtime = None
+
+        with self._locked():
+            if self._read_entry(slot)[:3] != (digest, mtime, length):
+                # Replaced or updated while we were checking, so the data we
+                # read is out of date, and the new entry is left alone.
+                self._incr(MISSES)
+                return None
+            if current_mtime != mtime:
+                self._write_entry(slot, empty_key, 0, 0, 0, 0)
+                self._incr(MISSES)
+                return None
+            # Only the checked time changes, so a concurrent put() of the same
+            # entry isn't clobbered.
+            self._write_checked(slot, now)
+            self._incr(HITS)
+            return data
+
+    def put(self, path, data, mtime):
+        """
+        Store ``data``, the contents of the file at ``path`` as of
+        modification time ``mtime``. Returns False if it is too large to
+        cache.
+        """
+        if len(data) > self.slot_size:
+            return False
+        digest = hashlib.md5(path.encode('utf-8')).digest()
+        with self._locked():
+            slot = self._find(digest)
+            if slot is None:
+                # Take an empty slot in this set if there is one, otherwise
+                # the least recently used.
+                entries = [(self._read_entry(slot), slot)
+                           for slot in self._set_slots(digest)]
+                empty = [slot for entry, slot in entries
+                         if entry[0] == empty_key]
+                if empty:
+                    slot = empty[0]
+                else:
+                    slot = min(entries, key=lambda pair: pair[0][3])[1]
+                    self._incr(EVICTIONS)
+            offset = self.data_offset + (slot * self.slot_size)
+            self._mm[offset:offset + len(data)] = data
+            self._write_entry(slot, digest, mtime, len(data),
+                              self._incr(CLOCK), time.time())
+        return True
+
+    def stats(self):
+        """
+        Return the hit, miss and eviction counts, and the number of entries,
+        for all processes sharing the cache.
+        """
+        with self._locked():
+            entries = sum(1 for slot in range(self.num_slots)
+                          if self._read_entry(slot)[0] != empty_key)
+            return dict(hits=self._counter(HITS),
+                        misses=self._counter(MISSES),
+                        evictions=self._counter(EVICTIONS),
+                        entries=entries)
+
+
+def shared_cache_from_settings(settings):
+    """
+    Build a ``SharedImageCache`` as configured by
+    ``pyramid_frontend.image_shm_cache`` and friends, or return None if it's
+    not enabled, which is the default.
+    """
+    path = settings.get('pyramid_frontend.image_shm_cache')
+    if not path:
+        return None
+    kwargs = {}
+    for key in ('size', 'max_item', 'revalidate'):
+        value = settings.get('pyramid_frontend.image_shm_cache_%s' % key)
+        if value not in (None, ''):
+            kwargs[key] = int(value)
+    return SharedImageCache(path, **kwargs)
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, print_function, division
+
+import hmac
+import base64
+import hashlib
+
+from pyramid.settings import aslist
+
+
+def signing_keys(settings):
+    """
+    Return the keys configured by ``pyramid_frontend.image_signing_keys``.
+    The first is used to sign URLs, and all of them are accepted, so that
+    URLs signed with a previous key keep working while it's being retired.
+    """
+    return [key.encode('utf-8') for key in
+            aslist(settings.get('pyramid_frontend.image_signing_keys') or '')]
+
+
+def sign(key, basename):
+    """
+    Return the signature of a processed image basename, which identifies the
+    original name and extension and the filter chain, with ``key``.
+    """
+    digest = hmac.new(key, basename.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:12]).decode('ascii')
+
+
+def signer(key):
+    """
+    Return a function which signs basenames like ``sign()`` with ``key``,
+    but without setting up the key for each one.
+    """
+    keyed = hmac.new(key, digestmod=hashlib.sha256)
+
+    def sign_basename(basename):
+        mac = keyed.copy()
+        mac.update(basename.encode('utf-8'))
+        return base64.urlsafe_b64encode(mac.digest()[:12]).decode('ascii')
+    return sign_basename
+
+
+def url_signature(settings, basename):
+    """
+    Return the signature to add to the URL of a processed image, or None if
+    URLs aren't signed.
+    """
+    keys = signing_keys(settings)
+    if not keys:
+        return None
+    return sign(keys[0], basename)
+
+
+def check_signature(settings, basename, signature):
+    """
+    Return True if ``signature`` is valid for ``basename`` with any of the
+    configured keys, or if URLs aren't signed.
+    """
+    keys = signing_keys(settings)
+    if not keys:
+        return True
+    if not signature:
+        return False
+    signature = signature.encode('ascii', 'replace')
+    return any(hmac.compare_digest(sign(key, basename).encode('ascii'),
+                                   signature)
+               for key in keys)
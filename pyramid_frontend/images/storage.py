@@ -0,0 +1,247 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import stat
+import errno
+import shutil
+import binascii
+import calendar
+import tempfile
+import mimetypes
+
+from pyramid.path import DottedNameResolver
+from pyramid.settings import asbool
+
+
+def create_temp(dest_dir, basename):
+    """
+    Create a new temporary file for ``basename`` in ``dest_dir``, and return
+    an open file descriptor for writing to it and its path.
+
+    Unlike ``tempfile.mkstemp()``, which only makes files readable by their
+    owner, this creates the file with the permissions allowed by the umask,
+    like ``open()``.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        token = binascii.hexlify(os.urandom(6)).decode('ascii')
+        temp_path = os.path.join(dest_dir, '.%s.%s.tmp' % (basename, token))
+        try:
+            return os.open(temp_path, flags, 0o666), temp_path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def atomic_write(dest_path, f, fsync=False):
+    """
+    Write the contents of file-like object ``f`` to ``dest_path`` by way of a
+    temporary file in the same directory, which is then renamed into place, so
+    that readers never see a partially written file.
+
+    If ``fsync`` is set, the file and its directory are flushed to disk before
+    returning, so that the new file survives a crash.
+    """
+    dest_dir, basename = os.path.split(dest_path)
+    fd, temp_path = create_temp(dest_dir, basename)
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            shutil.copyfileobj(f, temp)
+            if fsync:
+                temp.flush()
+                os.fsync(temp.fileno())
+        # Make this writable by the group, but not by everyone.
+        bits = os.stat(temp_path).st_mode
+        os.chmod(temp_path, bits | stat.S_IWGRP)
+        # Atomically replaces any existing file on POSIX systems.
+        os.rename(temp_path, dest_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    if fsync:
+        dir_fd = os.open(dest_dir or os.curdir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class LocalStorage(object):
+    """
+    Stores images as files in a directory on the local filesystem. Keys are
+    slash-separated paths relative to that directory.
+    """
+    local = True
+
+    def __init__(self, root, fsync=False):
+        self.root = root
+        self.fsync = fsync
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.root)
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def stat(self, key):
+        """
+        Return the modification time and size of the stored object, or None
+        if it doesn't exist.
+        """
+        try:
+            st = os.stat(self.path(key))
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    open_stream = open
+
+    def save(self, key, f):
+        path = self.path(key)
+        dirpath = os.path.dirname(path)
+        if not os.path.exists(dirpath):
+            try:
+                os.makedirs(dirpath)
+            except OSError:
+                pass
+        f.seek(0)
+        atomic_write(path, f, fsync=self.fsync)
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError:
+            pass
+
+
+class S3Storage(object):
+    """
+    Stores images in an S3-compatible object store, so that they can be
+    shared by every machine serving the application. Requires ``boto3``.
+
+    Keys are prefixed with ``prefix``. If ``endpoint_url`` is given, it's used
+    instead of AWS, for other S3-compatible stores. Any other keyword
+    arguments are passed on to ``boto3.client()``.
+    """
+    local = False
+
+    # Objects smaller than this are buffered in memory when read, larger ones
+    # are spooled to a temporary file.
+    spool_size = 4 * 1024 * 1024
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, client=None,
+                 **client_kwargs):
+        if client is None:
+            import boto3
+            client = boto3.client('s3', endpoint_url=endpoint_url,
+                                  **client_kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def __repr__(self):
+        return '<%s: s3://%s/%s>' % (self.__class__.__name__, self.bucket,
+                                     self.prefix)
+
+    def path(self, key):
+        return 's3://%s/%s%s' % (self.bucket, self.prefix, key)
+
+    def _head(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket,
+                                           Key=self.prefix + key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey',
+                                               'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def stat(self, key):
+        head = self._head(key)
+        if head is None:
+            return None
+        mtime = calendar.timegm(head['LastModified'].utctimetuple())
+        return mtime, head['ContentLength']
+
+    def open(self, key):
+        """
+        Return a seekable file-like object with the contents of the stored
+        object. The object is streamed into a spooled temporary file.
+        """
+        f = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self.client.download_fileobj(self.bucket, self.prefix + key, f)
+        f.seek(0)
+        return f
+
+    def open_stream(self, key):
+        """
+        Return a non-seekable file-like object which streams the contents of
+        the stored object.
+        """
+        response = self.client.get_object(Bucket=self.bucket,
+                                          Key=self.prefix + key)
+        return response['Body']
+
+    def save(self, key, f):
+        f.seek(0)
+        content_type = mimetypes.guess_type(key)[0]
+        extra_args = {'ContentType': content_type} if content_type else None
+        self.client.upload_fileobj(f, self.bucket, self.prefix + key,
+                                   ExtraArgs=extra_args)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+def local_storage_factory(settings, kind):
+    fsync = asbool(settings.get('pyramid_frontend.image_fsync'))
+    return LocalStorage(settings['pyramid_frontend.%s_image_dir' % kind],
+                        fsync=fsync)
+
+
+def s3_storage_factory(settings, kind):
+    return S3Storage(
+        settings['pyramid_frontend.s3_bucket'],
+        prefix=settings.get('pyramid_frontend.s3_%s_prefix' % kind,
+                            '%s/' % kind),
+        endpoint_url=settings.get('pyramid_frontend.s3_endpoint_url'))
+
+
+storage_factories = {
+    'local': local_storage_factory,
+    's3': s3_storage_factory,
+}
+
+
+def get_storage(settings, kind):
+    """
+    Return the storage backend for ``'original'`` or ``'processed'`` images,
+    as configured by ``pyramid_frontend.image_storage``. This is ``local``
+    (the default), ``s3``, or the dotted name of a factory which will be
+    called with ``settings`` and ``kind``.
+    """
+    storages = settings.get('pyramid_frontend.storage_registry', {})
+    if kind in storages:
+        return storages[kind]
+    name = settings.get('pyramid_frontend.image_storage') or 'local'
+    factory = storage_factories.get(name)
+    if factory is None:
+        factory = DottedNameResolver().resolve(name)
+    storage = factory(settings, kind)
+    # Local storage is cheap to set up, others (e.g. S3 clients) are reused.
+    if not storage.local:
+        storages = settings.setdefault('pyramid_frontend.storage_registry',
+                                       {})
+        storages[kind] = storage
+    return storage
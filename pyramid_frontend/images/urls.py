@@ -0,0 +1,105 @@
+from __future__ import absolute_import, print_function, division
+
+from pyramid.settings import asbool
+from pyramid.traversal import quote_path_segment, PATH_SAFE
+
+from .files import prefix_for_name, version_token
+from .signing import signing_keys, signer
+from .view import find_image_filter
+
+
+route_name = 'pyramid_frontend:images'
+
+
+class ImageURLBuilder(object):
+    """
+    Builds the URLs of images processed by one filter chain.
+
+    Everything about the URL which depends only on the chain and the settings
+    is worked out once, so building each URL is a few string operations, plus
+    a ``stat()`` of the original if URLs are versioned. The part which depends
+    on the request comes from ``base``, which ``template_base()`` generates
+    with the route once per batch of URLs.
+    """
+
+    def __init__(self, settings, chain):
+        self.settings = settings
+        self.chain = chain
+        self.versioned = asbool(
+            settings.get('pyramid_frontend.image_versioned_urls'))
+        keys = signing_keys(settings)
+        self.sign = signer(keys[0]) if keys else None
+        self._tails = {}
+
+    def tail(self, original_ext):
+        """
+        Return what the chain's basenames append to an image name.
+        """
+        try:
+            return self._tails[original_ext]
+        except KeyError:
+            tail = self._tails[original_ext] = \
+                self.chain.basename('', original_ext)
+            return tail
+
+    def url(self, base, name, original_ext):
+        """
+        Return the URL of an image, given the ``base`` URL of the image route
+        (up to and including the slash before the prefix).
+        """
+        basename = name + self.tail(original_ext)
+        query = []
+        if self.versioned:
+            token = version_token(self.settings, name, original_ext,
+                                  self.chain)
+            if token:
+                query.append('v=' + token)
+        if self.sign:
+            query.append('s=' + self.sign(basename))
+        url = ''.join([base, prefix_for_name(name), '/',
+                       quote_path_segment(basename, safe=PATH_SAFE)])
+        if query:
+            return url + '?' + '&'.join(query)
+        return url
+
+
+def get_url_builder(registry, filter_key):
+    """
+    Return the ``ImageURLBuilder`` for a filter key, building it the first
+    time it's needed.
+    """
+    builders = registry.image_url_builders
+    try:
+        return builders[filter_key]
+    except KeyError:
+        chain, with_theme = find_image_filter(registry, filter_key)
+        builder = builders[filter_key] = ImageURLBuilder(registry.settings,
+                                                         chain)
+        return builder
+
+
+def template_base(request, qualified=False, _scheme=None, _host=None,
+                  _port=None):
+    """
+    Generate the part of image URLs which precedes the prefix, with the
+    route, so that any application URL, route prefix or pregenerator is
+    respected. It's generated once per request for each set of arguments.
+    """
+    key = (qualified, _scheme, _host, _port)
+    bases = getattr(request, '_image_url_bases', None)
+    if bases is None:
+        bases = request._image_url_bases = {}
+    try:
+        return bases[key]
+    except KeyError:
+        pass
+    if qualified:
+        template = request.route_url(route_name, prefix='', name='',
+                                     _scheme=_scheme or request.scheme,
+                                     _host=_host or request.host,
+                                     _port=_port or request.server_port)
+    else:
+        template = request.route_path(route_name, prefix='', name='')
+    # The empty prefix and name leave a trailing '//'.
+    base = bases[key] = template[:-1]
+    return base
@@ -6,14 +6,67 @@ from PIL import Image, ImageChops, ImageEnhance
 
 
 def flatten_alpha(im, background='white'):
-    "Composite an RGBA image with a flat background."
+    """
+    Composite an RGBA image with a flat background. If it's entirely opaque,
+    the alpha band is just dropped.
+    """
     if im.mode == "RGBA":
+        if im.getextrema()[3] == (255, 255):
+            return im.convert("RGB")
         ni = Image.new("RGB", im.size, background)
         ni.paste(im, im)
         im = ni
     return im
 
 
+def corner_color(im, mode='RGBA'):
+    """
+    Return the color of the top left pixel of an image in ``mode``,
+    converting only that pixel rather than the whole image.
+    """
+    return im.crop((0, 0, 1, 1)).convert(mode).getpixel((0, 0))
+
+
+def thumbnail_size(size, box):
+    """
+    Return the size which ``Image.thumbnail(box)`` would give an image of
+    ``size``, without needing the image.
+    """
+    w, h = size
+    x, y = (int(math.floor(n)) for n in box)
+    if x >= w and y >= h:
+        return w, h
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    aspect = w / h
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect,
+                         key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return int(x), int(y)
+
+
+def resize(im, size, reducing_gap=None, box=None):
+    """
+    Resize an image with antialiasing. With ``reducing_gap``, it's first
+    reduced by an integer factor, as long as that leaves it at least
+    ``reducing_gap`` times ``size``, which is much faster for large
+    reductions. That needs Pillow 7.0 or later, and is ignored otherwise.
+
+    With ``box``, only that region of the image is resized. Its coordinates
+    may be fractional, but are rounded before Pillow 7.0.
+    """
+    if hasattr(im, 'reduce'):
+        return im.resize(size, Image.ANTIALIAS, box=box,
+                         reducing_gap=reducing_gap)
+    if box is not None:
+        im = im.crop(tuple(int(round(n)) for n in box))
+    return im.resize(size, Image.ANTIALIAS)
+
+
 def pad_image(im, dimensions, mode=None, color=None):
     """
     Pad an image to a given set of dimensions.
@@ -28,7 +81,13 @@ def pad_image(im, dimensions, mode=None, color=None):
 
 
 def image_entropy(im):
-    hist = im.histogram()
+    return histogram_entropy(im.histogram())
+
+
+def histogram_entropy(hist):
+    """
+    Return the entropy of an image with the histogram ``hist``.
+    """
     hist_size = sum(hist)
     # normalize
     hist = [float(h) / hist_size for h in hist]
@@ -73,10 +132,14 @@ def crop_entropy_height(im, desired_h):
     return im
 
 
-def crop_entropy(im, dimensions):
+def crop_entropy(im, dimensions, crop_width=crop_entropy_width,
+                 crop_height=crop_entropy_height):
     """
     Scale and crop the image to the desired aspect ratio by slicing off a bit
     at a time.  Slice off the edge which is lowest entropy.
+
+    The slicing is done by ``crop_width`` or ``crop_height``, which default to
+    ``crop_entropy_width()`` and ``crop_entropy_height()``.
     """
     # First resize this so that the longer dimension matches the desired
     # dimension.
@@ -90,18 +153,39 @@ def crop_entropy(im, dimensions):
         scale_h = desired_h
         scale_w = int(input_h * input_ar) + 1
         im.thumbnail((scale_w, scale_h), Image.ANTIALIAS)
-        return crop_entropy_width(im, desired_w)
+        return crop_width(im, desired_w)
     elif input_ar < desired_ar:
         scale_w = desired_w
         scale_h = int(input_w / input_ar) + 1
         im.thumbnail((scale_w, scale_h), Image.ANTIALIAS)
-        return crop_entropy_height(im, desired_h)
+        return crop_height(im, desired_h)
     else:
         # AR already matches exactly, no need to crop.
         im.thumbnail((desired_w, desired_h), Image.ANTIALIAS)
         return im
 
 
+def crop_entropy_size(size, dimensions):
+    """
+    Return the size of the image which ``crop_entropy()`` would return for an
+    image of ``size``.
+    """
+    input_w, input_h = size
+    desired_w, desired_h = dimensions
+
+    input_ar = float(input_w) / float(input_h)
+    desired_ar = float(desired_w) / float(desired_h)
+
+    if input_ar > desired_ar:
+        w, h = thumbnail_size(size, (int(input_h * input_ar) + 1, desired_h))
+        return min(w, desired_w), h
+    elif input_ar < desired_ar:
+        w, h = thumbnail_size(size, (desired_w, int(input_w / input_ar) + 1))
+        return w, min(h, desired_h)
+    else:
+        return thumbnail_size(size, (desired_w, desired_h))
+
+
 def colors_differ(a, b, tolerance):
     manhattan_distance = sum([abs(i - j) for i, j in zip(a, b)])
     return manhattan_distance > tolerance
@@ -139,7 +223,14 @@ def is_larger(im, dimensions):
     dimensions. If either desired dimension is None, the image will be larger
     in that dimension.
     """
-    w, h = im.size
+    return is_larger_size(im.size, dimensions)
+
+
+def is_larger_size(size, dimensions):
+    """
+    Like ``is_larger()``, for an image of ``size``.
+    """
+    w, h = size
     desired_w, desired_h = dimensions
     return (w > (desired_w or 0)) or (h > (desired_h or 0))
 
@@ -4,13 +4,34 @@ import os.path
 import mimetypes
 import pkg_resources
 
-from pyramid.httpexceptions import HTTPNotFound
-from pyramid.response import Response
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from six import BytesIO
+from six.moves.urllib.parse import quote
+from pyramid.httpexceptions import (HTTPNotFound, HTTPFound, HTTPForbidden,
+                                    HTTPNotModified, HTTPServiceUnavailable)
+from pyramid.response import Response, FileIter
 from pyramid.static import FileResponse
-from pyramid.settings import asbool
-from lockfile import FileLock
+from pyramid.settings import asbool, aslist
 
-from .files import filter_sep, prefix_for_name, processed_path, original_path
+from .files import (filter_sep, prefix_for_name, processed_path,
+                    original_key, processed_key, stat_version_token)
+from .storage import get_storage
+from .signing import check_signature, url_signature
+from .chain import optimized_marker_suffix, savers, split_derived_suffix
+from .filters import Filter, format_supported
+from .locking import PathLock
+from .executor import Saturated, background_worker
+
+
+# Sent along with images requested with the current version token, which will
+# never change.
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+
+# Not known to the mimetypes module in older versions of Python.
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
 
 
 plausible_extensions = set([
@@ -26,12 +47,116 @@ plausible_extensions = set([
 ])
 
 
-def get_image_filter(registry, filter_key):
+def find_image_filter(registry, filter_key):
+    """
+    Look up a chain, and the set of themes it's registered with, by suffix.
+    This includes chains derived from registered chains by their width and
+    density ladders, like ``thumb-w640``. Raises KeyError if there isn't one.
+    """
     filter_registry = getattr(registry, 'image_filter_registry', {})
-    chain, with_theme = filter_registry[filter_key]
+    try:
+        return filter_registry[filter_key]
+    except KeyError:
+        split = split_derived_suffix(filter_key)
+        if split is None:
+            raise
+    chain, with_theme = filter_registry[split[0]]
+    derived = chain.derived(split[1])
+    if derived is None:
+        raise KeyError(filter_key)
+    return derived, with_theme
+
+
+def get_image_filter(registry, filter_key):
+    chain, with_theme = find_image_filter(registry, filter_key)
     return chain
 
 
+def get_versioned_image_filter(registry, versioned_suffix):
+    """
+    Look up a chain by the suffix used in a processed image filename, which
+    may include the chain's fingerprint. Returns the chain and the
+    fingerprint, or None if there wasn't one.
+    """
+    try:
+        return get_image_filter(registry, versioned_suffix), None
+    except KeyError:
+        if versioned_suffix is None or '.' not in versioned_suffix:
+            raise
+    filter_key, fingerprint = versioned_suffix.rsplit('.', 1)
+    return get_image_filter(registry, filter_key), fingerprint
+
+
+def negotiable_formats(settings):
+    """
+    Return the list of image formats (by extension) which may be served
+    instead of the format of a filter chain, in order of preference, as
+    configured by ``pyramid_frontend.image_negotiate_formats``. Formats which
+    this installation of PIL can't save are left out.
+    """
+    formats = []
+    for extension in aslist(
+            settings.get('pyramid_frontend.image_negotiate_formats') or ''):
+        extension = extension.lower()
+        if extension in savers and \
+                format_supported(savers[extension].format):
+            formats.append(extension)
+    return formats
+
+
+def accepted_types(accept):
+    """
+    Return the set of media types which are named explicitly (rather than by
+    wildcards like ``image/*``) and not refused in an ``Accept`` header.
+    """
+    types = set()
+    for item in (accept or '').split(','):
+        params = item.split(';')
+        media_type = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if media_type and '*' not in media_type and quality > 0:
+            types.add(media_type)
+    return types
+
+
+def negotiate_format(formats, accept):
+    """
+    Return the first of ``formats`` (extensions) which the client explicitly
+    accepts, according to the ``Accept`` header, or None.
+    """
+    accepted = accepted_types(accept)
+    for extension in formats:
+        if mimetypes.guess_type('x.%s' % extension)[0] in accepted:
+            return extension
+    return None
+
+
+def get_bucketed_image_filter(registry, versioned_suffix):
+    """
+    Look up the chain for a width which isn't on the width ladder of a
+    registered chain, like ``thumb-w700``, which is the rung that width falls
+    into, so that arbitrary widths can be requested without each one being
+    processed and stored. Raises KeyError if there isn't one.
+    """
+    split = split_derived_suffix(versioned_suffix)
+    if split is None and versioned_suffix and '.' in versioned_suffix:
+        # Ignore the fingerprint.
+        split = split_derived_suffix(versioned_suffix.rsplit('.', 1)[0])
+    if split is None or not split[1].startswith('w'):
+        raise KeyError(versioned_suffix)
+    chain = get_image_filter(registry, split[0])
+    if not chain.widths:
+        raise KeyError(versioned_suffix)
+    return chain.derived('w%d' % chain.bucket_width(int(split[1][1:])))
+
+
 class MissingOriginal(Exception):
 
     def __init__(self, path, chain):
@@ -39,27 +164,198 @@ class MissingOriginal(Exception):
         self.chain = chain
         Exception.__init__(self, 'Missing file %s' % path)
 
+    def __reduce__(self):
+        # Allow this to be re-raised across a process pool.
+        return (self.__class__, (self.path, self.chain))
 
-def process_image(settings, name, original_ext, chain, overwrite=False):
+
+def optimize_image(proc_path, chain, fsync=False):
+    """
+    Apply deferred lossless optimization to an already processed image.
+    """
+    with PathLock(proc_path):
+        if os.path.exists(proc_path):
+            chain.optimize(proc_path, fsync=fsync)
+
+
+def open_original(settings, name, original_ext, chain):
+    """
+    Return a file-like object with the contents of an original image, or
+    raise ``MissingOriginal``.
+    """
+    originals = get_storage(settings, 'original')
+    key = original_key(name, original_ext)
+    if not originals.exists(key):
+        raise MissingOriginal(path=originals.path(key), chain=chain)
+    return originals.open(key)
+
+
+def processed_is_current(processed, proc_key, stale_before=None):
+    """
+    Return True if the processed image stored under ``proc_key`` exists, and
+    (if ``stale_before`` is given) was modified no earlier than that, i.e.
+    after the original it was processed from was last replaced.
+    """
+    if stale_before is None:
+        return processed.exists(proc_key)
+    st = processed.stat(proc_key)
+    return st is not None and st[0] >= stale_before
+
+
+def process_image(settings, name, original_ext, chain, overwrite=False,
+                  image_data=None, stale_before=None):
+    """
+    Ensure that the variant of an original image produced by ``chain`` exists,
+    processing it if necessary, and return its path. If ``image_data`` is
+    supplied (a file-like object or decoded PIL image), it is used instead of
+    reading the original image.
+
+    Processed images are written to a temporary file and renamed into place,
+    so an existing image is always complete and can be used without locking.
+    The lock is only taken to process a missing image, so that it's only
+    processed once.
+
+    If processed images are kept in a remote storage backend, the returned
+    path is only used for locking, and the image is stored under
+    ``processed_key()`` instead.
+
+    If ``stale_before`` is given, an existing processed image which was
+    modified before then (the modification time of the original) is processed
+    again.
+    """
+    defer = asbool(settings.get('pyramid_frontend.image_defer_optimization'))
+    fsync = asbool(settings.get('pyramid_frontend.image_fsync'))
+    processed = get_storage(settings, 'processed')
+    proc_key = processed_key(name, original_ext, chain)
     proc_path = processed_path(settings, name, original_ext, chain)
-    if overwrite or (not os.path.exists(proc_path)):
+    if not processed.local:
+        # Deferred optimization rewrites the file in place, which only makes
+        # sense locally.
+        defer = False
+
+    if overwrite or not processed_is_current(processed, proc_key,
+                                             stale_before):
         dest_dir = os.path.dirname(proc_path)
         try:
             os.makedirs(dest_dir)
         except OSError:
             pass
 
-        lock = FileLock(proc_path + '.lock')
-        with lock:
-            if overwrite or (not os.path.exists(proc_path)):
-                orig_path = original_path(settings, name, original_ext)
-                if not os.path.exists(orig_path):
-                    raise MissingOriginal(path=orig_path, chain=chain)
-                image_data = open(orig_path, 'rb')
-                chain.run(proc_path, image_data)
+        with PathLock(proc_path):
+            if overwrite or not processed_is_current(processed, proc_key,
+                                                     stale_before):
+                if image_data is None:
+                    image_data = open_original(settings, name, original_ext,
+                                               chain)
+                if processed.local:
+                    marker_path = proc_path + optimized_marker_suffix
+                    if os.path.exists(marker_path):
+                        os.unlink(marker_path)
+                    chain.run(proc_path, image_data, postprocess=not defer,
+                              fsync=fsync)
+                else:
+                    processed.save(proc_key,
+                                   chain.process(proc_path, image_data))
+            else:
+                defer = False
+        if defer:
+            # The unoptimized image can be served right away.
+            background_worker().submit(optimize_image, proc_path, chain,
+                                       fsync=fsync)
     return proc_path
 
 
+def process_variants(settings, name, original_ext, chains, overwrite=False,
+                     threads=None):
+    """
+    Ensure that the variants of an original image produced by each of
+    ``chains`` exist, and return a list of their paths.
+
+    This is much cheaper than calling ``process_image()`` for each chain: the
+    original is read and decoded only once, and the chains are run
+    concurrently in a pool of ``threads`` threads (by default, one per CPU).
+    """
+    chains = list(chains)
+    proc_paths = [processed_path(settings, name, original_ext, chain)
+                  for chain in chains]
+    processed = get_storage(settings, 'processed')
+    pending = [chain for chain in chains
+               if overwrite or (not processed.exists(
+                   processed_key(name, original_ext, chain)))]
+    if not pending:
+        return proc_paths
+
+    with open_original(settings, name, original_ext, pending[0]) as f:
+        raw = f.read()
+
+    im = None
+    if any(chain.accepts_image for chain in pending):
+        im = Filter().adapt_input(BytesIO(raw))
+        im.load()
+
+    def run(chain):
+        # Filters may modify images in place, so each chain gets a copy.
+        if chain.accepts_image:
+            image_data = im.copy()
+        else:
+            image_data = BytesIO(raw)
+        process_image(settings, name, original_ext, chain,
+                      overwrite=overwrite, image_data=image_data)
+
+    pool = ThreadPool(min(len(pending), threads or cpu_count()))
+    try:
+        pool.map(run, pending)
+    finally:
+        pool.close()
+        pool.join()
+    return proc_paths
+
+
+offload_modes = ('x-accel-redirect', 'x-sendfile')
+
+
+def check_offload_mode(settings):
+    """
+    Raise ValueError if ``pyramid_frontend.image_offload`` is set to an
+    unknown mode, so that a misconfigured app fails when it starts, rather
+    than on every image request.
+    """
+    mode = settings.get('pyramid_frontend.image_offload')
+    if mode and mode not in offload_modes:
+        raise ValueError('unknown pyramid_frontend.image_offload mode %r' %
+                         mode)
+
+
+def offload_response(settings, proc_path):
+    """
+    Return an empty response which tells the front-end web server to send the
+    processed image itself, as configured by
+    ``pyramid_frontend.image_offload``, or None if the app should send it.
+    """
+    mode = settings.get('pyramid_frontend.image_offload')
+    if not mode:
+        return None
+
+    response = Response()
+    response.content_type = mimetypes.guess_type(proc_path)[0]
+    if mode == 'x-accel-redirect':
+        # nginx: the header is a URI, which must map to an internal location
+        # aliased to the processed image directory.
+        prefix = settings.get('pyramid_frontend.image_offload_prefix',
+                              '/processed-images').rstrip('/')
+        rel_path = os.path.relpath(
+            proc_path, settings['pyramid_frontend.processed_image_dir'])
+        response.headers['X-Accel-Redirect'] = '%s/%s' % (
+            prefix, quote(rel_path.replace(os.sep, '/')))
+    elif mode == 'x-sendfile':
+        # Apache mod_xsendfile, lighttpd: the header is a filesystem path.
+        response.headers['X-Sendfile'] = os.path.abspath(proc_path)
+    else:
+        raise ValueError('unknown pyramid_frontend.image_offload mode %r' %
+                         mode)
+    return response
+
+
 class ImageView(object):
 
     def __init__(self, request):
@@ -77,12 +373,105 @@ class ImageView(object):
 
         return response
 
+    def stream_response(self, proc_path, settings, name, original_ext,
+                        chain):
+        """
+        Return a response which streams a processed image from a remote
+        storage backend.
+        """
+        processed = get_storage(settings, 'processed')
+        f = processed.open_stream(processed_key(name, original_ext, chain))
+        response = Response(app_iter=FileIter(f))
+        response.content_type = mimetypes.guess_type(proc_path)[0]
+        return response
+
+    def canonical_path(self, url_prefix, basename):
+        """
+        Return the path to redirect to for the current URL of an image.
+        """
+        query = {}
+        signature = url_signature(self.request.registry.settings, basename)
+        if signature:
+            query['s'] = signature
+        return self.request.route_path('pyramid_frontend:images',
+                                       prefix=url_prefix,
+                                       name=basename,
+                                       _query=query)
+
+    def process(self, name, original_ext, chain, overwrite=False,
+                stale_before=None):
+        """
+        Process a variant of an original image with ``process_image()``, and
+        return its path. Originals which were recently found to be missing are
+        rejected before taking up a worker.
+        """
+        registry = self.request.registry
+        settings = registry.settings
+        missing_cache = getattr(registry, 'image_missing_cache', None)
+        if missing_cache and missing_cache.is_missing(name, original_ext):
+            raise MissingOriginal(
+                path=get_storage(settings, 'original').path(
+                    original_key(name, original_ext)),
+                chain=chain)
+
+        # Cold renders are optionally handed off to a pool of worker
+        # processes, so that they don't tie up this thread's CPU.
+        executor = getattr(registry, 'image_executor', None)
+        try:
+            if executor:
+                return executor.run_with_settings(process_image, name,
+                                                  original_ext, chain,
+                                                  overwrite=overwrite,
+                                                  stale_before=stale_before)
+            return process_image(settings, name, original_ext, chain,
+                                 overwrite=overwrite,
+                                 stale_before=stale_before)
+        except MissingOriginal:
+            if missing_cache:
+                missing_cache.add(name, original_ext)
+            raise
+
+    def local_response(self, proc_path, cache, headers):
+        """
+        Return a response which sends a processed image from local storage.
+        Raises IOError or OSError if the image doesn't exist.
+        """
+        if cache:
+            with open(proc_path, 'rb') as f:
+                data = f.read(cache.slot_size + 1)
+                mtime = os.fstat(f.fileno()).st_mtime
+            if cache.put(proc_path, data, mtime):
+                return self.data_response(proc_path, data, headers)
+
+        response = offload_response(self.request.registry.settings, proc_path)
+        if response is None:
+            response = FileResponse(proc_path, self.request)
+        else:
+            # The front-end web server opens the image later, so at least
+            # check that it's still there. Garbage collection doesn't evict
+            # recently used images, so it won't be removed in the meantime.
+            os.stat(proc_path)
+        response.headers.update(headers)
+        return response
+
+    def data_response(self, proc_path, data, headers):
+        response = Response(data, conditional_response=True)
+        response.content_type = mimetypes.guess_type(proc_path)[0]
+        response.headers.update(headers)
+        return response
+
     def __call__(self):
         request = self.request
         settings = request.registry.settings
 
         url_prefix = self.request.matchdict['prefix']
         name = self.request.matchdict['name']
+
+        # When URLs are signed, only those generated by the app are
+        # processed, and anything else is rejected before doing any work.
+        if not check_signature(settings, name, request.params.get('s')):
+            raise HTTPForbidden()
+
         name, ext = name.rsplit('.', 1)
 
         if filter_sep in name:
@@ -95,10 +484,18 @@ class ImageView(object):
             original_ext = ext
             chain_name = None
 
+        bucketed = False
         try:
-            chain = get_image_filter(request.registry, chain_name)
+            chain, fingerprint = get_versioned_image_filter(request.registry,
+                                                            chain_name)
         except KeyError:
-            raise HTTPNotFound()
+            try:
+                chain = get_bucketed_image_filter(request.registry,
+                                                  chain_name)
+            except KeyError:
+                raise HTTPNotFound()
+            bucketed = True
+            fingerprint = chain.fingerprint if chain.fingerprinted else None
 
         if ((chain.extension and chain.extension != ext) or
                 prefix_for_name(name) != url_prefix):
@@ -107,15 +504,102 @@ class ImageView(object):
         if original_ext not in plausible_extensions:
             raise HTTPNotFound()
 
+        if bucketed:
+            if settings.get('pyramid_frontend.image_bucket_mode',
+                            'redirect') == 'redirect':
+                raise HTTPFound(location=self.canonical_path(
+                    url_prefix, chain.basename(name, original_ext)))
+        elif not chain.fingerprinted:
+            if fingerprint is not None:
+                raise HTTPNotFound()
+        elif fingerprint != chain.fingerprint:
+            # This URL refers to a previous configuration of this chain.
+            raise HTTPFound(location=self.canonical_path(
+                url_prefix, chain.basename(name, original_ext)))
+
         debug = asbool(settings.get('pyramid_frontend.debug'))
         overwrite = debug and request.params.get('overwrite')
 
+        sweeper = getattr(request.registry, 'image_sweeper', None)
+        if sweeper:
+            sweeper.ensure_started()
+
+        # Browsers which support better formats get them at the same URL,
+        # from a separately processed image.
+        headers = {}
+        url_chain = chain
+        formats = getattr(request.registry, 'image_negotiate_formats', None)
+        if formats and chain.extension:
+            headers['Vary'] = 'Accept'
+            extension = negotiate_format(formats,
+                                         request.headers.get('Accept'))
+            if extension:
+                chain = chain.with_extension(extension)
+
+        # The version token doubles as an ETag, which lets us answer
+        # conditional requests without processing anything. It's weak, since
+        # deferred optimization may later replace the processed image's bytes
+        # without changing the token.
+        #
+        # Replacing the original changes the token, so processed images older
+        # than the original are stale, and are processed again.
+        stale_before = None
+        if asbool(settings.get('pyramid_frontend.image_versioned_urls')):
+            original_st = get_storage(settings, 'original').stat(
+                original_key(name, original_ext))
+            token = stat_version_token(original_st, url_chain)
+            if token:
+                stale_before = original_st[0]
+                etag = token
+                if chain is not url_chain:
+                    etag = '%s-%s' % (token, chain.extension)
+                headers['ETag'] = 'W/"%s"' % etag
+                if request.params.get('v') == token:
+                    headers['Cache-Control'] = immutable_cache_control
+                if not overwrite and etag in request.if_none_match:
+                    raise HTTPNotModified(headers=headers)
+
+        # Hot images may be served straight from a cache shared by all of
+        # the processes on this machine.
+        processed = get_storage(settings, 'processed')
+        proc_path = processed_path(settings, name, original_ext, chain)
+        cache = getattr(request.registry, 'image_cache', None)
+        if not processed.local:
+            cache = None
+        if cache and not overwrite:
+            data = cache.get(proc_path, min_mtime=stale_before)
+            if data is not None:
+                return self.data_response(proc_path, data, headers)
+
+        # Processed images are renamed into place once they're complete, so
+        # one which exists can be served without taking any locks.
+        if overwrite or not processed_is_current(
+                processed, processed_key(name, original_ext, chain),
+                stale_before):
+            try:
+                proc_path = self.process(name, original_ext, chain,
+                                         overwrite=overwrite,
+                                         stale_before=stale_before)
+            except Saturated as e:
+                raise HTTPServiceUnavailable(
+                    headers={'Retry-After': str(e.retry_after)})
+            except MissingOriginal:
+                if debug:
+                    return self.placeholder(chain)
+                else:
+                    raise
+
+        if not processed.local:
+            response = self.stream_response(proc_path, settings, name,
+                                            original_ext, chain)
+            response.headers.update(headers)
+            return response
+
         try:
+            return self.local_response(proc_path, cache, headers)
+        except (IOError, OSError):
+            # Garbage collection removed the processed image since we checked
+            # that it exists, so process it again.
             proc_path = process_image(settings, name, original_ext, chain,
-                                      overwrite=overwrite)
-        except MissingOriginal:
-            if debug:
-                return self.placeholder(chain)
-            else:
-                raise
-        return FileResponse(proc_path, self.request)
+                                      stale_before=stale_before)
+            return self.local_response(proc_path, cache, headers)
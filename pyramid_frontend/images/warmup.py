@@ -0,0 +1,63 @@
+from __future__ import absolute_import, print_function, division
+
+from pyramid.settings import aslist
+
+from .executor import background_worker
+from .view import process_variants
+
+
+def warmup_chains(settings, registry=None):
+    """
+    Return the filter chains which should be processed as soon as a new
+    original image is saved, as configured by
+    ``pyramid_frontend.image_warmup``. This is either ``all``, for every
+    registered chain, which requires the application's ``registry``, or a list
+    of theme keys, for the chains used by those themes.
+    """
+    keys = aslist(settings.get('pyramid_frontend.image_warmup', ''))
+    if not keys or keys == ['false']:
+        return []
+
+    if keys in (['all'], ['true']):
+        if registry is None:
+            raise ValueError('pyramid_frontend.image_warmup = all requires '
+                             'the application registry')
+        filter_registry = getattr(registry, 'image_filter_registry', {})
+        chains = [chain for chain, with_theme in filter_registry.values()]
+    else:
+        themes = settings.get('pyramid_frontend.theme_registry', {})
+        unknown = [key for key in keys if key not in themes]
+        if unknown:
+            raise ValueError('unknown theme(s) in '
+                             'pyramid_frontend.image_warmup: %s' %
+                             ', '.join(unknown))
+        chains = []
+        for key in keys:
+            chains.extend(themes[key].stacked_image_filters)
+
+    unique = {}
+    for chain in chains:
+        unique.setdefault(chain.suffix, chain)
+    return list(unique.values())
+
+
+def check_warmup(registry):
+    """
+    Check that the chains configured by ``pyramid_frontend.image_warmup``
+    can be found, so that a typo fails when the app starts rather than on
+    every upload.
+    """
+    warmup_chains(registry.settings, registry=registry)
+
+
+def warmup_image(settings, name, original_ext, registry=None):
+    """
+    Queue processing of all the configured warmup variants of an original
+    image on the background worker, so that they are ready before anyone
+    requests them.
+    """
+    chains = warmup_chains(settings, registry=registry)
+    if chains:
+        background_worker().submit(process_variants, settings, name,
+                                   original_ext, chains)
+    return chains
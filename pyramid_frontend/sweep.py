@@ -0,0 +1,59 @@
+from __future__ import absolute_import, print_function, division
+
+import logging
+
+import argparse
+import sys
+
+from pyramid.paster import bootstrap
+
+from .compile import configure_logging
+from .images.eviction import (sweep, sweep_options, registered_chains,
+                              parse_size)
+
+log = logging.getLogger('pyramid_frontend')
+
+
+def main(args=sys.argv):
+    """
+    Main entry point for the executable which garbage collects processed
+    images.
+    """
+    parser = argparse.ArgumentParser(
+        description='Remove stale and least recently used processed images.')
+    parser.add_argument('-v', '--verbose', action='count', default=2)
+    parser.add_argument('-s', '--max-size', default=None,
+                        help='Remove least recently used images until they '
+                        'take up at most this many bytes (e.g. 500M, 20G).')
+    parser.add_argument('-f', '--max-files', type=int, default=None,
+                        help='Remove least recently used images until there '
+                        'are at most this many.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="Report what would be removed, but don't remove "
+                        "anything.")
+    parser.add_argument('config_uri')
+
+    options = parser.parse_args(args[1:])
+
+    env = bootstrap(options.config_uri)
+    configure_logging(options.verbose)
+    registry = env['registry']
+    settings = registry.settings
+
+    kwargs = sweep_options(settings)
+    if options.max_size is not None:
+        kwargs['max_size'] = parse_size(options.max_size)
+    if options.max_files is not None:
+        kwargs['max_files'] = options.max_files
+
+    stats = sweep(settings, registered_chains(registry),
+                  formats=registry.image_negotiate_formats,
+                  dry_run=options.dry_run, **kwargs)
+    log.warning('%s %d unregistered and %d least recently used images, '
+                '%d lock files, %d markers and %d temporary files, '
+                'freeing %d bytes. %d images (%d bytes) remain.',
+                'Would remove' if options.dry_run else 'Removed',
+                stats['unregistered'], stats['evicted'], stats['locks'],
+                stats['markers'], stats['temp'], stats['freed'],
+                stats['files'], stats['size'])
+    return 0
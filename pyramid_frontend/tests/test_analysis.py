@@ -0,0 +1,108 @@
+from __future__ import absolute_import, print_function, division
+
+import os.path
+
+from unittest import TestCase
+
+from mock import patch
+from PIL import Image
+
+from ..images import analysis, utils
+
+from .test_image_utils import samples_dir
+
+
+class TestAnalysis(TestCase):
+    """
+    Check that each analysis function gives the same results as its
+    counterpart in utils.
+    """
+
+    def setUp(self):
+        smiley = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
+        smiley.load()
+        self.images = [smiley] + [smiley.convert(mode)
+                                  for mode in ('L', 'P', 'RGBA', 'CMYK')]
+        self.images.append(Image.effect_mandelbrot((450, 150),
+                                                   (-2, -1, 1, 1), 50))
+        self.images.append(Image.new('RGB', (150, 50), 'red'))
+
+    def crops(self, im):
+        w, h = im.size
+        yield im
+        yield im.crop((0, 0, w // 2, h // 2))
+        yield im.crop((w // 3, h // 4, w, h))
+        yield im.crop((w // 2, 0, w // 2 + 1, h))
+
+    def test_is_white_background(self):
+        for im in self.images:
+            for cropped in self.crops(im):
+                for tolerance in (0, 10, 180):
+                    self.assertEqual(
+                        analysis.is_white_background(cropped, tolerance),
+                        utils.is_white_background(cropped, tolerance),
+                        (cropped, tolerance))
+
+    def test_is_white_background_without_numpy(self):
+        with patch.object(analysis, 'numpy', None):
+            self.test_is_white_background()
+
+    def test_bounding_box(self):
+        for im in self.images:
+            for cropped in self.crops(im):
+                for tolerance in (0, 10, 180):
+                    self.assertEqual(
+                        analysis.bounding_box(cropped, tolerance),
+                        utils.bounding_box(cropped, tolerance),
+                        (cropped, tolerance))
+        self.assertIsNone(analysis.bounding_box(Image.new('L', (10, 10))))
+
+    def test_crop_entropy(self):
+        for im in self.images:
+            for dimensions in ((300, 300), (300, 100), (100, 300), (64, 32)):
+                expected = utils.crop_entropy(im.copy(), dimensions)
+                cropped = analysis.crop_entropy(im.copy(), dimensions)
+                self.assertEqual(cropped.size, expected.size)
+                self.assertEqual(cropped.tobytes(), expected.tobytes(),
+                                 (im, dimensions))
+
+    def test_crop_entropy_without_numpy(self):
+        with patch.object(analysis, 'numpy', None):
+            self.test_crop_entropy()
+
+    def test_histogram_entropy(self):
+        for im in self.images:
+            hist = im.histogram()
+            self.assertAlmostEqual(analysis.histogram_entropy(hist),
+                                   utils.image_entropy(im))
+        self.assertTrue(analysis.less_entropy([1, 1, 0], [1, 1, 1]))
+        # Ties go the same way as with utils.image_entropy().
+        self.assertFalse(analysis.less_entropy([1, 1, 0], [0, 1, 1]))
+
+    def test_proxy_bounding_box(self):
+        smiley = self.images[0]
+        im = Image.new('RGB', (2000, 1500), 'white')
+        im.paste(smiley, (701, 303))
+        expected = analysis.bounding_box(im)
+        for factor in (2, 3, 8):
+            proxy = im.reduce(factor)
+            box = analysis.proxy_bounding_box(proxy, im.size)
+            # The box contains everything, and not much more.
+            self.assertLessEqual(box[:2], expected[:2])
+            self.assertGreaterEqual(box[2:], expected[2:])
+            for a, b in zip(box, expected):
+                self.assertLessEqual(abs(a - b), factor * 2)
+        self.assertIsNone(analysis.proxy_bounding_box(
+            Image.new('L', (10, 10)), (100, 100)))
+
+    def test_proxy_entropy_box(self):
+        im = self.images[5]
+        for dimensions in ((300, 300), (300, 100), (450, 150), (64, 32)):
+            proxy = im.reduce(3)
+            x0, y0, x1, y1 = analysis.proxy_entropy_box(proxy, im.size,
+                                                        dimensions)
+            self.assertGreaterEqual(min(x0, y0), 0)
+            self.assertLessEqual(x1, im.size[0])
+            self.assertLessEqual(y1, im.size[1])
+            self.assertAlmostEqual((x1 - x0) / (y1 - y0),
+                                   dimensions[0] / dimensions[1])
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, print_function, division
+
+import os.path
+import pkg_resources
+import shutil
+import time
+
+from mock import patch
+from unittest import TestCase
+from webtest import TestApp
+
+from ..images import files
+from ..images.cache import (LRUCache, MissingCache,
+                            missing_cache_from_settings)
+from ..images.view import MissingOriginal
+
+from . import utils
+
+samples_dir = pkg_resources.resource_filename('pyramid_frontend.tests', 'data')
+
+
+class TestLRUCache(TestCase):
+
+    def test_evict(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.pop('c'), 3)
+        self.assertEqual(cache.pop('c', 'gone'), 'gone')
+
+
+class TestMissingCache(TestCase):
+    shared_dir = os.path.join(utils.work_dir, 'missing')
+
+    def setUp(self):
+        if os.path.exists(self.shared_dir):
+            shutil.rmtree(self.shared_dir)
+
+    def _check(self, cache):
+        self.assertFalse(cache.is_missing('foo', 'jpg'))
+        cache.add('foo', 'jpg')
+        self.assertTrue(cache.is_missing('foo', 'jpg'))
+        self.assertFalse(cache.is_missing('foo', 'png'))
+        cache.discard('foo', 'jpg')
+        self.assertFalse(cache.is_missing('foo', 'jpg'))
+        cache.discard('foo', 'jpg')
+
+        cache.add('bar', 'jpg')
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertFalse(cache.is_missing('bar', 'jpg'))
+
+    def test_local(self):
+        self._check(MissingCache(60))
+
+    def test_local_bounded(self):
+        cache = MissingCache(60, maxsize=1)
+        cache.add('foo', 'jpg')
+        cache.add('bar', 'jpg')
+        self.assertFalse(cache.is_missing('foo', 'jpg'))
+        self.assertTrue(cache.is_missing('bar', 'jpg'))
+
+    def test_shared(self):
+        self._check(MissingCache(60, shared_dir=self.shared_dir))
+        # Entries are visible to other instances.
+        MissingCache(60, shared_dir=self.shared_dir).add('baz', 'jpg')
+        cache = MissingCache(60, shared_dir=self.shared_dir)
+        self.assertTrue(cache.is_missing('baz', 'jpg'))
+
+    def test_from_settings(self):
+        self.assertIsNone(missing_cache_from_settings({}))
+        settings = {'pyramid_frontend.missing_image_ttl': '30'}
+        cache = missing_cache_from_settings(settings)
+        self.assertEqual(cache.ttl, 30)
+
+    def test_view(self):
+        app = TestApp(utils.make_app({
+            'pyramid_frontend.missing_image_ttl': '60',
+        }))
+        registry = app.app.registry
+        settings = registry.settings
+        name = 'missing-then-saved'
+        orig_path = files.original_path(settings, name, 'jpg')
+        if os.path.exists(orig_path):
+            os.unlink(orig_path)
+        url = '/img/%s/%s_jpg_thumb.png' % (files.prefix_for_name(name), name)
+
+        with self.assertRaises(MissingOriginal):
+            app.get(url)
+
+        # The second miss is rejected before processing anything.
+        with patch('pyramid_frontend.images.view.process_image') as process:
+            with self.assertRaises(MissingOriginal):
+                app.get(url)
+            self.assertEqual(process.call_count, 0)
+
+        f = open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'), 'rb')
+        files.save_image(settings, name, 'jpg', f, registry=registry)
+        app.get(url)
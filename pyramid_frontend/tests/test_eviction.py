@@ -0,0 +1,178 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import time
+from mock import patch
+from unittest import TestCase
+from six import StringIO
+
+from .. import sweep as sweep_command
+from ..images.chain import FilterChain, optimized_marker_suffix
+from ..images.eviction import (parse_size, registered_chains, variant_chain,
+                               sweep, Sweeper)
+from ..images.locking import PathLock
+from ..images.view import process_image
+
+from . import utils
+
+
+class TestVariantChain(TestCase):
+
+    def setUp(self):
+        self.chains = registered_chains(utils.make_app().registry)
+
+    def test_registered(self):
+        self.assertEqual(variant_chain(self.chains,
+                                       'foo_jpg_thumb.png').suffix, 'thumb')
+        self.assertIsNone(variant_chain(self.chains, 'foo.jpg').suffix)
+        versioned = self.chains['versioned']
+        self.assertIs(variant_chain(self.chains,
+                                    versioned.basename('foo', 'jpg')),
+                      versioned)
+        webp = versioned.with_extension('webp')
+        self.assertIs(variant_chain(self.chains, webp.basename('foo', 'jpg'),
+                                    formats=['webp']),
+                      webp)
+        self.assertIsNone(variant_chain(self.chains,
+                                        webp.basename('foo', 'jpg')))
+
+    def test_unregistered(self):
+        for filename in ('foo_jpg_gone.png',
+                         'foo_jpg_thumb.jpg',
+                         'foo_jpg_versioned.png',
+                         'foo_jpg_versioned.00000000.png',
+                         'foo_jpg_thumb.00000000.png'):
+            self.assertIsNone(variant_chain(self.chains, filename), filename)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('1024'), 1024)
+        self.assertEqual(parse_size('2K'), 2048)
+        self.assertEqual(parse_size('1.5mb'), 1536 * 1024)
+        self.assertEqual(parse_size('1G'), 1024 ** 3)
+        self.assertIsNone(parse_size(''))
+
+
+class TestSweep(TestCase):
+
+    def setUp(self):
+        utils.load_images()
+        self.registry = utils.make_app().registry
+        self.settings = self.registry.settings
+        self.chains = registered_chains(self.registry)
+        self.paths = [process_image(self.settings, name, 'jpg',
+                                    self.chains['thumb'])
+                      for name in ('smiley-jpeg-rgb', 'smiley-jpeg-cmyk')]
+        self.dirpath = os.path.dirname(self.paths[0])
+
+    def touch(self, filename, age=0):
+        path = os.path.join(self.dirpath, filename)
+        with open(path, 'w') as f:
+            f.write('x')
+        then = time.time() - age
+        os.utime(path, (then, then))
+        return path
+
+    def test_remove_stale(self):
+        gone = self.touch('foo_jpg_gone.png')
+        old_fingerprint = self.touch('foo_jpg_versioned.00000000.png')
+        lock = self.touch('foo_jpg_thumb.png.lock')
+        marker = self.touch('foo_jpg_thumb.png' + optimized_marker_suffix)
+        old_temp = self.touch('.foo_jpg_thumb.png.abc.tmp', age=7200)
+        new_temp = self.touch('.foo_jpg_thumb.png.def.tmp')
+        kept_marker = self.paths[0] + optimized_marker_suffix
+        open(kept_marker, 'w').close()
+
+        stats = sweep(self.settings, self.chains, dry_run=True)
+        self.assertEqual(stats['unregistered'], 2)
+        self.assertTrue(os.path.exists(gone))
+
+        stats = sweep(self.settings, self.chains)
+        self.assertEqual(stats['unregistered'], 2)
+        self.assertEqual(stats['locks'], 1)
+        self.assertEqual(stats['markers'], 1)
+        self.assertEqual(stats['temp'], 1)
+        self.assertEqual(stats['evicted'], 0)
+        for path in (gone, old_fingerprint, lock, marker, old_temp):
+            self.assertFalse(os.path.exists(path), path)
+        for path in self.paths + [new_temp, kept_marker]:
+            self.assertTrue(os.path.exists(path), path)
+
+    def test_evict_least_recently_used(self):
+        now = time.time()
+        os.utime(self.paths[0], (now, now))
+        os.utime(self.paths[1], (now - 600, now - 600))
+        stats = sweep(self.settings, {'thumb': self.chains['thumb']},
+                      max_files=1)
+        self.assertEqual(stats['evicted'], 1)
+        self.assertEqual(stats['files'], 1)
+        self.assertTrue(os.path.exists(self.paths[0]))
+        self.assertFalse(os.path.exists(self.paths[1]))
+
+        stats = sweep(self.settings, self.chains, max_size=0)
+        self.assertEqual(stats['evicted'], 1)
+        self.assertEqual(stats['size'], 0)
+
+    def test_skip_locked(self):
+        with PathLock(self.paths[0]):
+            stats = sweep(self.settings, self.chains, max_files=0)
+            self.assertTrue(os.path.exists(self.paths[0]))
+        self.assertEqual(stats['evicted'], 1)
+        self.assertEqual(stats['files'], 1)
+        self.assertFalse(os.path.exists(self.paths[1]))
+
+    def test_skip_recently_used(self):
+        now = time.time()
+        os.utime(self.paths[0], (now, now))
+        os.utime(self.paths[1], (now - 600, now - 600))
+        stats = sweep(self.settings, self.chains, max_files=0, min_age=60)
+        self.assertEqual(stats['evicted'], 1)
+        self.assertEqual(stats['files'], 1)
+        self.assertTrue(os.path.exists(self.paths[0]))
+        self.assertFalse(os.path.exists(self.paths[1]))
+
+    def test_sweeper(self):
+        registry = utils.make_app({
+            'pyramid_frontend.image_gc_max_files': '1',
+        }).registry
+        # Images used within the last minute aren't evicted.
+        then = time.time() - 600
+        for path in self.paths:
+            os.utime(path, (then, then))
+        sweeper = Sweeper(registry, interval=3600)
+        stats = sweeper.sweep_once()
+        self.assertEqual(stats['evicted'], 1)
+        # Only one sweep at a time.
+        with PathLock(os.path.join(
+                self.settings['pyramid_frontend.processed_image_dir'], '.gc')):
+            self.assertIsNone(sweeper.sweep_once())
+
+    def test_sweeper_setting(self):
+        registry = utils.make_app({
+            'pyramid_frontend.image_gc_interval': '60',
+        }).registry
+        self.assertEqual(registry.image_sweeper.interval, 60)
+        self.assertIsNone(self.registry.image_sweeper)
+
+    def test_variant_chain_changed(self):
+        # A chain registered under the same suffix with different settings
+        # still produces the same filenames, unless it's fingerprinted.
+        chains = dict(self.chains)
+        chains['thumb'] = FilterChain('thumb', width=100, height=100)
+        stats = sweep(self.settings, chains)
+        self.assertEqual(stats['unregistered'], 0)
+
+
+class TestSweepCommand(TestCase):
+
+    def test_pgc_usage(self):
+        args = [
+            'pgc',
+        ]
+        buf = StringIO()
+        with patch('sys.stderr', buf):
+            with self.assertRaises(SystemExit) as cm:
+                sweep_command.main(args)
+            exit_exception = cm.exception
+            self.assertEqual(exit_exception.code, 2)
+        self.assertIn('config_uri', buf.getvalue())
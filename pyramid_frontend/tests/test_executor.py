@@ -0,0 +1,85 @@
+from __future__ import absolute_import, print_function, division
+
+import time
+from threading import Thread
+from unittest import TestCase
+
+from ..images.executor import (ImageExecutor, Saturated, picklable_settings,
+                               executor_from_settings, background_worker)
+
+
+class TestImageExecutor(TestCase):
+
+    def setUp(self):
+        self.executor = ImageExecutor(1, queue_depth=1, retry_after=7)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_run(self):
+        self.assertEqual(self.executor.run(max, 3, 12), 12)
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_run_exception(self):
+        with self.assertRaises(ValueError):
+            self.executor.run(int, 'not-a-number')
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_saturated(self):
+        t = Thread(target=self.executor.run, args=(time.sleep, 0.5))
+        t.start()
+        while not self.executor.pending:
+            time.sleep(0.01)
+        with self.assertRaises(Saturated) as cm:
+            self.executor.run(max, 3, 12)
+        self.assertEqual(cm.exception.retry_after, 7)
+        t.join()
+
+    def test_run_with_settings(self):
+        executor = ImageExecutor(1, settings={
+            'pyramid_frontend.original_image_dir': '/tmp/originals',
+            'pyramid_frontend.theme_registry': {},
+        })
+        try:
+            self.assertEqual(executor.run_with_settings(sorted),
+                             ['pyramid_frontend.original_image_dir'])
+            # The worker's settings are kept from job to job.
+            key = 'pyramid_frontend.test'
+            self.assertEqual(
+                executor.run_with_settings(dict.setdefault, key, 'a'), 'a')
+            self.assertEqual(
+                executor.run_with_settings(dict.setdefault, key, 'b'), 'a')
+        finally:
+            executor.close()
+
+    def test_picklable_settings(self):
+        settings = {
+            'pyramid_frontend.original_image_dir': '/tmp/originals',
+            'pyramid_frontend.debug': True,
+            'pyramid_frontend.theme_registry': {},
+        }
+        self.assertEqual(picklable_settings(settings), {
+            'pyramid_frontend.original_image_dir': '/tmp/originals',
+            'pyramid_frontend.debug': True,
+        })
+
+    def test_from_settings(self):
+        self.assertIsNone(executor_from_settings({}))
+        executor = executor_from_settings({
+            'pyramid_frontend.image_workers': '2',
+        })
+        self.assertEqual(executor.workers, 2)
+        self.assertEqual(executor.queue_depth, 8)
+
+
+class TestBackgroundWorker(TestCase):
+
+    def test_submit(self):
+        results = []
+        worker = background_worker()
+        self.assertIs(worker, background_worker())
+        worker.submit(results.append, 1)
+        worker.submit(int, 'failures-are-logged')
+        worker.submit(results.append, 2)
+        worker.wait()
+        self.assertEqual(results, [1, 2])
@@ -3,11 +3,18 @@ from __future__ import absolute_import, print_function, division
 import os.path
 import pkg_resources
 
+from mock import patch
 from unittest import TestCase
 
-from ..images import files
+from pyramid import testing
+from pyramid.exceptions import ConfigurationExecutionError
+
+from ..images import files, warmup
+from ..images.chain import FilterChain
+from ..images.executor import background_worker
 
 from . import utils
+from .example import foo
 
 samples_dir = pkg_resources.resource_filename('pyramid_frontend.tests', 'data')
 
@@ -51,3 +58,85 @@ class TestFiles(TestCase):
         info = files.check_and_save_image(settings, 'smiley-jpeg-rgb', f)
         self.assertEqual(info['ext'], 'jpg')
         self.assertEqual(info['size'], (512, 512))
+
+    def test_version_token(self):
+        settings = utils.default_settings
+        f = open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'), 'rb')
+        files.save_image(settings, 'version-test', 'jpg', f)
+        chain = FilterChain('thumb', extension='jpg')
+        token = files.version_token(settings, 'version-test', 'jpg', chain)
+        self.assertRegexpMatches(token, '^[0-9a-f]{12}$')
+
+        other = FilterChain('thumb', extension='jpg', quality=50)
+        self.assertNotEqual(files.version_token(settings, 'version-test',
+                                                'jpg', other), token)
+
+        f = open(os.path.join(samples_dir, 'smiley-png24-alpha.png'), 'rb')
+        files.save_image(settings, 'version-test', 'jpg', f)
+        self.assertNotEqual(files.version_token(settings, 'version-test',
+                                                'jpg', chain), token)
+
+        self.assertIsNone(files.version_token(settings, 'nonexistent-file',
+                                              'jpg', chain))
+
+    def test_check_and_save_image_warmup(self):
+        f = open(os.path.join(samples_dir, 'smiley-png24-alpha.png'), 'rb')
+        settings = dict(utils.default_settings)
+        settings['pyramid_frontend.image_warmup'] = 'foo'
+        settings['pyramid_frontend.theme_registry'] = {
+            'foo': foo.FooTheme(settings),
+        }
+        chains = warmup.warmup_chains(settings)
+        self.assertEqual(sorted(chain.suffix for chain in chains),
+                         ['full', 'tiny'])
+
+        for chain in chains:
+            proc_path = files.processed_path(settings, 'warmup-test', 'png',
+                                             chain)
+            if os.path.exists(proc_path):
+                os.unlink(proc_path)
+
+        files.check_and_save_image(settings, 'warmup-test', f)
+        background_worker().wait()
+        for chain in chains:
+            proc_path = files.processed_path(settings, 'warmup-test', 'png',
+                                             chain)
+            self.assertTrue(os.path.exists(proc_path))
+
+    def test_warmup_chains_all(self):
+        config = testing.setUp()
+        chain = FilterChain('warmup-all', extension='jpg')
+        config.registry.image_filter_registry = {
+            'warmup-all': (chain, set()),
+        }
+        try:
+            settings = {'pyramid_frontend.image_warmup': 'all'}
+            self.assertEqual(warmup.warmup_chains(settings, config.registry),
+                             [chain])
+            with self.assertRaises(ValueError):
+                warmup.warmup_chains(settings)
+            settings = {}
+            self.assertEqual(warmup.warmup_chains(settings, config.registry),
+                             [])
+        finally:
+            testing.tearDown()
+
+    def test_warmup_unknown_theme(self):
+        settings = dict(utils.default_settings)
+        settings['pyramid_frontend.image_warmup'] = 'foo nonexistent'
+        settings['pyramid_frontend.theme_registry'] = {
+            'foo': foo.FooTheme(settings),
+        }
+        with self.assertRaises(ValueError):
+            warmup.warmup_chains(settings)
+
+        # The failure is logged, and the original is still saved.
+        f = open(os.path.join(samples_dir, 'smiley-png24-alpha.png'), 'rb')
+        with patch.object(files.log, 'exception') as log_exception:
+            files.check_and_save_image(settings, 'warmup-unknown', f)
+        self.assertEqual(log_exception.call_count, 1)
+        self.assertTrue(os.path.exists(
+            files.original_path(settings, 'warmup-unknown', 'png')))
+
+        with self.assertRaises(ConfigurationExecutionError):
+            utils.make_app({'pyramid_frontend.image_warmup': 'nonexistent'})
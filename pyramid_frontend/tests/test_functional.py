@@ -1,15 +1,23 @@
 from __future__ import absolute_import, print_function, division
 
 import re
+import os
+import os.path
 from unittest import TestCase, SkipTest
 from six import BytesIO
 
+from mock import patch
 from webtest import TestApp
 
 from PIL import Image
 
 from ..images import files
+from ..images.chain import FilterChain
+from ..images.locking import PathLock
+from ..images.storage import LocalStorage
 from ..images.view import MissingOriginal
+from ..images.signing import sign
+from ..images.executor import ImageExecutor, Saturated
 from ..templating.renderer import MakoRenderingException
 
 from . import utils
@@ -19,6 +27,22 @@ def setup():
     utils.load_images()
 
 
+def removed_after_check():
+    """
+    Patch local storage so that the first check for a processed image finds
+    it, as if it were removed right afterwards.
+    """
+    exists = LocalStorage.exists
+    checked = []
+
+    def exists_once(storage, key):
+        if not checked:
+            checked.append(key)
+            return True
+        return exists(storage, key)
+    return patch.object(LocalStorage, 'exists', exists_once)
+
+
 class Functional(TestCase):
     settings = None
 
@@ -166,6 +190,47 @@ class TestImagesFunctional(Functional):
         tag_resp.mustcontain('width')
         tag_resp.mustcontain(url_resp.body)
 
+    def test_image_tag_srcset(self):
+        tag = self.app.get('/image-tag?filter_key=ladder').body.decode('utf-8')
+        self.assertRegexpMatches(tag, r'srcset="/img/\w+/smiley-jpeg-rgb_jpg_'
+                                 r'ladder-w100\.png 100w, /img/\w+/smiley-'
+                                 r'jpeg-rgb_jpg_ladder-w400\.png 400w"')
+        self.assertIn('sizes="200px"', tag)
+
+        tag = self.app.get('/image-tag?filter_key=retina').body.decode('utf-8')
+        self.assertIn('_jpg_retina.png 1x, ', tag)
+        self.assertIn('_jpg_retina-2x.png 2x, ', tag)
+        self.assertIn('_jpg_retina-3x.png 3x"', tag)
+        self.assertNotIn('sizes=', tag)
+
+    def test_fetch_derived(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        resp = self.app.get('/img/%s/%s_jpg_ladder-w400.png' % (prefix, name))
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (400, 200))
+        resp = self.app.get('/img/%s/%s_jpg_retina-2x.png' % (prefix, name))
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (100, 100))
+        self.app.get('/img/%s/%s_jpg_retina-4x.png' % (prefix, name),
+                     status=404)
+        self.app.get('/img/%s/%s_jpg_thumb-2x.png' % (prefix, name),
+                     status=404)
+
+    def test_fetch_bucketed(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        for width, bucket in ((50, 100), (101, 400), (99999, 400)):
+            resp = self.app.get('/img/%s/%s_jpg_ladder-w%d.png' %
+                                (prefix, name, width), status=302)
+            self.assertTrue(resp.location.endswith(
+                '/img/%s/%s_jpg_ladder-w%d.png' % (prefix, name, bucket)),
+                resp.location)
+        self.app.get('/img/%s/%s_jpg_ladder-w0400.png' % (prefix, name),
+                     status=302)
+        self.app.get('/img/%s/%s_jpg_ladder-w999999.png' % (prefix, name),
+                     status=404)
+        self.app.get('/img/%s/%s_jpg_thumb-w400.png' % (prefix, name),
+                     status=404)
+
     def test_image_original_path(self):
         resp = self.app.get('/image-original-path')
         resp.mustcontain('originals')
@@ -189,9 +254,28 @@ class TestImagesFunctional(Functional):
         name = 'smiley-jpeg-rgb'
         prefix = files.prefix_for_name(name)
         resp_a = self.app.get('/img/%s/%s_jpg_thumb.png' % (prefix, name))
-        # FIXME This should try to find a way to test that it's fetching from
-        # the filesystem the second time.
-        resp_b = self.app.get('/img/%s/%s_jpg_thumb.png' % (prefix, name))
+        # The second time, the processed image is served from the filesystem
+        # without processing or locking anything.
+        with patch.object(PathLock, 'acquire') as acquire:
+            with patch.object(FilterChain, 'run') as run:
+                resp_b = self.app.get('/img/%s/%s_jpg_thumb.png' %
+                                      (prefix, name))
+                self.assertEqual(acquire.call_count, 0)
+                self.assertEqual(run.call_count, 0)
+        self.assertEqual(resp_a.body, resp_b.body)
+
+    def test_fetch_removed(self):
+        # If garbage collection removes a processed image after it's been
+        # found, it's processed again.
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        url = '/img/%s/%s_jpg_thumb.png' % (prefix, name)
+        resp_a = self.app.get(url)
+        registry = self.app.app.registry
+        chain, with_theme = registry.image_filter_registry['thumb']
+        os.unlink(files.processed_path(registry.settings, name, 'jpg', chain))
+        with removed_after_check():
+            resp_b = self.app.get(url)
         self.assertEqual(resp_a.body, resp_b.body)
 
     def test_fetch_missing_original(self):
@@ -200,12 +284,285 @@ class TestImagesFunctional(Functional):
         with self.assertRaises(MissingOriginal):
             self.app.get('/img/%s/%s_jpg_thumb.png' % (prefix, name))
 
+    def test_fetch_fingerprinted(self):
+        url_resp = self.app.get('/image-url?filter_key=versioned')
+        url = url_resp.body.decode('utf-8')
+        self.assertRegexpMatches(url, r'_jpg_versioned\.[0-9a-f]{8}\.png$')
+        img_resp = self.app.get(url)
+        im = Image.open(BytesIO(img_resp.body))
+        self.assertEqual(im.size, (100, 100))
+
+    def test_fetch_stale_fingerprint(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        url_resp = self.app.get('/image-url?filter_key=versioned')
+        resp = self.app.get('/img/%s/%s_jpg_versioned.0badf00d.png' %
+                            (prefix, name), status=302)
+        self.assertTrue(resp.location.endswith(url_resp.body.decode('utf-8')))
+        self.app.get('/img/%s/%s_jpg_versioned.png' % (prefix, name),
+                     status=302)
+
+    def test_fetch_unexpected_fingerprint(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        self.app.get('/img/%s/%s_jpg_thumb.0badf00d.png' % (prefix, name),
+                     status=404)
+
     def test_fetch_malformed_url(self):
         name = 'smiley-jpeg-rgb'
         prefix = files.prefix_for_name(name)
         self.app.get('/img/%s/%s_thumb.png' % (prefix, name), status=404)
 
 
+class TestImagesBucketServe(Functional):
+    settings = {
+        'pyramid_frontend.image_bucket_mode': 'serve',
+    }
+
+    def test_fetch_bucketed(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        resp = self.app.get('/img/%s/%s_jpg_ladder-w150.png' % (prefix, name))
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (400, 200))
+        self.assertTrue(os.path.exists(os.path.join(
+            utils.work_dir, 'processed', prefix,
+            '%s_jpg_ladder-w400.png' % name)))
+        self.assertFalse(os.path.exists(os.path.join(
+            utils.work_dir, 'processed', prefix,
+            '%s_jpg_ladder-w150.png' % name)))
+
+
+class TestImagesExecutor(Functional):
+    settings = {
+        'pyramid_frontend.image_workers': '1',
+    }
+
+    def setUp(self):
+        utils.load_images()
+        Functional.setUp(self)
+
+    def test_fetch_image(self):
+        name = 'smiley-png24-alpha'
+        prefix = files.prefix_for_name(name)
+        img_resp = self.app.get('/img/%s/%s_png_thumb.png' % (prefix, name))
+        f = BytesIO(img_resp.body)
+        im = Image.open(f)
+        self.assertEqual(im.size, (200, 200))
+
+    def test_fetch_missing_original(self):
+        name = 'nonexistent-file'
+        prefix = files.prefix_for_name(name)
+        with self.assertRaises(MissingOriginal):
+            self.app.get('/img/%s/%s_jpg_thumb.png' % (prefix, name))
+
+    def test_saturated(self):
+        name = 'nonexistent-file'
+        prefix = files.prefix_for_name(name)
+        with patch.object(ImageExecutor, 'run',
+                          side_effect=Saturated(retry_after=3)):
+            resp = self.app.get('/img/%s/%s_jpg_thumb.png' % (prefix, name),
+                                status=503)
+        self.assertEqual(resp.headers['Retry-After'], '3')
+
+
+class TestImagesVersioned(Functional):
+    settings = {
+        'pyramid_frontend.image_versioned_urls': 'true',
+    }
+
+    def test_fetch_versioned(self):
+        url = self.app.get('/image-url').body.decode('utf-8')
+        self.assertRegexpMatches(url, r'\?v=[0-9a-f]{12}$')
+        token = url.rsplit('=', 1)[1]
+
+        resp = self.app.get(url)
+        self.assertEqual(resp.headers['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        self.assertEqual(resp.headers['ETag'], 'W/"%s"' % token)
+
+        resp = self.app.get(url, headers={'If-None-Match': 'W/"%s"' % token},
+                            status=304)
+        self.assertEqual(resp.body, b'')
+        # Weak comparison is used, so the bare tag matches too.
+        self.app.get(url, headers={'If-None-Match': '"%s"' % token},
+                     status=304)
+
+    def test_fetch_unversioned(self):
+        url = self.app.get('/image-url').body.decode('utf-8')
+        token = url.rsplit('=', 1)[1]
+        resp = self.app.get(url.split('?')[0])
+        self.assertNotIn('Cache-Control', resp.headers)
+        self.assertEqual(resp.headers['ETag'], 'W/"%s"' % token)
+
+        # A stale version token is served, but not as immutable.
+        resp = self.app.get(url.split('?')[0] + '?v=0123456789ab')
+        self.assertNotIn('Cache-Control', resp.headers)
+
+    def test_replace_original(self):
+        settings = self.app.app.registry.settings
+        url = self.app.get('/image-url').body.decode('utf-8')
+        before = self.app.get(url).body
+
+        replacement = os.path.join(utils.samples_dir, 'smiley-gif-alpha.jpg')
+        original = os.path.join(utils.samples_dir, 'smiley-jpeg-rgb.jpg')
+        try:
+            with open(replacement, 'rb') as f:
+                files.save_image(settings, 'smiley-jpeg-rgb', 'jpg', f)
+            new_url = self.app.get('/image-url').body.decode('utf-8')
+            self.assertNotEqual(new_url, url)
+            # The processed image is older than the original, so it's
+            # processed again rather than served under the new token.
+            after = self.app.get(new_url).body
+            self.assertNotEqual(after, before)
+        finally:
+            with open(original, 'rb') as f:
+                files.save_image(settings, 'smiley-jpeg-rgb', 'jpg', f)
+            url = self.app.get('/image-url').body.decode('utf-8')
+            self.assertEqual(self.app.get(url).body, before)
+
+
+class TestImagesAccelRedirect(Functional):
+    settings = {
+        'pyramid_frontend.image_offload': 'x-accel-redirect',
+        'pyramid_frontend.image_offload_prefix': '/internal/',
+    }
+
+    def test_fetch_image(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        resp = self.app.get('/img/%s/%s_jpg_thumb.png' % (prefix, name))
+        self.assertEqual(resp.body, b'')
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertEqual(resp.headers['X-Accel-Redirect'],
+                         '/internal/%s/%s_jpg_thumb.png' % (prefix, name))
+
+    def test_fetch_removed(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        url = '/img/%s/%s_jpg_thumb.png' % (prefix, name)
+        self.app.get(url)
+        registry = self.app.app.registry
+        chain, with_theme = registry.image_filter_registry['thumb']
+        path = files.processed_path(registry.settings, name, 'jpg', chain)
+        os.unlink(path)
+        with removed_after_check():
+            resp = self.app.get(url)
+        self.assertIn('X-Accel-Redirect', resp.headers)
+        self.assertTrue(os.path.exists(path))
+
+
+class TestImagesOffloadSetting(TestCase):
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            utils.make_app({'pyramid_frontend.image_offload': 'x-bogus'})
+
+
+class TestImagesSendfile(Functional):
+    settings = {
+        'pyramid_frontend.image_offload': 'x-sendfile',
+    }
+
+    def test_fetch_image(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        resp = self.app.get('/img/%s/%s_jpg_thumb.png' % (prefix, name))
+        self.assertEqual(resp.body, b'')
+        path = resp.headers['X-Sendfile']
+        self.assertTrue(path.startswith(
+            utils.default_settings['pyramid_frontend.processed_image_dir']))
+        self.assertEqual(Image.open(path).size, (200, 200))
+
+
+class TestImagesSharedCache(Functional):
+    settings = {
+        'pyramid_frontend.image_shm_cache': utils.work_dir + '/img-cache',
+    }
+
+    def test_fetch_twice(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        url = '/img/%s/%s_jpg_thumb.png' % (prefix, name)
+        resp_a = self.app.get(url)
+        resp_b = self.app.get(url)
+        self.assertEqual(resp_a.body, resp_b.body)
+        self.assertEqual(resp_b.content_type, 'image/png')
+        stats = self.app.app.registry.image_cache.stats()
+        self.assertGreaterEqual(stats['hits'], 1)
+
+
+class TestImagesNegotiated(Functional):
+    settings = {
+        'pyramid_frontend.image_negotiate_formats': 'avif webp',
+        'pyramid_frontend.image_versioned_urls': 'true',
+    }
+
+    def setUp(self):
+        utils.load_images()
+        Functional.setUp(self)
+
+    def test_fetch_webp(self):
+        url = self.app.get('/image-url').body.decode('utf-8')
+        self.assertTrue(url.split('?')[0].endswith('.png'))
+        accept = 'image/webp,image/apng,image/*,*/*;q=0.8'
+        resp = self.app.get(url, headers={'Accept': accept})
+        self.assertEqual(resp.content_type, 'image/webp')
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+        im = Image.open(BytesIO(resp.body))
+        self.assertEqual(im.format, 'WEBP')
+        self.assertEqual(im.size, (200, 200))
+
+        # Each format has its own ETag.
+        png_resp = self.app.get(url, headers={'Accept': 'image/*'})
+        self.assertEqual(png_resp.content_type, 'image/png')
+        self.assertEqual(png_resp.headers['Vary'], 'Accept')
+        self.assertNotEqual(png_resp.headers['ETag'], resp.headers['ETag'])
+        self.app.get(url, headers={'Accept': accept,
+                                   'If-None-Match': resp.headers['ETag']},
+                     status=304)
+        self.app.get(url, headers={'If-None-Match': resp.headers['ETag']},
+                     status=200)
+
+    def test_fetch_refused(self):
+        url = self.app.get('/image-url').body.decode('utf-8')
+        resp = self.app.get(url, headers={'Accept': 'image/webp;q=0'})
+        self.assertEqual(resp.content_type, 'image/png')
+
+
+class TestImagesSigned(Functional):
+    settings = {
+        'pyramid_frontend.image_signing_keys': 'new-key old-key',
+    }
+
+    def test_fetch_signed(self):
+        url = self.app.get('/image-url').body.decode('utf-8')
+        self.assertRegexpMatches(url, r'\?s=[\w-]{16}$')
+        resp = self.app.get(url)
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (200, 200))
+
+    def test_reject_unsigned(self):
+        url = self.app.get('/image-url').body.decode('utf-8')
+        unsigned = url.split('?')[0]
+        with patch.object(PathLock, 'acquire') as acquire:
+            with patch('os.path.exists') as exists:
+                self.app.get(unsigned, status=403)
+                self.app.get(unsigned + '?s=AAAAAAAAAAAAAAAA', status=403)
+                # Signatures are only valid for the image they were made for.
+                self.app.get(unsigned.replace('_thumb', '_full') +
+                             url[len(unsigned):], status=403)
+                self.assertEqual(acquire.call_count, 0)
+                self.assertEqual(exists.call_count, 0)
+
+    def test_redirect_signed(self):
+        name = 'smiley-jpeg-rgb'
+        prefix = files.prefix_for_name(name)
+        basename = '%s_jpg_ladder-w150.png' % name
+        resp = self.app.get('/img/%s/%s?s=%s' % (
+            prefix, basename, sign(b'old-key', basename)), status=302)
+        resp = self.app.get(resp.location)
+        self.assertEqual(Image.open(BytesIO(resp.body)).size, (400, 200))
+
+
 class TestImagesDebug(Functional):
     def setUp(self):
         settings = {
@@ -7,9 +7,12 @@ import pkg_resources
 
 from unittest import TestCase, skip
 
+from mock import patch
 from PIL import Image
 
-from ..images.chain import FilterChain, PassThroughFilterChain
+from ..images.chain import (FilterChain, PassThroughFilterChain,
+                            optimized_marker_suffix)
+from ..images.filters import PNGProcessor
 
 from . import utils
 
@@ -35,6 +38,95 @@ class TestFilterChain(TestCase):
         self.assertEqual(chain.basename('delicious', 'gif'),
                          'delicious_gif_thumb200.png')
 
+    def test_basename_fingerprinted(self):
+        chain = FilterChain('thumb200', extension='png', fingerprinted=True)
+        self.assertRegexpMatches(chain.basename('some-cool-image', 'jpg'),
+                                 r'^some-cool-image_jpg_thumb200\.'
+                                 r'[0-9a-f]{8}\.png$')
+
+    def test_fingerprint(self):
+        chain = FilterChain('thumb', extension='jpg',
+                            width=200, height=100, quality=80)
+        same = FilterChain('thumb', extension='jpg',
+                           width=200, height=100, quality=80)
+        self.assertEqual(chain.fingerprint, same.fingerprint)
+        for changed in [
+            FilterChain('thumb', extension='jpg',
+                        width=201, height=100, quality=80),
+            FilterChain('thumb', extension='jpg',
+                        width=200, height=100, quality=81),
+            FilterChain('thumb', extension='jpg',
+                        width=200, height=100, quality=80, crop=True),
+            FilterChain('thumb', extension='png',
+                        width=200, height=100),
+        ]:
+            self.assertNotEqual(chain.fingerprint, changed.fingerprint)
+
+    def test_with_extension(self):
+        chain = FilterChain('thumb', width=100, height=100, crop=True)
+        webp = chain.with_extension('webp')
+        self.assertIs(chain.with_extension('webp'), webp)
+        self.assertIs(chain.with_extension('png'), chain)
+        self.assertEqual(webp.suffix, 'thumb')
+        self.assertEqual(webp.basename('foo', 'jpg'), 'foo_jpg_thumb.webp')
+        self.assertNotEqual(webp.fingerprint, chain.fingerprint)
+        self.assertEqual([filter.__class__.__name__
+                          for filter in webp.filters],
+                         ['ThumbFilter', 'WebPSaver'])
+        # The original chain is unchanged.
+        self.assertEqual(chain.filters[-1].__class__.__name__,
+                         'PNGProcessor')
+
+    def test_with_extension_sharpness(self):
+        chain = FilterChain('thumb', width=100, height=100, extension='jpg',
+                            sharpness=1.5, quality=90)
+        for extension in ('webp', 'avif'):
+            saver = chain.with_extension(extension).filters[-1]
+            self.assertEqual(saver.sharpness, 1.5)
+            # Other settings are specific to the chain's own format.
+            self.assertEqual(saver.kwargs, {})
+
+    def test_derived(self):
+        chain = FilterChain('ladder', width=200, height=100,
+                            widths=[400, 100], densities=[1, 2])
+        self.assertEqual(chain.widths, [100, 400])
+        wide = chain.derived('w400')
+        self.assertIs(chain.derived('w400'), wide)
+        self.assertEqual(wide.suffix, 'ladder-w400')
+        self.assertEqual((wide.width, wide.height), (400, 200))
+        self.assertIsNone(wide.widths)
+        double = chain.derived('2x')
+        self.assertEqual(double.suffix, 'ladder-2x')
+        self.assertEqual((double.width, double.height), (400, 200))
+        for rung in ('w300', 'w0400', '3x', '2.0x', '1x'):
+            self.assertIsNone(chain.derived(rung), rung)
+
+    def test_fast_decode(self):
+        chain = FilterChain('fast', width=100, height=100, widths=[200],
+                            decode='fast')
+        self.assertNotEqual(chain.fingerprint,
+                            FilterChain('fast', width=100, height=100,
+                                        widths=[200]).fingerprint)
+        self.assertEqual(chain.derived('w200').filters[0].decode, 'fast')
+        dest_path = os.path.join(self.work_dir, 'fast.png')
+        with open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'),
+                  'rb') as f:
+            chain.run(dest_path, f)
+        self.assertEqual(Image.open(dest_path).size, (100, 100))
+
+    def test_rungs(self):
+        chain = FilterChain('retina', width=50, height=50,
+                            densities=[1, 1.5, 2])
+        self.assertEqual(chain.rungs(), [('1x', 'retina'),
+                                         ('1.5x', 'retina-1.5x'),
+                                         ('2x', 'retina-2x')])
+        self.assertEqual(chain.derived('1.5x').width, 75)
+        chain = FilterChain('ladder', width=200, widths=[100, 400],
+                            densities=[2])
+        self.assertEqual(chain.rungs(), [('100w', 'ladder-w100'),
+                                         ('400w', 'ladder-w400')])
+        self.assertEqual(FilterChain('plain').rungs(), [])
+
     def test_repr(self):
         chain = FilterChain('zygolicious', extension='png')
         self.assertIn('zygolicious', repr(chain))
@@ -103,7 +195,63 @@ class TestFilterChain(TestCase):
         im = Image.open(proc_path)
         self.assertEqual(im.size, (50, 50))
 
+    def test_run_atomic(self):
+        chain = FilterChain('thumb50', extension='png',
+                            width=50, height=50)
+        filename = self.test_files[0]
+        proc_path = os.path.join(self.work_dir, filename)
+        with open(os.path.join(samples_dir, filename), 'rb') as image_data:
+            with patch('os.fsync') as fsync:
+                chain.run(proc_path, image_data, fsync=True)
+                # Once for the file, and once for the directory.
+                self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(os.listdir(self.work_dir), [filename])
+
+        # A failed write leaves the previous file in place.
+        with patch('shutil.copyfileobj', side_effect=IOError):
+            with self.assertRaises(IOError):
+                chain.run(proc_path, open(os.path.join(samples_dir,
+                                                       filename), 'rb'))
+        self.assertEqual(os.listdir(self.work_dir), [filename])
+        self.assertEqual(Image.open(proc_path).size, (50, 50))
+
     def test_run_no_thumb(self):
         chain = FilterChain('thumbless', extension='png', no_thumb=True)
         im = self._process(chain, self.test_files[0])
         self.assertEqual(im.size, (512, 512))
+
+    def test_run_deferred_optimization(self):
+        chain = FilterChain('thumb50', extension='png',
+                            width=50, height=50)
+        filename = self.test_files[0]
+        image_data = open(os.path.join(samples_dir, filename), 'rb')
+        proc_path = os.path.join(self.work_dir, filename)
+        marker_path = proc_path + optimized_marker_suffix
+
+        with patch.object(PNGProcessor, '__call__',
+                          side_effect=lambda input: input) as processor:
+            chain.run(proc_path, image_data, postprocess=False)
+            self.assertEqual(processor.call_count, 0)
+            self.assertEqual(Image.open(proc_path).size, (50, 50))
+            self.assertFalse(os.path.exists(marker_path))
+
+            self.assertTrue(chain.optimize(proc_path))
+            self.assertEqual(processor.call_count, 1)
+            self.assertTrue(os.path.exists(marker_path))
+            self.assertEqual(Image.open(proc_path).size, (50, 50))
+
+            self.assertFalse(chain.optimize(proc_path))
+            self.assertEqual(processor.call_count, 1)
+
+    def test_run_deferred_optimization_passthrough(self):
+        chain = PassThroughFilterChain()
+        filename = 'smiley-png24-alpha.png'
+        image_data = open(os.path.join(samples_dir, filename), 'rb')
+        proc_path = os.path.join(self.work_dir, filename)
+
+        with patch.object(PNGProcessor, '__call__',
+                          side_effect=lambda input: input) as processor:
+            chain.run(proc_path, image_data, postprocess=False)
+            self.assertEqual(processor.call_count, 0)
+            self.assertTrue(chain.optimize(proc_path))
+            self.assertEqual(processor.call_count, 1)
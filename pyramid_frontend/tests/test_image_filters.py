@@ -6,6 +6,8 @@ import pkg_resources
 
 from unittest import TestCase
 
+from mock import patch
+
 from PIL import Image
 
 from ..images import filters
@@ -201,6 +203,42 @@ class TestFilters(TestCase):
         self.assertEqual(nm.mode, 'RGB')
         self.assertSimilarColor(nm.getpixel((15, 15)), (254, 6, 0))
 
+    def test_webp_save(self):
+        saver = filters.WebPSaver()
+        im = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
+        f = saver(im)
+
+        nm = Image.open(f)
+        self.assertEqual(nm.format, 'WEBP')
+        self.assertEqual(nm.mode, 'RGB')
+        self.assertSimilarColor(nm.getpixel((300, 300)), (206, 205, 1))
+
+    def test_webp_save_smaller(self):
+        im = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
+        webp_size = filesize(filters.WebPSaver(quality=80)(im))
+        jpeg_size = filesize(filters.JPGSaver(quality=80)(im))
+        self.assertLess(webp_size, jpeg_size)
+
+    def test_webp_save_alpha(self):
+        saver = filters.WebPSaver(lossless=True)
+        im = Image.new('LA', (30, 30), (255, 0))
+        rect = Image.new('LA', (10, 10), (0, 255))
+        im.paste(rect, (10, 10))
+
+        nm = Image.open(saver(im))
+        self.assertEqual(nm.mode, 'RGBA')
+        self.assertEqual(nm.getpixel((15, 15)), (0, 0, 0, 255))
+        self.assertEqual(nm.getpixel((0, 0))[3], 0)
+
+    def test_avif_save(self):
+        if not filters.format_supported('AVIF'):
+            self.skipTest('PIL is missing AVIF support')
+        saver = filters.AVIFSaver()
+        im = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
+        nm = Image.open(saver(im))
+        self.assertEqual(nm.format, 'AVIF')
+        self.assertEqual(nm.size, (512, 512))
+
     def test_vignette_filter(self):
         im = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
         filter = filters.VignetteFilter()
@@ -212,6 +250,33 @@ class TestFilters(TestCase):
         nm = Image.open(f)
         self.assertNotEqual(nm.getpixel((0, 0)), (255, 255, 255))
 
+    def test_vignette_mask(self):
+        filter = filters.VignetteFilter(falloff=3, extent=60)
+        mask = filter.mask((120, 90))
+        self.assertIs(filter.mask((120, 90)), mask)
+        self.assertIs(filters.VignetteFilter(falloff=3, extent=60)
+                      .mask((120, 90)), mask)
+        self.assertIsNot(filter.mask((90, 120)), mask)
+        self.assertEqual(mask.getpixel((0, 0)), 60)
+        self.assertEqual(mask.getpixel((60, 45)), 0)
+
+    def test_vignette_mask_numpy(self):
+        if filters.numpy is None:
+            self.skipTest('numpy is not installed')
+        for size in ((120, 90), (1, 1), (33, 7)):
+            for falloff, extent in ((4, 40), (2.5, 300)):
+                filter = filters.VignetteFilter(falloff, extent)
+                self.assertEqual(filter.compute_mask_numpy(size).tobytes(),
+                                 filter.compute_mask(size).tobytes())
+
+    def test_vignette_filter_without_numpy(self):
+        im = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
+        expected = filters.VignetteFilter(falloff=5)(im)
+        filters.vignette_masks.pop(((512, 512), 5, 40))
+        with patch.object(filters, 'numpy', None):
+            im = filters.VignetteFilter(falloff=5)(im)
+        self.assertEqual(im.tobytes(), expected.tobytes())
+
     def test_thumb_filter_defaults(self):
         filter = filters.ThumbFilter((64, 32))
         im = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
@@ -274,3 +339,123 @@ class TestFilters(TestCase):
         im = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
         im = filter(im)
         self.assertEqual(im.size, (200, 200))
+
+    def test_thumb_filter_fast_decode(self):
+        path = os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg')
+        for kwargs in (dict(dimensions=(64, 32)),
+                       dict(dimensions=(64, 32), crop=True),
+                       dict(dimensions=(100, None)),
+                       dict(dimensions=(64, 32), pad=True)):
+            quality = filters.ThumbFilter(**kwargs)(Image.open(path))
+            filter = filters.ThumbFilter(decode='fast', **kwargs)
+            output_size = filter.output_size((512, 512))
+            self.assertEqual(quality.size, output_size)
+            # Decoded at a reduced scale which leaves at least twice the
+            # output size.
+            drafted_size = filter.draft(Image.open(path))
+            self.assertLess(drafted_size, (512, 512))
+            self.assertGreaterEqual(drafted_size[0], output_size[0] * 2)
+            self.assertGreaterEqual(drafted_size[1], output_size[1] * 2)
+            im = filter(Image.open(path))
+            self.assertEqual(im.size, output_size)
+            self.assertSimilarColor(im.getpixel((im.size[0] // 2,
+                                                 im.size[1] // 2)),
+                                    quality.getpixel((im.size[0] // 2,
+                                                      im.size[1] // 2)))
+
+    def test_thumb_filter_fast_decode_full(self):
+        path = os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg')
+        # Only unloaded JPEGs are decoded at a reduced scale, and only when
+        # the output size doesn't depend on the image contents.
+        filter = filters.ThumbFilter((64, 32), decode='fast')
+        im = Image.open(path)
+        im.load()
+        self.assertIsNone(filter.draft(im))
+        self.assertIsNone(filter.draft(
+            Image.open(os.path.join(samples_dir, 'smiley-png24-alpha.png'))))
+        for filter in (filters.ThumbFilter((64, 32), decode='fast',
+                                           crop_whitespace=True),
+                       filters.ThumbFilter((64, 32), decode='fast',
+                                           enlarge=True),
+                       filters.ThumbFilter((400, 400), decode='fast')):
+            self.assertIsNone(filter.draft(Image.open(path)))
+
+    def test_thumb_filter_decode_fingerprint(self):
+        default = filters.ThumbFilter((64, 32)).fingerprint_data()
+        self.assertEqual(
+            filters.ThumbFilter((64, 32), decode='quality').fingerprint_data(),
+            default)
+        self.assertNotEqual(
+            filters.ThumbFilter((64, 32), decode='fast').fingerprint_data(),
+            default)
+
+    def test_fingerprint_unstable_value(self):
+        filter = filters.VignetteFilter()
+        filter.extent = object()
+        # Its repr() includes an address, which differs between processes.
+        with self.assertRaises(TypeError):
+            filter.fingerprint_data()
+        self.assertEqual(filters.stable_repr({'b': [1, None], 'a': 'x'}),
+                         "{'a': 'x', 'b': [1, None]}")
+
+    def test_thumb_filter_proxy_factor(self):
+        filter = filters.ThumbFilter((64, 32), crop=True, proxy_size=64)
+        self.assertEqual(filter.proxy_factor((512, 512), cover=True), 8)
+        # Never so small that the crop is more than a pixel of the output
+        # off.
+        self.assertEqual(filter.proxy_factor((512, 512), cover=False), 8)
+        self.assertEqual(filter.proxy_factor((4096, 256), cover=True), 8)
+        # Small images are analyzed in full.
+        self.assertIsNone(filter.proxy_factor((100, 100), cover=True))
+        self.assertIsNone(
+            filters.ThumbFilter((64, 32)).proxy_factor((512, 512), True))
+        filter = filters.ThumbFilter((64, 32), proxy_size=64,
+                                     proxy_tolerance=0.25)
+        self.assertEqual(filter.proxy_factor((512, 512), cover=True), 2)
+
+    def test_thumb_filter_proxy_crop(self):
+        path = os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg')
+        for dimensions in ((64, 32), (32, 64), (48, 48)):
+            full = filters.ThumbFilter(dimensions, crop=True)
+            filter = filters.ThumbFilter(dimensions, crop=True, proxy_size=64)
+            expected = full(Image.open(path))
+            im = filter(Image.open(path))
+            self.assertEqual(im.size, dimensions)
+            center = (dimensions[0] // 2, dimensions[1] // 2)
+            self.assertSimilarColor(im.getpixel(center),
+                                    expected.getpixel(center))
+
+    def test_thumb_filter_proxy_crop_palette(self):
+        # Palette images can't be reduced, so they're analyzed in full.
+        path = os.path.join(samples_dir, 'smiley-gif-alpha.gif')
+        for kwargs in (dict(crop=True), dict(crop_whitespace=True)):
+            full = filters.ThumbFilter((40, 40), **kwargs)
+            filter = filters.ThumbFilter((40, 40), proxy_size=32, **kwargs)
+            self.assertIsNone(filter.proxy(Image.open(path), cover=True))
+            expected = full(Image.open(path))
+            im = filter(Image.open(path))
+            self.assertEqual(im.size, expected.size)
+            self.assertEqual(im.tobytes(), expected.tobytes())
+
+    def test_thumb_filter_proxy_crop_whitespace(self):
+        smiley = Image.open(os.path.join(samples_dir, 'smiley-jpeg-rgb.jpg'))
+        im = Image.new('RGB', (2000, 1500), 'white')
+        im.paste(smiley, (700, 300))
+        full = filters.ThumbFilter((256, 256), crop_whitespace=True)
+        filter = filters.ThumbFilter((256, 256), crop_whitespace=True,
+                                     proxy_size=256)
+        expected = full(im.copy())
+        cropped = filter(im.copy())
+        # Cropped to within about a pixel of the output.
+        self.assertEqual(expected.size, (256, 256))
+        for n in cropped.size:
+            self.assertLessEqual(n, 256)
+            self.assertGreaterEqual(n, 252)
+
+    def test_thumb_filter_proxy_fingerprint(self):
+        default = filters.ThumbFilter((64, 32)).fingerprint_data()
+        filter = filters.ThumbFilter((64, 32), proxy_tolerance=2)
+        self.assertEqual(filter.fingerprint_data(), default)
+        self.assertNotEqual(
+            filters.ThumbFilter((64, 32), proxy_size=256).fingerprint_data(),
+            default)
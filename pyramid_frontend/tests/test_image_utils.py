@@ -32,6 +32,23 @@ class TestUtils(TestCase):
         padded = utils.pad_image(self.im, (600, 600))
         self.assertEqual(padded.size, (600, 600))
 
+    def test_flatten_alpha(self):
+        im = Image.open(os.path.join(samples_dir, 'smiley-png24-alpha.png'))
+        flattened = utils.flatten_alpha(im, 'red')
+        self.assertEqual(flattened.mode, 'RGB')
+        self.assertEqual(flattened.getpixel((0, 0)), (255, 0, 0))
+        opaque = utils.flatten_alpha(self.im.convert('RGBA'), 'red')
+        self.assertEqual(opaque.mode, 'RGB')
+        self.assertEqual(opaque.tobytes(), self.im.tobytes())
+        self.assertIs(utils.flatten_alpha(self.im), self.im)
+
+    def test_corner_color(self):
+        for mode in ('RGB', 'L', 'P', 'RGBA', 'CMYK'):
+            im = self.im.convert(mode)
+            self.assertEqual(utils.corner_color(im),
+                             im.convert('RGBA').getpixel((0, 0)))
+        self.assertEqual(utils.corner_color(self.im, 'L'), 255)
+
     def test_colors_differ(self):
         self.assertTrue(utils.colors_differ((127, 243, 100),
                                             (125, 243, 95),
@@ -1,11 +1,21 @@
 from __future__ import absolute_import, print_function, division
 
+import os.path
 from unittest import TestCase
 
+from mock import patch
+from PIL import Image
 from pyramid import testing
 from pyramid.httpexceptions import HTTPNotFound
 
-from ..images.view import ImageView
+from ..images.chain import (FilterChain, PassThroughFilterChain,
+                            optimized_marker_suffix)
+from ..images.executor import background_worker
+from ..images.filters import Filter, CMYKFilter, VignetteFilter
+from ..images.view import (ImageView, MissingOriginal, process_image,
+                           process_variants)
+
+from . import utils
 
 
 class TestImageView(TestCase):
@@ -17,3 +27,73 @@ class TestImageView(TestCase):
             request.matchdict['name'] = 'nonexistent-image.jpg'
             with self.assertRaises(HTTPNotFound):
                 ImageView(request)()
+
+
+class TestProcessImage(TestCase):
+
+    def setUp(self):
+        utils.load_images()
+
+    def test_process_deferred_optimization(self):
+        settings = dict(utils.default_settings)
+        settings['pyramid_frontend.image_defer_optimization'] = 'true'
+        chain = FilterChain('deferred', extension='jpg', width=50, height=50)
+        proc_path = process_image(settings, 'smiley-jpeg-rgb', 'jpg', chain)
+        self.assertEqual(Image.open(proc_path).size, (50, 50))
+        background_worker().wait()
+        self.assertTrue(os.path.exists(proc_path + optimized_marker_suffix))
+        self.assertEqual(Image.open(proc_path).size, (50, 50))
+
+    def test_process_variants(self):
+        chains = [
+            FilterChain('variant-small', extension='jpg',
+                        width=50, height=50),
+            FilterChain('variant-large', extension='png',
+                        width=100, height=100, crop=True),
+            PassThroughFilterChain(),
+        ]
+        with patch.object(CMYKFilter, '__call__', autospec=True,
+                          side_effect=CMYKFilter.__call__) as cmyk:
+            proc_paths = process_variants(utils.default_settings,
+                                          'smiley-jpeg-cmyk', 'jpg', chains)
+            # The original was only converted from CMYK once, not once for
+            # each chain.
+            self.assertEqual(cmyk.call_count, 1)
+        self.assertEqual([Image.open(path).size for path in proc_paths],
+                         [(50, 50), (100, 100), (512, 512)])
+
+        # Everything is processed already, so this is a no-op.
+        with patch.object(CMYKFilter, '__call__') as cmyk:
+            self.assertEqual(process_variants(utils.default_settings,
+                                              'smiley-jpeg-cmyk', 'jpg',
+                                              chains),
+                             proc_paths)
+            self.assertEqual(cmyk.call_count, 0)
+
+    def test_process_variants_custom_filter(self):
+        # Custom filters may expect image data rather than a decoded image.
+        class DataFilter(Filter):
+            def __call__(self, input):
+                assert hasattr(input, 'read')
+                return input
+
+        chains = [
+            FilterChain('variant-builtin', extension='jpg',
+                        width=50, height=50, filters=[VignetteFilter()]),
+            FilterChain('variant-custom', extension='jpg',
+                        width=60, height=60, filters=[DataFilter()]),
+        ]
+        self.assertTrue(chains[0].accepts_image)
+        self.assertFalse(chains[1].accepts_image)
+        proc_paths = process_variants(utils.default_settings,
+                                      'smiley-jpeg-rgb', 'jpg', chains,
+                                      overwrite=True)
+        self.assertEqual([Image.open(path).size for path in proc_paths],
+                         [(50, 50), (60, 60)])
+
+    def test_process_variants_missing_original(self):
+        chains = [FilterChain('variant-small', extension='jpg',
+                              width=50, height=50)]
+        with self.assertRaises(MissingOriginal):
+            process_variants(utils.default_settings, 'nonexistent-file',
+                             'jpg', chains)
@@ -0,0 +1,76 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import time
+from multiprocessing import Process, Event
+from threading import Thread
+from unittest import TestCase
+
+from ..images.locking import PathLock
+
+from . import utils
+
+
+def hold_lock(path, locked, crash):
+    lock = PathLock(path)
+    lock.acquire()
+    locked.set()
+    if crash:
+        # Die without releasing the lock, like a crashed worker.
+        time.sleep(0.2)
+        os._exit(1)
+    time.sleep(0.2)
+    lock.release()
+
+
+class TestPathLock(TestCase):
+    path = os.path.join(utils.work_dir, 'locked-image.png')
+
+    def test_lock_file_removed(self):
+        with PathLock(self.path) as lock:
+            self.assertTrue(os.path.exists(lock.lock_path))
+        self.assertFalse(os.path.exists(lock.lock_path))
+
+    def test_threads_wait(self):
+        order = []
+
+        def worker(n):
+            with PathLock(self.path):
+                order.append(('start', n))
+                time.sleep(0.05)
+                order.append(('end', n))
+
+        threads = [Thread(target=worker, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # No two threads held the lock at the same time.
+        for ii in range(0, len(order), 2):
+            self.assertEqual(order[ii][0], 'start')
+            self.assertEqual(order[ii + 1], ('end', order[ii][1]))
+
+    def test_nonblocking(self):
+        locked = Event()
+        p = Process(target=hold_lock, args=(self.path, locked, False))
+        p.start()
+        locked.wait()
+        self.assertFalse(PathLock(self.path).acquire(blocking=False))
+        with PathLock(self.path) as lock:
+            self.assertTrue(os.path.exists(lock.lock_path))
+        p.join()
+        self.assertFalse(os.path.exists(self.path + '.lock'))
+
+    def test_crashed_holder(self):
+        locked = Event()
+        p = Process(target=hold_lock, args=(self.path, locked, True))
+        p.start()
+        locked.wait()
+        p.join()
+        # The lock file is left behind, but isn't locked any more.
+        self.assertTrue(os.path.exists(self.path + '.lock'))
+        lock = PathLock(self.path)
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+        self.assertFalse(os.path.exists(self.path + '.lock'))
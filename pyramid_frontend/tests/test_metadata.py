@@ -0,0 +1,153 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import itertools
+
+from unittest import TestCase
+from webtest import TestApp
+
+from PIL import Image
+
+from ..images import files
+from ..images.chain import FilterChain
+from ..images.filters import Filter, ThumbFilter, VignetteFilter
+from ..images.metadata import (ImageInfo, MetadataIndex, get_metadata_index,
+                               image_dimensions)
+
+from . import utils
+
+
+class TestMetadataIndex(TestCase):
+    path = os.path.join(utils.work_dir, 'metadata', 'index.db')
+
+    def setUp(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.settings = dict(utils.default_settings)
+        self.settings['pyramid_frontend.image_metadata_index'] = self.path
+
+    def test_record_get(self):
+        index = MetadataIndex(self.path)
+        self.assertIsNone(index.get('foo', 'jpg'))
+        info = ImageInfo('JPEG', 'RGB', 640, 480, 12345)
+        index.record('foo', 'jpg', info)
+        index.record('bar', 'png', ImageInfo('PNG', 'RGBA', 10, 20, 300))
+        self.assertEqual(index.get('foo', 'jpg'), info)
+        # Other processes see the same index.
+        self.assertEqual(MetadataIndex(self.path).get('foo', 'jpg'), info)
+
+        found = index.get_many([('foo', 'jpg'), ('bar', 'png'),
+                                ('foo', 'png')])
+        self.assertEqual(sorted(found), [('bar', 'png'), ('foo', 'jpg')])
+        self.assertEqual(found['bar', 'png'].mode, 'RGBA')
+
+        index.discard('foo', 'jpg')
+        self.assertIsNone(index.get('foo', 'jpg'))
+
+    def test_get_metadata_index(self):
+        self.assertIsNone(get_metadata_index(utils.default_settings))
+        index = get_metadata_index(self.settings)
+        self.assertIs(get_metadata_index(self.settings), index)
+
+    def test_check_and_save_image(self):
+        name = 'smiley-png24-alpha'
+        filename = os.path.join(utils.samples_dir, name + '.png')
+        with open(filename, 'rb') as f:
+            files.check_and_save_image(self.settings, name, f)
+        info = get_metadata_index(self.settings).get(name, 'png')
+        self.assertEqual(info, ImageInfo('PNG', 'RGBA', 512, 512,
+                                         os.path.getsize(filename)))
+
+        chain = FilterChain('meta-thumb', width=100, height=50)
+        self.assertEqual(image_dimensions(self.settings, name, 'png', chain),
+                         (50, 50))
+        self.assertIsNone(image_dimensions(self.settings, name, 'jpg', chain))
+
+        # Saving over an original without checking it drops the stale entry.
+        with open(filename, 'rb') as f:
+            files.save_image(self.settings, name, 'png', f)
+        self.assertIsNone(get_metadata_index(self.settings).get(name, 'png'))
+
+
+class TestOutputSize(TestCase):
+    sizes = [(512, 512), (800, 300), (300, 800), (150, 40), (40, 150),
+             (1001, 667)]
+
+    def check(self, size, **kwargs):
+        im = Image.new('RGB', size, 'white')
+        # Give entropy cropping something to work with.
+        im.paste((200, 30, 30), (size[0] // 3, size[1] // 3,
+                                 size[0] // 2, size[1] // 2))
+        filter = ThumbFilter(**kwargs)
+        self.assertEqual(filter.output_size(size), filter(im).size,
+                         (size, kwargs))
+
+    def test_thumb_filter(self):
+        for size, dimensions, crop, pad, enlarge in itertools.product(
+                self.sizes, [(200, 200), (300, 100), (100, 300)],
+                [False, True], [False, True], [False, True]):
+            self.check(size, dimensions=dimensions, crop=crop, pad=pad,
+                       enlarge=enlarge)
+
+    def test_thumb_filter_partial_dimensions(self):
+        for size, dimensions in itertools.product(
+                self.sizes, [(200, None), (None, 200), (None, None)]):
+            self.check(size, dimensions=dimensions)
+
+    def test_content_dependent(self):
+        filter = ThumbFilter((200, 200), crop='nonwhite')
+        self.assertIsNone(filter.output_size((400, 400)))
+        # Images which are already small enough aren't cropped.
+        self.assertEqual(filter.output_size((100, 150)), (100, 150))
+        self.assertIsNone(ThumbFilter((200, 200), crop_whitespace=True)
+                          .output_size((400, 400)))
+
+    def test_chain(self):
+        chain = FilterChain('meta-chain', width=300, height=200)
+        self.assertEqual(chain.output_size((600, 600)), (200, 200))
+        chain = FilterChain('meta-chain', width=300, height=200, pad=True)
+        self.assertEqual(chain.output_size((600, 600)), (300, 200))
+        chain = FilterChain('meta-chain', no_thumb=True)
+        self.assertEqual(chain.output_size((600, 600)), (600, 600))
+        chain = FilterChain('meta-chain', width=300, height=200,
+                            crop='nonwhite')
+        self.assertIsNone(chain.output_size((600, 600)))
+        chain = FilterChain('meta-chain', width=300, height=200,
+                            filters=[VignetteFilter()])
+        self.assertEqual(chain.output_size((600, 600)), (200, 200))
+
+    def test_custom_filter(self):
+        # The output size of chains with filters which may resize images
+        # isn't known.
+        class RotateFilter(Filter):
+            def filter(self, im):
+                return im.rotate(90, expand=True)
+
+        self.assertIsNone(RotateFilter().output_size((600, 300)))
+        chain = FilterChain('meta-chain', width=300, height=200,
+                            filters=[RotateFilter()])
+        self.assertIsNone(chain.output_size((600, 600)))
+
+
+class TestImageTag(TestCase):
+
+    def test_image_tag_dimensions(self):
+        path = os.path.join(utils.work_dir, 'metadata', 'tag-index.db')
+        if os.path.exists(path):
+            os.unlink(path)
+        app = utils.make_app({
+            'pyramid_frontend.image_metadata_index': path,
+        })
+        index = get_metadata_index(app.registry.settings)
+        test_app = TestApp(app)
+
+        # Falls back to the chain's dimensions until the image is indexed.
+        tag = test_app.get('/image-tag?filter_key=retina').body
+        self.assertIn(b'height="50"', tag)
+
+        index.record('smiley-jpeg-rgb', 'jpg',
+                     ImageInfo('JPEG', 'RGB', 600, 300, 1000))
+        tag = test_app.get('/image-tag?filter_key=retina').body
+        self.assertIn(b'width="50"', tag)
+        self.assertIn(b'height="25"', tag)
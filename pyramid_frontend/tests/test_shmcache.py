@@ -0,0 +1,108 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import time
+from multiprocessing import Process
+from mock import patch
+from unittest import TestCase
+
+from ..images.shmcache import SharedImageCache, shared_cache_from_settings
+
+from . import utils
+
+
+def put_in_child(cache_path, path):
+    cache = SharedImageCache(cache_path, size=64 * 1024, max_item=1024)
+    cache.put(path, b'from the child', os.stat(path).st_mtime)
+
+
+class TestSharedImageCache(TestCase):
+    cache_path = os.path.join(utils.work_dir, 'shm-cache')
+    file_path = os.path.join(utils.work_dir, 'shm-cached-file')
+
+    def setUp(self):
+        if not os.path.exists(utils.work_dir):
+            os.makedirs(utils.work_dir)
+        if os.path.exists(self.cache_path):
+            os.unlink(self.cache_path)
+        with open(self.file_path, 'wb') as f:
+            f.write(b'hello')
+        self.mtime = os.stat(self.file_path).st_mtime
+        self.cache = SharedImageCache(self.cache_path, size=64 * 1024,
+                                      max_item=1024)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get(self.file_path))
+        self.assertTrue(self.cache.put(self.file_path, b'hello', self.mtime))
+        self.assertEqual(self.cache.get(self.file_path), b'hello')
+        self.assertEqual(self.cache.stats(), dict(hits=1, misses=1,
+                                                  evictions=0, entries=1))
+
+    def test_min_mtime(self):
+        self.cache.put(self.file_path, b'hello', self.mtime)
+        self.assertIsNone(self.cache.get(self.file_path,
+                                         min_mtime=self.mtime + 1))
+        self.assertEqual(self.cache.get(self.file_path,
+                                        min_mtime=self.mtime), b'hello')
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.put(self.file_path, b'x' * 1025,
+                                        self.mtime))
+        self.assertIsNone(self.cache.get(self.file_path))
+
+    def test_evict(self):
+        # With only one set, the ninth entry evicts the least recently used.
+        cache = SharedImageCache(self.cache_path, size=8 * 1024,
+                                 max_item=1024)
+        self.assertEqual(cache.num_slots, 8)
+        for ii in range(8):
+            cache.put('/images/%d' % ii, b'data', 0)
+        self.assertIsNotNone(cache.get('/images/0'))
+        cache.put('/images/8', b'data', 0)
+        self.assertIsNotNone(cache.get('/images/0'))
+        self.assertIsNone(cache.get('/images/1'))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 8)
+
+    def test_revalidate(self):
+        cache = SharedImageCache(self.cache_path, size=64 * 1024,
+                                 max_item=1024, revalidate=0)
+        cache.put(self.file_path, b'hello', self.mtime)
+        self.assertEqual(cache.get(self.file_path), b'hello')
+        os.utime(self.file_path, (time.time(), self.mtime + 10))
+        self.assertIsNone(cache.get(self.file_path))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_updated_while_revalidating(self):
+        cache = SharedImageCache(self.cache_path, size=64 * 1024,
+                                 max_item=1024, revalidate=0)
+        cache.put(self.file_path, b'hello', self.mtime)
+        real_stat = os.stat
+
+        def stat_and_update(path):
+            # Another process stores a newer version between the checks.
+            cache.put(self.file_path, b'goodbye', self.mtime + 10)
+            return real_stat(path)
+
+        with patch('os.stat', side_effect=stat_and_update):
+            self.assertIsNone(cache.get(self.file_path))
+        self.assertEqual(self.cache.get(self.file_path), b'goodbye')
+
+    def test_shared_between_processes(self):
+        p = Process(target=put_in_child,
+                    args=(self.cache_path, self.file_path))
+        p.start()
+        p.join()
+        self.assertEqual(self.cache.get(self.file_path), b'from the child')
+
+    def test_from_settings(self):
+        self.assertIsNone(shared_cache_from_settings({}))
+        cache = shared_cache_from_settings({
+            'pyramid_frontend.image_shm_cache': self.cache_path,
+            'pyramid_frontend.image_shm_cache_max_item': '1024',
+            'pyramid_frontend.image_shm_cache_revalidate': '0',
+        })
+        self.assertEqual(cache.slot_size, 1024)
+        self.assertEqual(cache.revalidate, 0)
@@ -0,0 +1,43 @@
+from __future__ import absolute_import, print_function, division
+
+from unittest import TestCase
+
+from ..images.signing import (signing_keys, sign, signer, url_signature,
+                              check_signature)
+
+
+class TestSigning(TestCase):
+    settings = {
+        'pyramid_frontend.image_signing_keys': 'new-key\nold-key',
+    }
+
+    def test_keys(self):
+        self.assertEqual(signing_keys(self.settings), [b'new-key', b'old-key'])
+        self.assertEqual(signing_keys({}), [])
+
+    def test_sign(self):
+        basename = 'foo_jpg_thumb.png'
+        signature = url_signature(self.settings, basename)
+        self.assertEqual(signature, sign(b'new-key', basename))
+        self.assertEqual(len(signature), 16)
+        self.assertNotEqual(signature, sign(b'new-key', 'foo_jpg_full.png'))
+        self.assertIsNone(url_signature({}, basename))
+        sign_basename = signer(b'new-key')
+        self.assertEqual(sign_basename(basename), signature)
+        self.assertEqual(sign_basename(basename), signature)
+
+    def test_check(self):
+        basename = 'foo_jpg_thumb.png'
+        self.assertTrue(check_signature(self.settings, basename,
+                                        sign(b'new-key', basename)))
+        # Still valid while the old key is being retired.
+        self.assertTrue(check_signature(self.settings, basename,
+                                        sign(b'old-key', basename)))
+        self.assertFalse(check_signature(self.settings, basename,
+                                         sign(b'other-key', basename)))
+        self.assertFalse(check_signature(self.settings, 'bar_jpg_thumb.png',
+                                         sign(b'new-key', basename)))
+        self.assertFalse(check_signature(self.settings, basename, None))
+        self.assertFalse(check_signature(self.settings, basename, u'\xe9'))
+        # Anything goes if URLs aren't signed.
+        self.assertTrue(check_signature({}, basename, None))
@@ -0,0 +1,171 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import shutil
+
+from mock import patch
+from six import BytesIO
+from unittest import TestCase, SkipTest
+from webtest import TestApp
+
+from PIL import Image
+
+from ..images import files
+from ..images.chain import FilterChain
+from ..images.storage import LocalStorage, S3Storage, get_storage
+from ..images.view import MissingOriginal, process_image
+
+from . import utils
+
+try:
+    import boto3
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    boto3 = None
+
+
+class TestLocalStorage(TestCase):
+    root = os.path.join(utils.work_dir, 'storage')
+
+    def setUp(self):
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        self.storage = LocalStorage(self.root)
+
+    def test_save_open_delete(self):
+        key = 'abcd/hello.txt'
+        self.assertFalse(self.storage.exists(key))
+        self.assertIsNone(self.storage.stat(key))
+        self.storage.save(key, BytesIO(b'hello'))
+        self.assertTrue(self.storage.exists(key))
+        self.assertEqual(self.storage.path(key),
+                         os.path.join(self.root, 'abcd', 'hello.txt'))
+        self.assertEqual(self.storage.stat(key)[1], 5)
+        with self.storage.open(key) as f:
+            self.assertEqual(f.read(), b'hello')
+        self.storage.delete(key)
+        self.assertFalse(self.storage.exists(key))
+        # Deleting a missing key is not an error.
+        self.storage.delete(key)
+
+    def test_save_permissions(self):
+        # Saved files are made writable by the group, on top of what the umask
+        # allows, but never by everyone.
+        key = 'abcd/hello.txt'
+        umask = os.umask(0o027)
+        try:
+            self.storage.save(key, BytesIO(b'hello'))
+        finally:
+            os.umask(umask)
+        mode = os.stat(self.storage.path(key)).st_mode & 0o777
+        self.assertEqual(mode, 0o660)
+
+    def test_get_storage_default(self):
+        storage = get_storage(utils.default_settings, 'processed')
+        self.assertIsInstance(storage, LocalStorage)
+        self.assertEqual(
+            storage.root,
+            utils.default_settings['pyramid_frontend.processed_image_dir'])
+
+
+class S3TestCase(TestCase):
+    """
+    Runs tests against a local stand-in for S3.
+    """
+    bucket = 'pfe-test'
+
+    @classmethod
+    def setUpClass(cls):
+        if boto3 is None:
+            raise SkipTest('boto3 and moto are required for S3 tests')
+        cls.env = patch.dict(os.environ, {
+            'AWS_ACCESS_KEY_ID': 'testing',
+            'AWS_SECRET_ACCESS_KEY': 'testing',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+        })
+        cls.env.start()
+        cls.server = ThreadedMotoServer(ip_address='127.0.0.1', port=0,
+                                        verbose=False)
+        cls.server.start()
+        cls.endpoint_url = 'http://%s:%d' % cls.server.get_host_and_port()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.env.stop()
+
+    def setUp(self):
+        client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        client.create_bucket(Bucket=self.bucket)
+        self.settings = dict(utils.default_settings)
+        self.settings.update({
+            'pyramid_frontend.image_storage': 's3',
+            'pyramid_frontend.s3_bucket': self.bucket,
+            'pyramid_frontend.s3_endpoint_url': self.endpoint_url,
+        })
+        for filename in ('smiley-jpeg-rgb.jpg', 'smiley-png24-alpha.png'):
+            name, ext = filename.rsplit('.', 1)
+            with open(os.path.join(utils.samples_dir, filename), 'rb') as f:
+                files.save_image(self.settings, name, ext, f)
+
+
+class TestS3Storage(S3TestCase):
+
+    def test_save_open_delete(self):
+        storage = S3Storage(self.bucket, prefix='misc/',
+                            endpoint_url=self.endpoint_url)
+        key = 'abcd/hello.txt'
+        self.assertFalse(storage.exists(key))
+        self.assertIsNone(storage.stat(key))
+        storage.save(key, BytesIO(b'hello'))
+        self.assertTrue(storage.exists(key))
+        self.assertEqual(storage.path(key),
+                         's3://pfe-test/misc/abcd/hello.txt')
+        self.assertEqual(storage.stat(key)[1], 5)
+        self.assertEqual(storage.open(key).read(), b'hello')
+        self.assertEqual(storage.open_stream(key).read(), b'hello')
+        storage.delete(key)
+        self.assertFalse(storage.exists(key))
+
+    def test_get_storage_reused(self):
+        originals = get_storage(self.settings, 'original')
+        self.assertIsInstance(originals, S3Storage)
+        self.assertEqual(originals.prefix, 'original/')
+        self.assertIs(get_storage(self.settings, 'original'), originals)
+        self.assertEqual(get_storage(self.settings, 'processed').prefix,
+                         'processed/')
+
+    def test_process_image(self):
+        chain = FilterChain('s3-thumb', extension='jpg', width=50, height=50)
+        name = 'smiley-jpeg-rgb'
+        token = files.version_token(self.settings, name, 'jpg', chain)
+        self.assertTrue(token)
+        process_image(self.settings, name, 'jpg', chain)
+        processed = get_storage(self.settings, 'processed')
+        key = files.processed_key(name, 'jpg', chain)
+        im = Image.open(processed.open(key))
+        self.assertEqual(im.size, (50, 50))
+        # Nothing was written to the local processed image directory.
+        self.assertFalse(os.path.exists(
+            files.processed_path(self.settings, name, 'jpg', chain)))
+
+    def test_process_missing_original(self):
+        chain = FilterChain('s3-thumb', extension='jpg', width=50, height=50)
+        with self.assertRaises(MissingOriginal) as cm:
+            process_image(self.settings, 'nonexistent-file', 'jpg', chain)
+        self.assertTrue(cm.exception.path.startswith('s3://pfe-test/'))
+
+
+class TestImagesS3(S3TestCase):
+
+    def test_fetch_image(self):
+        app = TestApp(utils.make_app(self.settings))
+        name = 'smiley-png24-alpha'
+        prefix = files.prefix_for_name(name)
+        url = '/img/%s/%s_png_thumb.png' % (prefix, name)
+        for ii in range(2):
+            resp = app.get(url)
+            self.assertEqual(resp.content_type, 'image/png')
+            im = Image.open(BytesIO(resp.body))
+            self.assertEqual(im.size, (200, 200))
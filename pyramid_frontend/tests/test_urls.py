@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, division
+
+from unittest import TestCase
+
+from pyramid.request import Request
+from pyramid.scripting import prepare
+from webtest import TestApp
+
+from ..images import image_url, image_urls, files
+from ..images.urls import get_url_builder
+
+from . import utils
+
+
+names = ['smiley-jpeg-rgb', 'with space', u'ünïcode', 'a+b&c?d#e', 'pct%20']
+
+
+class TestImageURLs(TestCase):
+
+    def make_request(self, settings=None, script_name=''):
+        registry = utils.make_app(settings).registry
+        request = Request.blank('/', base_url='http://example.com:8080' +
+                                script_name)
+        request.registry = registry
+        return request
+
+    def route_path(self, request, name, ext, chain, **kwargs):
+        return request.route_path('pyramid_frontend:images',
+                                  prefix=files.prefix_for_name(name),
+                                  name=chain.basename(name, ext),
+                                  **kwargs)
+
+    def test_same_as_route(self):
+        request = self.make_request(script_name='/app')
+        for key in ('thumb', 'ladder-w400', None):
+            chain = get_url_builder(request.registry, key).chain
+            self.assertEqual(image_urls(request, names, 'jpg', key),
+                             [self.route_path(request, name, 'jpg', chain)
+                              for name in names])
+        self.assertEqual(
+            image_urls(request, names[:1], 'jpg', 'thumb', qualified=True),
+            [request.route_url('pyramid_frontend:images',
+                               prefix=files.prefix_for_name(names[0]),
+                               name='smiley-jpeg-rgb_jpg_thumb.png')])
+        self.assertTrue(image_url(request, names[0], 'jpg', 'thumb',
+                                  qualified=True, _scheme='https')
+                        .startswith('https://example.com:8080/app/img/'))
+
+    def test_versioned_signed(self):
+        utils.load_images()
+        request = self.make_request({
+            'pyramid_frontend.image_versioned_urls': 'true',
+            'pyramid_frontend.image_signing_keys': 'secret',
+        })
+        urls = image_urls(request, ['smiley-jpeg-rgb', 'nonexistent-file'],
+                          'jpg', 'thumb')
+        self.assertRegexpMatches(urls[0], r'_jpg_thumb\.png\?v=[0-9a-f]{12}'
+                                 r'&s=[\w-]{16}$')
+        self.assertRegexpMatches(urls[1], r'_jpg_thumb\.png\?s=[\w-]{16}$')
+        self.assertEqual(image_url(request, 'smiley-jpeg-rgb', 'jpg',
+                                   'thumb'), urls[0])
+
+    def test_builder_reused(self):
+        request = self.make_request()
+        builder = get_url_builder(request.registry, 'thumb')
+        self.assertIs(get_url_builder(request.registry, 'thumb'), builder)
+        self.assertEqual(builder.tail('jpg'), '_jpg_thumb.png')
+
+    def test_memoized_prefix(self):
+        self.assertEqual(files.prefix_for_name('smiley-jpeg-rgb'),
+                         files.prefix_for_name('smiley-jpeg-rgb'))
+        self.assertRegexpMatches(files.prefix_for_name(u'ünïcode'),
+                                 '^[0-9a-f]{4}$')
+
+
+class TestImageURLsFunctional(TestCase):
+
+    def test_image_urls_request_method(self):
+        utils.load_images()
+        app = utils.make_app()
+        env = prepare(registry=app.registry)
+        try:
+            urls = env['request'].image_urls(['smiley-jpeg-rgb',
+                                              'smiley-jpeg-cmyk'],
+                                             'jpg', 'thumb')
+        finally:
+            env['closer']()
+        test_app = TestApp(app)
+        for url in urls:
+            resp = test_app.get(url)
+            self.assertEqual(resp.content_type, 'image/png')
@@ -0,0 +1,101 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+from mock import patch
+from unittest import TestCase
+from six import StringIO
+
+from .. import warm
+from ..images import files
+
+from . import utils
+
+
+class TestWarmCommand(TestCase):
+
+    def setUp(self):
+        utils.load_images()
+        self.registry = utils.make_app().registry
+        self.checkpoint = os.path.join(utils.work_dir, 'warm-checkpoint')
+        if os.path.exists(self.checkpoint):
+            os.unlink(self.checkpoint)
+
+    def test_pwarm_usage(self):
+        args = [
+            'pwarm',
+        ]
+        buf = StringIO()
+        with patch('sys.stderr', buf):
+            with self.assertRaises(SystemExit) as cm:
+                warm.main(args)
+            exit_exception = cm.exception
+            self.assertEqual(exit_exception.code, 2)
+        self.assertIn('config_uri', buf.getvalue())
+
+    def test_select_chains(self):
+        chains = warm.select_chains(self.registry)
+        self.assertIn('thumb', [chain.suffix for chain in chains])
+
+        chains = warm.select_chains(self.registry, only_theme='foo')
+        self.assertEqual(sorted(chain.suffix for chain in chains),
+                         ['full', 'tiny'])
+
+        chains = warm.select_chains(self.registry, only_theme='foo',
+                                    only_chains=['tiny'])
+        self.assertEqual([chain.suffix for chain in chains], ['tiny'])
+
+    def test_warm(self):
+        settings = self.registry.settings
+        originals, variants, errors = warm.warm(self.registry, jobs=2,
+                                                only_chains=['thumb', 'tiny'],
+                                                checkpoint=self.checkpoint)
+        self.assertEqual(originals, 5)
+        self.assertEqual(variants, 10)
+        self.assertEqual(errors, 0)
+
+        chain, with_theme = self.registry.image_filter_registry['tiny']
+        name = 'smiley-jpeg-rgb'
+        self.assertTrue(os.path.exists(
+            files.processed_path(settings, name, 'jpg', chain)))
+        with open(self.checkpoint) as f:
+            self.assertIn(files.prefix_for_name(name), f.read().split())
+
+        # Everything is done, so resuming finds nothing to do.
+        self.assertEqual(warm.warm(self.registry, checkpoint=self.checkpoint),
+                         (0, 0, 0))
+
+        # Without a checkpoint, everything is checked again, but only
+        # missing variants are generated.
+        originals, variants, errors = warm.warm(self.registry,
+                                                only_theme='foo')
+        self.assertEqual(originals, 5)
+        self.assertEqual(variants, 5)
+
+    def test_warm_checkpoint_skips_failed_prefixes(self):
+        settings = self.registry.settings
+        name = 'not-really-an-image'
+        prefix = files.prefix_for_name(name)
+        dirpath = os.path.join(settings['pyramid_frontend.original_image_dir'],
+                               prefix)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        path = os.path.join(dirpath, name + '.jpg')
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+        self.addCleanup(os.unlink, path)
+
+        originals, variants, errors = warm.warm(self.registry,
+                                                only_chains=['tiny'],
+                                                checkpoint=self.checkpoint)
+        self.assertEqual(errors, 1)
+        with open(self.checkpoint) as f:
+            done = f.read().split()
+        self.assertNotIn(prefix, done)
+        self.assertIn(files.prefix_for_name('smiley-jpeg-rgb'), done)
+
+    def test_warm_requires_local_originals(self):
+        with patch.object(warm, 'get_storage') as get_storage:
+            get_storage.return_value.local = False
+            with self.assertRaises(ValueError):
+                warm.warm(self.registry)
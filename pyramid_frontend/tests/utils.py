@@ -117,6 +117,12 @@ def make_app(settings=None, theme_strategy=None):
 
     config.add_image_filter(FilterChain('thumb', width=200, height=200,
                                         crop=True))
+    config.add_image_filter(FilterChain('versioned', width=100, height=100,
+                                        fingerprinted=True))
+    config.add_image_filter(FilterChain('ladder', width=200, height=100,
+                                        crop=True, widths=[100, 400]))
+    config.add_image_filter(FilterChain('retina', width=50, height=50,
+                                        densities=[1, 2, 3]))
 
     config.add_theme(base.BaseTheme)
     config.add_theme(foo.FooTheme)
@@ -0,0 +1,192 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import os.path
+import logging
+import time
+
+import argparse
+import sys
+
+from multiprocessing import Pool
+
+from pyramid.paster import bootstrap
+
+from .compile import configure_logging
+from .images.executor import picklable_settings
+from .images.files import processed_key
+from .images.storage import get_storage
+from .images.view import process_variants, plausible_extensions
+
+log = logging.getLogger('pyramid_frontend')
+
+
+# Set in each worker process by _init_worker().
+_worker_settings = None
+_worker_chains = None
+
+
+def _init_worker(settings, chains):
+    global _worker_settings, _worker_chains
+    _worker_settings = settings
+    _worker_chains = chains
+
+
+def _warm_prefix(prefix):
+    """
+    Generate every missing variant for all of the originals in one prefix
+    directory. Returns ``(prefix, originals, variants, errors)`` counts.
+    """
+    settings = _worker_settings
+    dirpath = get_storage(settings, 'original').path(prefix)
+    processed = get_storage(settings, 'processed')
+    originals = variants = errors = 0
+    for filename in sorted(os.listdir(dirpath)):
+        if filename.startswith('.') or '.' not in filename:
+            continue
+        name, original_ext = filename.rsplit('.', 1)
+        if original_ext not in plausible_extensions:
+            continue
+        originals += 1
+        missing = [chain for chain in _worker_chains
+                   if not processed.exists(processed_key(name, original_ext,
+                                                         chain))]
+        if not missing:
+            continue
+        try:
+            # Parallelism comes from the process pool, so only use one
+            # thread per original here.
+            process_variants(settings, name, original_ext, missing,
+                             threads=1)
+        except Exception:
+            log.exception('Failed to process %s', filename)
+            errors += 1
+        else:
+            variants += len(missing)
+    return prefix, originals, variants, errors
+
+
+def select_chains(registry, only_theme=None, only_chains=None):
+    """
+    Return the filter chains to warm: every chain registered in ``registry``,
+    or those used by ``only_theme``, optionally narrowed down to the suffixes
+    in ``only_chains``.
+    """
+    if only_theme:
+        theme_registry = registry.settings['pyramid_frontend.theme_registry']
+        chains = list(theme_registry[only_theme].stacked_image_filters)
+    else:
+        chains = [chain for chain, with_theme
+                  in registry.image_filter_registry.values()]
+    if only_chains:
+        chains = [chain for chain in chains if chain.suffix in only_chains]
+    return chains
+
+
+def read_checkpoint(path):
+    if not (path and os.path.exists(path)):
+        return set()
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def warm(registry, jobs=1, only_theme=None, only_chains=None,
+         checkpoint=None, report_interval=10):
+    """
+    Generate every missing image variant for every original image, for the
+    filter chains which are registered in ``registry``.
+
+    Originals are processed one prefix directory at a time by a pool of
+    ``jobs`` worker processes. If a ``checkpoint`` path is given, each
+    finished prefix directory is recorded there, and skipped by subsequent
+    runs, so that an interrupted run can be resumed. Prefix directories in
+    which any original failed aren't recorded, so that they're retried.
+
+    Originals are found by listing their directories, so they must be in
+    local storage. Processed images may be stored by any backend.
+
+    Returns a tuple of the numbers of originals processed, variants generated,
+    and originals which failed.
+    """
+    settings = registry.settings
+    chains = select_chains(registry, only_theme=only_theme,
+                           only_chains=only_chains)
+    log.warning('Warming %d filter chains: %s', len(chains),
+                ', '.join(str(chain.suffix) for chain in chains))
+
+    original_storage = get_storage(settings, 'original')
+    if not original_storage.local:
+        raise ValueError("can't list originals in %r: pwarm only supports "
+                         "local original storage" % original_storage)
+    originals_dir = original_storage.root
+    done = read_checkpoint(checkpoint)
+    prefixes = [prefix for prefix in sorted(os.listdir(originals_dir))
+                if prefix not in done and
+                os.path.isdir(os.path.join(originals_dir, prefix))]
+    count = len(prefixes)
+    if done:
+        log.warning('Resuming: skipping %d prefixes from %s',
+                    len(done), checkpoint)
+
+    totals = [0, 0, 0]
+    start_time = last_report = time.time()
+    checkpoint_f = open(checkpoint, 'a') if checkpoint else None
+    pool = Pool(jobs, initializer=_init_worker,
+                initargs=(picklable_settings(settings), chains))
+    try:
+        results = pool.imap_unordered(_warm_prefix, prefixes)
+        for ii, (prefix, originals, variants, errors) in enumerate(results):
+            totals[0] += originals
+            totals[1] += variants
+            totals[2] += errors
+            if checkpoint_f and not errors:
+                checkpoint_f.write(prefix + '\n')
+                checkpoint_f.flush()
+
+            now = time.time()
+            if (now - last_report >= report_interval) or (ii + 1 == count):
+                last_report = now
+                elapsed = max(now - start_time, 0.001)
+                log.warning('%d / %d prefixes - %d originals (%.1f/s), '
+                            '%d variants (%.1f/s), %d errors',
+                            ii + 1, count,
+                            totals[0], totals[0] / elapsed,
+                            totals[1], totals[1] / elapsed,
+                            totals[2])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if checkpoint_f:
+            checkpoint_f.close()
+    return tuple(totals)
+
+
+def main(args=sys.argv):
+    """
+    Main entry point for the executable which pre-generates image variants.
+    """
+    parser = argparse.ArgumentParser(
+        description='Generate missing image variants.')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('-v', '--verbose', action='count', default=2)
+    parser.add_argument('-t', '--theme', default=None)
+    parser.add_argument('-c', '--chain', action='append', default=None,
+                        help='Only warm this filter chain suffix. May be '
+                        'given more than once.')
+    parser.add_argument('--checkpoint', default=None,
+                        help='File to record progress in, so that an '
+                        'interrupted run can be resumed.')
+    parser.add_argument('config_uri')
+
+    options = parser.parse_args(args[1:])
+
+    env = bootstrap(options.config_uri)
+    configure_logging(options.verbose)
+    registry = env['registry']
+    originals, variants, errors = warm(registry,
+                                       jobs=options.jobs,
+                                       only_theme=options.theme,
+                                       only_chains=options.chain,
+                                       checkpoint=options.checkpoint)
+    return 1 if errors else 0
@@ -67,8 +67,11 @@ setup(name='pyramid_frontend',
           'Mako>=0.9.0',
           'WebHelpers2>=2.0b5',
           'six>=1.5.2',
-          'lockfile>=0.9.1',
       ],
+      extras_require={
+          's3': ['boto3'],
+          'numpy': ['numpy'],
+      },
       license='MIT',
       packages=find_packages(),
       test_suite='nose.collector',
@@ -78,4 +81,6 @@ setup(name='pyramid_frontend',
       entry_points="""\
       [console_scripts]
       pcompile = pyramid_frontend.compile:main
+      pwarm = pyramid_frontend.warm:main
+      pgc = pyramid_frontend.sweep:main
       """)